@@ -9,6 +9,7 @@ import numpy as np
 import logic.sim as sim
 import logic.helper as hlp
 from logic.model_reporters import ALL_MODEL_REPORTEERS
+from logic.metrics import COLLECTION_POLICIES
 
 if __name__ == "__main__":
     #multiprocessing.freeze_support()  # needed for multiprocessing to work on windows systems (comment out line to run on linux or mac / uncomment for windows) #todo is that still needed? if yes, detect os and act accordingly
@@ -55,6 +56,15 @@ if __name__ == "__main__":
     parser.add_argument('--iterations_after_convergence', type=int, default=10,
                         help='The minimum consecutive idle iterations that are required before terminations. '
                              'Default is 10.')
+    parser.add_argument('--collection_policy', nargs="?", type=str.lower, default='final',
+                        choices=COLLECTION_POLICIES,
+                        help='The steps at which the metrics of each simulation are collected: "every_step", '
+                             '"every_n_steps" (see collection_period), "on_change" (only steps where the state changed) '
+                             'or "final" (only the final state, which is all that the aggregate results need). '
+                             'Default is "final".')
+    parser.add_argument('--collection_period', nargs="?", type=hlp.positive_int, default=1,
+                        help='The number of steps between two collections of the metrics, when the collection policy '
+                             'is "every_n_steps". Default is 1.')
     parser.add_argument('--agent_profile_distr', nargs="*", type=float, default=[1, 0, 0],
                         help='The probability distribution for assigning different profiles to the agents. Default is [1, 0, 0], i.e. 100%% non-myopic agents.')
 
@@ -181,9 +181,13 @@ def _model_run_func(
 
     data = []
 
-    steps = list(range(0, model.schedule.steps, data_collection_period))
-    if not steps or steps[-1] != model.schedule.steps - 1:
-        steps.append(model.schedule.steps - 1)
+    # only the steps whose metrics were collected and are still held in memory can be used (the rest can be found in
+    # the metrics file), and the last collected step always corresponds to the final state of the simulation
+    datacollector = model.datacollector
+    steps = [step for step in datacollector.retained_steps
+             if data_collection_period > 0 and step % data_collection_period == 0]
+    if not steps or steps[-1] != datacollector.last_step:
+        steps.append(datacollector.last_step)
 
     for step in steps:
         model_data, all_agents_data = _collect_data(model, step)
@@ -198,7 +202,7 @@ def _model_run_func(
         else:
             stepdata = [{**{"Step": step}, **kwargs, **model_data}]
 
-            if step == model.schedule.steps - 1:
+            if step == datacollector.last_step:
                 # write end-of-run results to file
                 header = [key for key in stepdata[0].keys() if key not in fixed_params]
                 row = [value for key, value in stepdata[0].items() if key not in fixed_params]
@@ -215,14 +219,7 @@ def _collect_data(
     model: Model,
     step: int,
 ) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
-    """Collect model and agent data from a model using mesas datacollector."""
-    dc = model.datacollector
-    model_data = {param: values[step] for param, values in dc.model_vars.items()}
-
+    """Collect model data from a model using its metrics collector (there are no agent-level metrics)."""
+    model_data = model.datacollector.get_row(step)
     all_agents_data = []
-    raw_agent_data = dc._agent_records.get(step, [])
-    for data in raw_agent_data:
-        agent_dict = {"AgentID": data[1]}
-        agent_dict.update(zip(dc.agent_reporters, data[2:]))
-        all_agents_data.append(agent_dict)
     return model_data, all_agents_data
@@ -63,7 +63,7 @@ class BubbleChartModule(VisualizationElement):
         for s in self.series:
             name = s["Label"]
             try:
-                data_dict = data_collector.model_vars[name][-1]  # Latest values collected
+                data_dict = data_collector.get_latest_value(name)  # Latest values collected
             except (IndexError, KeyError):
                 continue
             x = data_dict['x']
@@ -42,7 +42,7 @@ class MyChartModule(VisualizationElement):
         for s in self.series:
             name = s["label"]
             try:
-                val = data_collector.model_vars[name][-1]  # Latest value
+                val = data_collector.get_latest_value(name)  # Latest value
             except (IndexError, KeyError):
                 continue  # todo maybe add sth to know if it happens any time other than the beginning
             current_values.append(val)
@@ -69,7 +69,7 @@ class StackedChartModule(VisualizationElement):
         for s in self.series:
             name = s["Label"]
             try:
-                values = data_collector.model_vars[name][-1]  # Latest values collected
+                values = data_collector.get_latest_value(name)  # Latest values collected
             except (IndexError, KeyError):
                 continue
             keys = list(values.keys())
@@ -1,3 +1,8 @@
+import heapq
+import io
+import multiprocessing
+import pickle
+
 from mesa.time import BaseScheduler
 
 
@@ -9,26 +14,402 @@ class SemiSimultaneousActivation(BaseScheduler):
     step() activates the agent and stages any necessary changes, but does not
     apply them yet. advance() then applies the changes.
 
+    If adaptive_simultaneous_moves is True, then the number of agents that are activated at the same time grows as the
+    number of agents that change their strategy in a step drops, so that the expected number of agents that move
+    simultaneously stays around z (and the late steps of the simulation, when few agents move, are completed in fewer
+    blocks).
+
     """
-    def __init__(self, model, simultaneous_moves=5, all_agents_move=True):
+    def __init__(self, model, simultaneous_moves=5, all_agents_move=True, adaptive_simultaneous_moves=False):
         super().__init__(model)
         self.simultaneous_moves = simultaneous_moves
         self.all_agents_move = all_agents_move
+        self.adaptive_simultaneous_moves = adaptive_simultaneous_moves
+        self.current_simultaneous_moves = simultaneous_moves  # the size of the blocks of agents for the next step
 
     def step(self) -> None:
         """
         Step a certain number of agents at a time, then advance them.
         if self.all_agents_move is True, then repeat until all agents have had the chance to make a move.
         """
+        # draw one random order for all agents and go through it in blocks
         agent_keys = list(self._agents.keys())
-        while len(agent_keys) > 0:
-            k = self.simultaneous_moves if self.simultaneous_moves < len(agent_keys) else len(agent_keys)
-            current_agent_keys = self.model.random.sample(agent_keys, k=k)
+        self.model.random.shuffle(agent_keys)
+        block_size = self.current_simultaneous_moves
+        if not self.all_agents_move:
+            agent_keys = agent_keys[:block_size]
+        moving_agents = 0
+        for start in range(0, len(agent_keys), block_size):
+            current_agent_keys = agent_keys[start:start + block_size]
             for agent_key in current_agent_keys:
                 self._agents[agent_key].step()
             for agent_key in current_agent_keys:
-                self._agents[agent_key].advance()
-            # Update keys to sample from
-            agent_keys = [key for key in agent_keys if key not in current_agent_keys] if self.all_agents_move else []
+                agent = self._agents[agent_key]
+                if getattr(agent, 'new_strategy', None) is not None:
+                    moving_agents += 1
+                agent.advance()
+        if self.adaptive_simultaneous_moves:
+            num_agents = len(self._agents)
+            self.current_simultaneous_moves = min(
+                max(num_agents, 1),
+                max(self.simultaneous_moves, self.simultaneous_moves * num_agents // max(moving_agents, 1))
+            )
+        self.steps += 1
+        self.time += 1
+
+
+# the attributes of the model that may change from step to step and that the agents' decisions depend on (the
+# multi-phase parameters of the model are also included, see get_step_state)
+STEP_STATE_ATTRIBUTES = ['pools', 'pool_rankings', 'pool_rankings_myopic', 'reward_scheme', 'state_version', 'id_seq']
+# the attributes of the agents that their decisions depend on and that refer to the state of the model (e.g. the
+# rankings that some agents keep a reference to), so they must point to the copies that are sent to the workers
+AGENT_STEP_STATE_ATTRIBUTES = ['strategy', 'idle_state_version', 'idle_num_pool_ids', 'rankings']
+
+_worker_model = None  # the copy of the model that is held by each worker process
+
+
+class ModelPickler(pickle.Pickler):
+    """
+    Pickler that refers to the model instead of copying it, e.g. when pickling rankings whose key function is a method
+    of the model. The model is replaced by the copy of the receiving process when unpickling (see ModelUnpickler).
+    """
+
+    def __init__(self, file, model):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.model = model
+
+    def persistent_id(self, obj):
+        return 'model' if obj is self.model else None
+
+
+class ModelUnpickler(pickle.Unpickler):
+
+    def __init__(self, file, model):
+        super().__init__(file)
+        self.model = model
+
+    def persistent_load(self, pid):
+        if pid != 'model':
+            raise pickle.UnpicklingError('unsupported persistent id: {}'.format(pid))
+        return self.model
+
+
+def initialize_worker(model_snapshot):
+    """
+    Store a copy of the model in the worker process (meant to be executed once, when the process starts).
+    @param model_snapshot: the pickled model
+    """
+    global _worker_model
+    _worker_model = pickle.loads(model_snapshot)
+
+
+def evaluate_agent_moves(state_snapshot, agent_keys):
+    """
+    Activate some agents on the worker's copy of the model, without applying their moves (meant to be executed in a
+    worker process).
+    @param state_snapshot: the pickled state of the model for the current step (see get_step_state)
+    @param agent_keys: the keys of the agents to activate
+    @return: list with a tuple for each agent, which holds the agent's key, their new strategy, the state version at
+        which they last stayed idle and the number of pool ids that they used then, the value of the pool id sequence
+        before their activation and the number of pool ids that they used
+    """
+    model = _worker_model
+    state = ModelUnpickler(io.BytesIO(state_snapshot), model).load()
+    for name, value in state['attributes'].items():
+        setattr(model, name, value)
+    agents = model.schedule._agents
+    for agent_key, agent_attributes in state['agents'].items():
+        for name, value in agent_attributes.items():
+            setattr(agents[agent_key], name, value)
+    results = []
+    for agent_key in agent_keys:
+        agent = agents[agent_key]
+        id_seq = model.id_seq
+        agent.step()
+        if agent.new_strategy is not None:
+            for pool in agent.new_strategy.owned_pools.values():
+                if pool.id in model.pools and pool.delegators is model.pools[pool.id].delegators:
+                    # no need to send back the delegators of existing pools, as the main process already has them
+                    pool.delegators = None
+        results.append((agent_key, agent.new_strategy, agent.idle_state_version, agent.idle_num_pool_ids, id_seq,
+                        model.id_seq - id_seq))
+    return results
+
+
+class ParallelSimultaneousActivation(BaseScheduler):
+    """A scheduler to simulate the simultaneous activation of all the agents, using multiple processes.
+    Like in SimultaneousActivation, all agents are first activated (step) and then they apply their moves (advance).
+    Each worker process receives a copy of the model when it starts, and since the state of the model doesn't change
+    during the first phase, only the parts of the state that the agents' decisions depend on (the pools, their rankings,
+    the reward scheme and the strategies of the agents to activate) are sent to the workers in every step, each of which
+    activates a different subset of the agents. The moves of the agents are then applied by the main process, in the
+    same order as in SimultaneousActivation, so the results are identical.
+    The worker processes are started on the first step and they are terminated when the simulation finishes (see
+    shutdown). Agents are activated in the current process instead if it is a worker process itself (e.g. in batch runs,
+    where every simulation already runs in a separate process) or if only one worker is used.
+
+    """
+    def __init__(self, model, num_workers=None):
+        super().__init__(model)
+        self.num_workers = num_workers if num_workers is not None else multiprocessing.cpu_count()
+        self.worker_pool = None
+
+    def __getstate__(self):
+        # the worker processes can't be pickled (e.g. when sending the model to them)
+        state = self.__dict__.copy()
+        state['worker_pool'] = None
+        return state
+
+    @property
+    def uses_workers(self):
+        # daemonic processes (like the ones of a multiprocessing pool) are not allowed to start processes of their own
+        return self.num_workers > 1 and not multiprocessing.current_process().daemon
+
+    def step(self) -> None:
+        """Step all agents (in parallel), then advance them."""
+        model = self.model
+        agent_keys = list(self._agents.keys())
+        results = {}
+        if self.uses_workers:
+            # agents that know that their strategy won't change are activated directly
+            agent_keys_to_evaluate = [
+                agent_key for agent_key in agent_keys
+                if getattr(self._agents[agent_key], 'idle_state_version', None) != model.state_version
+            ]
+            if len(agent_keys_to_evaluate) > 0:
+                results = self.evaluate_agent_moves(agent_keys_to_evaluate)
+
+        for agent_key in agent_keys:
+            agent = self._agents[agent_key]
+            if agent_key not in results:
+                agent.step()
+                continue
+            new_strategy, agent.idle_state_version, agent.idle_num_pool_ids, first_pool_id, num_pool_ids = \
+                results[agent_key]
+            if new_strategy is not None:
+                owned_pools = dict()
+                for pool_id, pool in new_strategy.owned_pools.items():
+                    if pool_id > first_pool_id:
+                        # new pool, so we assign the id that it would get if the agents were activated one by one
+                        pool.id = pool_id = pool_id - first_pool_id + model.id_seq
+                    elif pool.delegators is None:
+                        # the pool is a draft of an existing one, so it shares its delegators (until they change)
+                        live_pool = model.pools[pool_id]
+                        pool.delegators = live_pool.delegators
+                        pool._shares_delegators = live_pool._shares_delegators = True
+                    owned_pools[pool_id] = pool
+                new_strategy.owned_pools = owned_pools
+            agent.new_strategy = new_strategy
+            model.id_seq += num_pool_ids
+
+        for agent_key in agent_keys:
+            self._agents[agent_key].advance()
         self.steps += 1
         self.time += 1
+
+    def get_model_snapshot(self):
+        """
+        @return: the pickled model, without the parts that the agents' decisions don't depend on (which is sent to the
+            worker processes when they start)
+        """
+        model = self.model
+        datacollector, incremental_metrics = model.datacollector, getattr(model, 'incremental_metrics', None)
+        model.datacollector = model.incremental_metrics = None
+        try:
+            return pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+        finally:
+            model.datacollector, model.incremental_metrics = datacollector, incremental_metrics
+
+    def get_step_state(self, agent_keys):
+        """
+        @param agent_keys: the keys of the agents to activate
+        @return: the pickled state of the model that the decisions of the given agents depend on in the current step
+        """
+        model = self.model
+        attribute_names = STEP_STATE_ATTRIBUTES + [
+            name for name in getattr(model, 'multi_phase_params', {}) if name in vars(model)
+        ]
+        state = {
+            'attributes': {name: getattr(model, name) for name in attribute_names},
+            'agents': {
+                agent_key: {
+                    name: value for name, value in vars(self._agents[agent_key]).items()
+                    if name in AGENT_STEP_STATE_ATTRIBUTES
+                }
+                for agent_key in agent_keys
+            }
+        }
+        file = io.BytesIO()
+        ModelPickler(file, model).dump(state)
+        return file.getvalue()
+
+    def evaluate_agent_moves(self, agent_keys):
+        """
+        Activate the given agents in the worker processes, each of which handles a different shard of them.
+        @param agent_keys: the keys of the agents to activate
+        @return: dictionary with the results of the activation for each agent (see evaluate_agent_moves function)
+        """
+        if self.worker_pool is None:
+            self.worker_pool = multiprocessing.Pool(
+                processes=self.num_workers, initializer=initialize_worker, initargs=(self.get_model_snapshot(),)
+            )
+        state_snapshot = self.get_step_state(agent_keys)
+
+        num_shards = min(self.num_workers, len(agent_keys))
+        shard_size, remainder = divmod(len(agent_keys), num_shards)
+        shards = []
+        start = 0
+        for i in range(num_shards):
+            end = start + shard_size + (1 if i < remainder else 0)
+            shards.append(agent_keys[start:end])
+            start = end
+        results = dict()
+        try:
+            all_shard_results = self.worker_pool.starmap(
+                evaluate_agent_moves, [(state_snapshot, shard) for shard in shards]
+            )
+        except BaseException:
+            # don't leave the worker processes behind if the simulation is interrupted
+            self.shutdown(terminate=True)
+            raise
+        for shard_results in all_shard_results:
+            for agent_key, *agent_results in shard_results:
+                results[agent_key] = agent_results
+        return results
+
+    def shutdown(self, terminate=False):
+        """
+        Stop the worker processes (new ones are started if the scheduler is used again).
+        @param terminate: whether to stop the processes immediately, instead of waiting for them to finish their work
+        """
+        if self.worker_pool is not None:
+            if terminate:
+                self.worker_pool.terminate()
+            else:
+                self.worker_pool.close()
+            self.worker_pool.join()
+            self.worker_pool = None
+
+
+class RegretPrioritizedActivation(BaseScheduler):
+    """A scheduler that activates the agents that are most likely to want to change their strategy first.
+    The agents are kept in a priority queue, keyed by an estimate of the utility they could gain by revising their
+    strategy, i.e. by how much their current utility has changed since they were last activated. Whenever an agent
+    makes a move, only the agents that are affected by it (the owners of and delegators to the pools involved in the
+    move) are added to the queue (or have their priority updated). In each step, agents are activated in order of
+    priority (only the agents that were queued before the step, so each agent is activated at most once per step, and
+    the agents that are affected by their moves are activated in the next step). If no agent moves during this
+    process, then all agents are activated (a sweep, in random order) to certify that no one wants to move, which is the
+    only way for a step to count as idle. Early on, when most agents move anyway, the queue doesn't pay off, so sweeps
+    are performed in every step until the fraction of agents that move during a sweep drops below sweep_fraction.
+
+    """
+    def __init__(self, model, sweep_fraction=0.1):
+        super().__init__(model)
+        self.queue = []  # heap of (-priority, estimated_gain, agent_key) tuples
+        self.queued_gains = dict()  # the current priority of the queued agents (other queue entries are outdated)
+        self.last_utilities = dict()  # the utility of each agent right after they were last activated
+        # prioritised activation is used once the fraction of agents that move in a step drops below this value
+        self.sweep_fraction = sweep_fraction
+        self.last_sweep_moves = float('inf')  # the number of agents that moved during the last sweep
+
+    def step(self) -> None:
+        """
+        Activate the agents in the queue in order of priority, then (if none of them moved) all agents.
+        While many agents are still moving, all agents are activated (in random order) in every step instead.
+        """
+        agent_moved = False
+        if self.last_sweep_moves <= self.sweep_fraction * len(self._agents):
+            # only the agents that were queued before the step are activated in it (at most once each), while the
+            # agents that get affected by their moves are activated in the next step
+            queue, self.queue = self.queue, []
+            queued_gains, self.queued_gains = self.queued_gains, dict()
+            while len(queue) > 0:
+                _, estimated_gain, agent_key = heapq.heappop(queue)
+                if queued_gains.get(agent_key) != estimated_gain:
+                    continue  # outdated entry
+                del queued_gains[agent_key]
+                if agent_key in self._agents:
+                    agent_moved = self.activate(agent_key) or agent_moved
+        if not agent_moved:
+            self.sweep()
+        self.steps += 1
+        self.time += 1
+
+    def sweep(self):
+        """
+        Activate all agents in random order.
+        """
+        agent_keys = list(self._agents.keys())
+        self.model.random.shuffle(agent_keys)
+        self.last_sweep_moves = 0
+        for agent_key in agent_keys:
+            if self.activate(agent_key):
+                self.last_sweep_moves += 1
+
+    def activate(self, agent_key):
+        """
+        Activate an agent and (if they make a move) update the queue with the agents that are affected by the move.
+        @param agent_key: the key of the agent to activate
+        @return: True if the agent made a move, False otherwise
+        """
+        self.queued_gains.pop(agent_key, None)  # any queue entries for the agent become outdated
+        agent = self._agents[agent_key]
+        agent.update_strategy()
+        new_strategy = agent.new_strategy
+        agent_moved = new_strategy is not None
+        if agent_moved:
+            pool_ids = set()
+            for strategy in (agent.strategy, new_strategy):
+                pool_ids.update(strategy.owned_pools.keys())
+                pool_ids.update(strategy.stake_allocations.keys())
+            # the delegators of pools that close are removed, so they need to be determined before the move
+            affected_agent_keys = self.get_stakeholders(pool_ids)
+            agent.advance()
+            affected_agent_keys.update(self.get_stakeholders(pool_ids))
+            affected_agent_keys.discard(agent_key)
+            for affected_agent_key in affected_agent_keys:
+                self.prioritize(affected_agent_key)
+        self.last_utilities[agent_key] = self.calculate_current_utility(agent)
+        return agent_moved
+
+    def get_stakeholders(self, pool_ids):
+        """
+        @param pool_ids: the ids of some pools
+        @return: set with the keys of the agents that own the (currently active) pools or delegate to them
+        """
+        pools = self.model.pools
+        stakeholders = set()
+        for pool_id in pool_ids:
+            if pool_id in pools:
+                pool = pools[pool_id]
+                stakeholders.add(pool.owner)
+                stakeholders.update(pool.delegators.keys())
+        return stakeholders
+
+    def prioritize(self, agent_key):
+        """
+        Add an agent to the queue (or update their priority), based on how much their utility has changed since they
+        were last activated.
+        @param agent_key: the key of the agent
+        """
+        if agent_key not in self._agents:
+            return
+        utility = self.calculate_current_utility(self._agents[agent_key])
+        if utility is None:
+            return
+        last_utility = self.last_utilities.get(agent_key)
+        estimated_gain = abs(utility - last_utility) if last_utility is not None else float('inf')
+        if self.queued_gains.get(agent_key, -1) >= estimated_gain:
+            return
+        self.queued_gains[agent_key] = estimated_gain
+        # the agents are ordered randomly but with weights equal to their estimated gains (using the keys of the
+        # Efraimidis-Spirakis weighted sampling method), so that agents with higher gains tend to be activated first,
+        # while deterministic cycles of moves among a few agents are avoided
+        priority = self.model.random.random() ** (1 / estimated_gain) if estimated_gain > 0 else 0
+        heapq.heappush(self.queue, (-priority, estimated_gain, agent_key))
+
+    @staticmethod
+    def calculate_current_utility(agent):
+        # agents without a strategy (e.g. abstainers) never move, so they don't need to be prioritised
+        return agent.calculate_current_utility() if agent.strategy is not None else None
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+from functools import lru_cache
+
+DEFAULT_CACHE_SIZE = 1024
+MAX_ADAPTIVE_CACHE_SIZE = 2 ** 16
+MIN_CALLS_FOR_ADAPTATION = 10000  # number of calls to a cache before deciding whether to resize or disable it
+MIN_HIT_RATE = 0.05  # caches with a lower hit rate only add hashing overhead, so they get disabled
+MAX_EVICTION_RATE = 0.1  # caches that evict more entries than this fraction of their calls (while still getting hits) grow
+
+# all the function caches created with registered_lru_cache, by function name
+CACHE_REGISTRY = {}
+
+
+class VersionedCache:
+    """
+    Bounded (least recently used) cache for values that depend on some versioned state, e.g. the parameters of a
+    reward scheme. The cache remembers the version of the state that its entries were calculated for and drops them all
+    as soon as it's queried with a different version, so stale values are never returned. It also counts hits and
+    misses, to help judge whether caching pays off for a given workload.
+    """
+
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, version, compute):
+        """
+        Retrieve the value that corresponds to the given key, calculating (and storing) it if it's not in the cache.
+        @param key: hashable key of the value (e.g. a tuple with the arguments used to calculate it)
+        @param version: the current version of the state that the value depends on
+        @param compute: function with no arguments that calculates the value on a cache miss
+        @return: the (possibly cached) value
+        """
+        if version != self.version:
+            self.clear()
+            self.version = version
+        entries = self._entries
+        try:
+            value = entries[key]
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            entries[key] = value
+            if len(entries) > self.maxsize:
+                entries.popitem(last=False)
+                self.evictions += 1
+            return value
+        self.hits += 1
+        entries.move_to_end(key)
+        return value
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self):
+        """
+        @return: dictionary with the number of hits, misses and evictions and the current size of the cache
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'size': len(self),
+                'maxsize': self.maxsize}
+
+
+class RegisteredCache:
+    """
+    Entry of the cache registry, which keeps track of an lru_cache-decorated module-level function. Resizing the cache
+    replaces the function in its module with a newly decorated version of the original one (or with the original one
+    itself, if the cache gets disabled), so that calling the function doesn't go through any extra layer.
+    The statistics of the replaced versions are accumulated, so that they are reported for the whole simulation.
+    """
+
+    def __init__(self, function, maxsize):
+        self.function = function
+        self.namespace = function.__globals__
+        self.name = function.__name__
+        self.maxsize = None
+        self._past_stats = None
+        self.resize(maxsize)
+
+    def resize(self, maxsize):
+        """
+        @param maxsize: the new maximum number of entries of the cache (0 disables caching for the function)
+        """
+        self._past_stats = self.get_stats()
+        self.maxsize = maxsize
+        self.namespace[self.name] = lru_cache(maxsize=maxsize)(self.function) if maxsize > 0 else self.function
+
+    def reset(self):
+        self.resize(self.maxsize)
+        self._past_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get_stats(self):
+        """
+        @return: dictionary with the number of hits, misses and evictions and the current size of the cache
+        """
+        stats = dict(self._past_stats) if self._past_stats is not None else {'hits': 0, 'misses': 0, 'evictions': 0}
+        size = 0
+        cached_function = self.namespace.get(self.name)
+        if self.maxsize and hasattr(cached_function, 'cache_info'):
+            cache_info = cached_function.cache_info()
+            size = cache_info.currsize
+            stats['hits'] += cache_info.hits
+            stats['misses'] += cache_info.misses
+            # every miss adds an entry to the cache, so the ones that are not there anymore have been evicted
+            stats['evictions'] += cache_info.misses - cache_info.currsize
+        stats.update(size=size, maxsize=self.maxsize)
+        return stats
+
+
+def registered_lru_cache(maxsize=DEFAULT_CACHE_SIZE):
+    """
+    Drop-in replacement for functools.lru_cache for module-level functions, which also adds the cache to the registry,
+    so that its statistics can be reported and its size can be adjusted.
+    """
+    def decorator(function):
+        entry = RegisteredCache(function, maxsize)
+        CACHE_REGISTRY[entry.name] = entry
+        return entry.namespace[entry.name]
+    return decorator
+
+
+def get_cache_stats():
+    """
+    @return: dictionary with the statistics of every registered cache (see RegisteredCache.get_stats), by function name
+    """
+    return {name: entry.get_stats() for name, entry in CACHE_REGISTRY.items()}
+
+
+def set_cache_size(maxsize):
+    """
+    Set the size of all registered caches and reset their statistics.
+    @param maxsize: the maximum number of entries of each cache (0 disables caching)
+    """
+    for entry in CACHE_REGISTRY.values():
+        entry.maxsize = maxsize
+        entry.reset()
+
+
+def adapt_cache_sizes():
+    """
+    Adjust the size of the registered caches based on their usage since they were last adjusted: caches that are rarely
+    hit get disabled and caches that are hit but keep evicting entries are doubled in size.
+    """
+    for entry in CACHE_REGISTRY.values():
+        if entry.maxsize == 0:
+            continue
+        cache_info = entry.namespace[entry.name].cache_info()
+        calls = cache_info.hits + cache_info.misses
+        if calls < MIN_CALLS_FOR_ADAPTATION:
+            continue
+        if cache_info.hits < MIN_HIT_RATE * calls:
+            entry.resize(0)
+        elif cache_info.misses - cache_info.currsize > MAX_EVICTION_RATE * calls and \
+                entry.maxsize < MAX_ADAPTIVE_CACHE_SIZE:
+            entry.resize(min(2 * entry.maxsize, MAX_ADAPTIVE_CACHE_SIZE))
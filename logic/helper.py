@@ -3,18 +3,23 @@ from numpy.random import default_rng
 import numpy as np
 from scipy import stats
 import csv
+import hashlib
+import heapq
+import io
+import os
 import pathlib
 from math import floor, log10, fsum
-from functools import lru_cache
 import json
 import matplotlib.pyplot as plt
 from matplotlib import ticker
 import seaborn as sns
 import argparse
 
+from logic.caching import registered_lru_cache
 from logic.stakeholder_profiles import PROFILE_MAPPING
 from logic.reward_schemes import RSS_MAPPING
 from logic.model_reporters import REPORTER_IDS
+from logic.metrics import COLLECTION_POLICIES
 from logic.reward_schemes import TOTAL_EPOCH_REWARDS_R
 
 sns.set_theme()
@@ -23,25 +28,29 @@ sns.set_theme()
 MIN_STAKE_UNIT = 2.2e-17
 
 
-def read_stake_distr_from_file(num_agents=10000, seed=42):
-    default_filename = 'synthetic-stake-distribution-10000-agents.csv'
-    filename = 'synthetic-stake-distribution-' + str(num_agents) + '-agents.csv'
-    stk_dstr = []
+STAKE_DISTR_CACHE_DIR = '.stake-distr-cache'
+
+
+def read_stake_distr_from_file(num_agents=10000, seed=42, filename=None):
+    """
+    Read the stake distribution of the agents from a csv file, sampling from it if the file contains a different number
+    of values than the number of agents.
+    @param num_agents: the number of agents of the simulation
+    @param seed: the seed used for sampling from the values of the file
+    @param filename: the csv file to read the values from (if None, then synthetic-stake-distribution-X-agents.csv is
+        used, where X is the number of agents, and if it doesn't exist then the one for 10000 agents)
+    @return: numpy array with the stake values of the agents
+    """
+    if filename is None:
+        filename = 'synthetic-stake-distribution-' + str(num_agents) + '-agents.csv'
+        if not pathlib.Path(filename).exists():
+            filename = 'synthetic-stake-distribution-10000-agents.csv'
     try:
-        with open(filename) as file:
-            reader = csv.reader(file)
-            for row in reader:
-                stk_dstr.append(float(row[0]))
+        stk_dstr = load_stake_distr_array(filename)
     except FileNotFoundError:
-        try:
-            with open(default_filename) as file:
-                reader = csv.reader(file)
-                for row in reader:
-                    stk_dstr.append(float(row[0]))
-        except FileNotFoundError:
-            print("Couldn't find file to read stake distribution from. Please make sure that the file exists or "
-                  "use another option for the stake distribution source.")
-            raise
+        print("Couldn't find file to read stake distribution from. Please make sure that the file exists or "
+              "use another option for the stake distribution source.")
+        raise
     if num_agents == len(stk_dstr):
         return stk_dstr
     rng = default_rng(seed=int(seed))
@@ -50,6 +59,63 @@ def read_stake_distr_from_file(num_agents=10000, seed=42):
     return rng.choice(stk_dstr, num_agents, replace=True)
 
 
+def load_stake_distr_array(filename):
+    """
+    Load the stake values of a csv file (the first value of each row) as a memory-mapped numpy array.
+    The first time that a file is loaded, its values are converted to the binary .npy format and stored in a cache
+    directory next to it, under a name that includes the hash of the file's contents, so that subsequent loads (e.g. in
+    batch runs) skip parsing the csv file altogether and pick up any changes to it. The hash is only calculated again
+    when the size or modification time of the file change.
+    @param filename: the path of the csv file
+    @return: numpy array with the stake values, backed by the cached .npy file (copy-on-write, so changing the values
+        of the array doesn't affect the file)
+    """
+    csv_path = pathlib.Path(filename)
+    file_stat = csv_path.stat()
+    cache_dir = csv_path.parent / STAKE_DISTR_CACHE_DIR
+    index_path = cache_dir / (csv_path.stem + '.json')
+    file_key = {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns}
+    try:
+        with open(index_path) as file:
+            index = json.load(file)
+    except (OSError, ValueError):
+        index = {}
+    if index.get('key') == file_key:
+        file_hash = index['hash']
+    else:
+        hash_obj = hashlib.sha256()
+        with open(csv_path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                hash_obj.update(chunk)
+        file_hash = hash_obj.hexdigest()[:16]
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        write_atomically(index_path, json.dumps({'key': file_key, 'hash': file_hash}).encode())
+    npy_path = cache_dir / (csv_path.stem + '-' + file_hash + '.npy')
+    if not npy_path.exists():
+        stk_dstr = []
+        with open(csv_path) as file:
+            reader = csv.reader(file)
+            for row in reader:
+                stk_dstr.append(float(row[0]))
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        with io.BytesIO() as buffer:
+            np.save(buffer, np.array(stk_dstr, dtype=float))
+            write_atomically(npy_path, buffer.getvalue())
+    return np.load(npy_path, mmap_mode='c')
+
+
+def write_atomically(path, data):
+    """
+    Write some data to a file through a temporary file, so that concurrent runs never read a partially written file.
+    @param path: the path of the file
+    @param data: the bytes to write
+    """
+    tmp_path = path.with_name(path.name + '.' + str(os.getpid()) + '.tmp')
+    with open(tmp_path, 'wb') as file:
+        file.write(data)
+    os.replace(tmp_path, path)
+
+
 def generate_stake_distr_disparity(n, x=0.3, c=3):
     stk_dstr = []
     high_end_stake = x / c
@@ -81,22 +147,58 @@ def generate_stake_distr_pareto(num_agents, pareto_param=2, seed=156, truncation
     rng = default_rng(seed=int(seed))
     # Sample from a Pareto distribution with the specified shape
     a, m = pareto_param, 1.  # shape and mode
-    stake_sample = list((rng.pareto(a, num_agents) + 1) * m)
+    stake_sample = (rng.pareto(a, num_agents) + 1) * m
     if truncation_factor > 0:
-        stake_sample = truncate_pareto(rng, (a, m), stake_sample, truncation_factor)
-    return stake_sample
+        return truncate_pareto(rng, (a, m), stake_sample, truncation_factor)
+    return list(stake_sample)
 
 
 def truncate_pareto(rng, pareto_params, sample, truncation_factor):
+    """
+    Truncate a Pareto sample with rejection sampling: as long as the largest value is more than 1 / truncation_factor of
+    the total, it is removed and a new value is drawn (and appended to the end of the sample).
+    Instead of going through the whole sample for every rejection, the original values are sorted once and the new ones
+    are kept in a heap, while the total is updated incrementally (using compensated summation), so each rejection takes
+    logarithmic time. New values are drawn in batches, which yields the same values as drawing them one by one.
+    :param rng: the random number generator that the sample was drawn from
+    :param pareto_params: tuple with the shape and mode of the Pareto distribution
+    :param sample: the values drawn from the distribution
+    :param truncation_factor: the number that the total is divided by to get the highest value allowed in the sample
+    :return: list with the truncated sample
+    """
     a, m = pareto_params
+    sample = np.asarray(sample, dtype=float)
+    # positions of the original values from largest to smallest (ties in order of appearance, like list.remove)
+    order = np.lexsort((np.arange(len(sample)), -sample))
+    removed = np.zeros(len(sample), dtype=bool)
+    next_largest = 0
+    new_values = []
+    new_values_heap = []  # (-value, position in new_values) for the new values that haven't been removed
+    batch_size = max(16, len(sample) // 100)
+    total, compensation = fsum(sample), 0.
     while 1:
         # rejection sampling to ensure that the distribution is truncated
-        max_value = max(sample)
-        if max_value > sum(sample) / truncation_factor:
-            sample.remove(max_value)
-            sample.append((rng.pareto(a) + 1) * m)
+        original_max = sample[order[next_largest]] if next_largest < len(order) else -np.inf
+        new_max = -new_values_heap[0][0] if new_values_heap else -np.inf
+        max_value = max(original_max, new_max)
+        if max_value <= (total + compensation) / truncation_factor:
+            break
+        if original_max >= new_max:
+            removed[order[next_largest]] = True
+            next_largest += 1
         else:
-            return sample
+            heapq.heappop(new_values_heap)
+        if len(new_values) % batch_size == 0:
+            batch = ((rng.pareto(a, batch_size) + 1) * m).tolist()
+        new_value = batch[len(new_values) % batch_size]
+        heapq.heappush(new_values_heap, (-new_value, len(new_values)))
+        new_values.append(new_value)
+        for x in (-max_value, new_value):
+            t = total + x
+            compensation += (total - t) + x if abs(total) >= abs(x) else (x - t) + total
+            total = t
+    kept_new_positions = sorted(position for _, position in new_values_heap)
+    return sample[~removed].tolist() + [new_values[position] for position in kept_new_positions]
 
 
 def generate_stake_distr_flat(num_agents):
@@ -154,21 +256,43 @@ def generate_cost_distr_nrm(num_agents, low, high, mean, stddev):
     return costs
 
 
-# @lru_cache(maxsize=1024)
 def calculate_potential_profit(reward_scheme, pledge, cost):
     """
     Calculate a pool's potential profit, which can be defined as the profit it would get at saturation level
+    Note that the result is cached in the reward scheme object (which can't be used as a key for lru_cache, as its
+    parameters may change during the simulation) and reused as long as the parameters of the reward scheme stay the same
     :param reward_scheme: the reward scheme object (of an RSS subclass) used in the simulation
     :param pledge: the pledge of the pool in question
     :param cost: the cost of the pool in question
     :return: float, the maximum possible profit that this pool can yield, aka its profit at saturation
     """
+    return reward_scheme.potential_profit_cache.get(
+        (pledge, cost), reward_scheme.param_version, lambda: _calculate_potential_profit(reward_scheme, pledge, cost)
+    )
+
+
+def _calculate_potential_profit(reward_scheme, pledge, cost):
     potential_reward = calculate_pool_reward(
-        reward_scheme=reward_scheme, pool_stake=reward_scheme.get_pool_saturation_threshold(pledge), pool_pledge=pledge
+        reward_scheme=reward_scheme, pool_stake=reward_scheme.get_cached_pool_saturation_threshold(pledge),
+        pool_pledge=pledge
     )
     return potential_reward - cost
 
 
+def calculate_potential_profits(reward_scheme, pledges, costs):
+    """
+    Vectorised version of calculate_potential_profit, which works element-wise on numpy arrays
+    :param reward_scheme: the reward scheme object (of an RSS subclass) used in the simulation
+    :param pledges: array with the pledges of the pools in question
+    :param costs: array with the costs of the pools in question
+    :return: numpy array with the potential profits of the pools
+    """
+    potential_rewards = reward_scheme.calculate_pool_rewards(
+        pool_pledges=pledges, pool_stakes=reward_scheme.get_pool_saturation_thresholds(pledges)
+    )
+    return potential_rewards - costs
+
+
 # @lru_cache(maxsize=1024)
 def calculate_current_profit(stake, pledge, cost, reward_scheme):
     reward = calculate_pool_reward(reward_scheme=reward_scheme, pool_stake=stake, pool_pledge=pledge)
@@ -179,7 +303,7 @@ def calculate_pool_reward(reward_scheme, pool_stake, pool_pledge):
     return reward_scheme.calculate_pool_reward(pool_pledge=pool_pledge, pool_stake=pool_stake)
 
 
-@lru_cache(maxsize=1024)
+@registered_lru_cache()
 def calculate_delegator_reward_from_pool(pool_margin, pool_cost, pool_reward, delegator_stake_fraction):
     margin_factor = (1 - pool_margin) * delegator_stake_fraction
     pool_profit = pool_reward - pool_cost
@@ -187,31 +311,45 @@ def calculate_delegator_reward_from_pool(pool_margin, pool_cost, pool_reward, de
     return r_d
 
 
-@lru_cache(maxsize=1024)
+@registered_lru_cache()
 def calculate_operator_reward_from_pool(pool_margin, pool_cost, pool_reward, operator_stake_fraction):
     margin_factor = pool_margin + ((1 - pool_margin) * operator_stake_fraction)
     pool_profit = pool_reward - pool_cost
     return pool_profit if pool_profit <= 0 else pool_profit * margin_factor
 
 
+def calculate_operator_rewards_from_pools(pool_margins, pool_costs, pool_rewards, operator_stake_fractions):
+    """
+    Vectorised version of calculate_operator_reward_from_pool, which works element-wise on numpy arrays
+    (with broadcasting)
+    """
+    margin_factors = pool_margins + ((1 - pool_margins) * operator_stake_fractions)
+    pool_profits = pool_rewards - pool_costs
+    return np.where(pool_profits <= 0, pool_profits, pool_profits * margin_factors)
+
+
 def calculate_non_myopic_pool_stake(pool, pool_rankings, reward_scheme, total_stake):
     """
     Calculate the non-myopic stake of a pool, given the pool and the state of the system (other active pools)
     :param pool:
-    :param pool_rankings:
+    :param pool_rankings: the pools of the system ranked from best to worst (a PoolRankings object or a sorted list)
     :param reward_scheme: the reward scheme object used in the simulation
     :total_stake: the total stake of the system
     :return: the value of the non-myopic stake of the pool with id pool_id
     """
     rank = pool_rankings.index(pool)
-    better_pools_stake_at_saturation = fsum(
-        [reward_scheme.get_pool_saturation_threshold(p.pledge) for p in pool_rankings[:rank]])
+    if hasattr(pool_rankings, 'cumulative_saturation_stake'):
+        # the rankings keep track of cumulative saturation thresholds, so there is no need to go through all better pools
+        better_pools_stake_at_saturation = pool_rankings.cumulative_saturation_stake(rank)
+    else:
+        better_pools_stake_at_saturation = fsum(
+            [reward_scheme.get_pool_saturation_threshold(p.pledge) for p in pool_rankings[:rank]])
     # check whether the higher-ranked pools suffice to cover the system's total stake without getting over-saturated
     rank_in_top_pools = better_pools_stake_at_saturation + MIN_STAKE_UNIT < total_stake
     return calculate_non_myopic_pool_stake_from_rank(
         pool_pledge=pool.pledge,
         pool_stake=pool.stake,
-        pool_saturation_threshold=reward_scheme.get_pool_saturation_threshold(pool.pledge),
+        pool_saturation_threshold=reward_scheme.get_cached_pool_saturation_threshold(pool.pledge),
         rank_in_top_pools=rank_in_top_pools
     )
 
@@ -250,7 +388,7 @@ def generate_execution_id(args_dict):
                      for key, value in list(args_dict.items())[:num_args_to_use]])[:max_characters]
 
 
-@lru_cache(maxsize=1024)
+@registered_lru_cache()
 def calculate_cost_per_pool(num_pools, initial_cost, extra_pool_cost_fraction):
     """
     Calculate the average cost of an agent's pools, assuming that any additional pool costs less than the first one
@@ -263,18 +401,29 @@ def calculate_cost_per_pool(num_pools, initial_cost, extra_pool_cost_fraction):
     return (initial_cost + (num_pools - 1) * extra_pool_cost_fraction * initial_cost) / num_pools
 
 
-@lru_cache(maxsize=1024)
+@registered_lru_cache()
 def calculate_suitable_margin(potential_profit, target_desirability):
     m = 1 - target_desirability / potential_profit if potential_profit > 0 else 0
     return max(m, 0)
 
 
-@lru_cache(maxsize=1024)
+def calculate_suitable_margins(potential_profits, target_desirabilities):
+    """
+    Vectorised version of calculate_suitable_margin, which works element-wise on numpy arrays (with broadcasting)
+    """
+    positive_profits = potential_profits > 0
+    # the profits that are not positive are replaced by 1 only to avoid dividing by zero, their ratios are not used
+    ratios = target_desirabilities / np.where(positive_profits, potential_profits, 1)
+    m = np.where(positive_profits, 1 - ratios, 0)
+    return np.maximum(m, 0)
+
+
+@registered_lru_cache()
 def calculate_pool_desirability(margin, potential_profit):
     return max((1 - margin) * potential_profit, 0)
 
 
-@lru_cache(maxsize=1024)
+@registered_lru_cache()
 def calculate_myopic_pool_desirability(margin, current_profit):
     return max((1 - margin) * current_profit, 0)
 
@@ -295,12 +444,12 @@ def calculate_delegator_utility_from_pool(stake_allocation, pool_stake, pledge,
                                                 delegator_stake_fraction=stake_fraction)
 
 
-@lru_cache(maxsize=1024)
+@registered_lru_cache()
 def calculate_non_myopic_pool_stake_from_rank(pool_pledge, pool_stake, pool_saturation_threshold, rank_in_top_pools):
     return max(pool_saturation_threshold, pool_stake) if rank_in_top_pools else pool_pledge
 
 
-@lru_cache(maxsize=1024)
+@registered_lru_cache()
 def calculate_pledge_per_pool(agent_stake, global_saturation_threshold, num_pools):
     """
     The agents choose to allocate their entire stake as the pledge of their pools,
@@ -363,19 +512,27 @@ def write_to_csv(filepath, header, row):
 
 
 def plot_line(data, execution_id, color, x_label, y_label, filename, equilibrium_steps, pivot_steps,
-              path, title='', show_equilibrium=False):
+              path, title='', show_equilibrium=False, steps=None):
+    """
+    @param steps: the steps that the values of data correspond to, in increasing order (by default, data holds a value
+        for every step, starting from 0)
+    """
     equilibrium_colour = 'mediumseagreen'
     pivot_colour = 'gold'
 
+    steps = np.arange(len(data)) if steps is None else np.asarray(steps)
     fig = plt.figure(figsize=(10, 5))
-    data.plot(color=color)
+    plt.plot(steps, data, color=color)
     if show_equilibrium:
         for i, step in enumerate(equilibrium_steps):
             label = "Equilibrium reached" if i == 0 else ""
             plt.axvline(x=step, label=label, c=equilibrium_colour)
     for i, step in enumerate(pivot_steps):
         label = "Parameter change" if i == 0 else ""
-        plt.plot(step, data[step], 'x', label=label, c=pivot_colour)
+        # if the metrics were not collected at the step of the change, mark the last value that was collected before it
+        position = np.searchsorted(steps, step, side='right') - 1
+        if position >= 0:
+            plt.plot(step, data[position], 'x', label=label, c=pivot_colour)
     plt.title(title)
     plt.xlabel(x_label)
     plt.ylabel(y_label)
@@ -385,11 +542,15 @@ def plot_line(data, execution_id, color, x_label, y_label, filename, equilibrium
     plt.close(fig)
 
 
-def plot_stack_area_chart(pool_sizes_by_step, execution_id, path):
+def plot_stack_area_chart(pool_sizes_by_step, execution_id, path, steps=None):
+    """
+    @param steps: the steps that the entries of pool_sizes_by_step correspond to (by default, every step from 0 on)
+    """
     pool_sizes_by_agent = np.array(list(pool_sizes_by_step)).T
+    steps = range(len(pool_sizes_by_step)) if steps is None else steps
     fig = plt.figure(figsize=(10, 5))
     col = sns.color_palette("hls", 77)
-    plt.stackplot(range(1, len(pool_sizes_by_step)), pool_sizes_by_agent[:, 1:], colors=col, edgecolor='black', lw=0.1)
+    plt.stackplot(steps[1:], pool_sizes_by_agent[:, 1:], colors=col, edgecolor='black', lw=0.1)
     plt.xlim(xmin=0.0)
     plt.xlabel("Round")
     plt.ylabel("Stake per Operator")
@@ -561,9 +722,27 @@ def add_script_arguments(parser):
                         help='The factor that determines how much an additional pool costs as a fraction of '
                              'the original cost value of the stakeholder. Default is 40%%.')
     parser.add_argument('--agent_activation_order', nargs="?", type=str.lower, default='random',
-                        choices=['random', 'sequential', 'simultaneous', 'semisimultaneous'],
+                        choices=['random', 'sequential', 'simultaneous', 'semisimultaneous', 'parallelsimultaneous',
+                                 'regret'],
                         help='The order with which agents are activated. Default is "Random". Other options are '
-                             '"Sequential" and "Semisimultaneous".')
+                             '"Sequential", "Simultaneous", "Semisimultaneous", "Parallelsimultaneous" and "Regret".')
+    parser.add_argument('--simultaneous_moves', nargs="?", type=positive_int, default=5,
+                        help='The number of agents that are activated at the same time when the activation order is '
+                             '"Semisimultaneous". Default is 5.')
+    parser.add_argument('--adaptive_simultaneous_moves', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='If True then the number of agents that are activated at the same time (when the '
+                             'activation order is "Semisimultaneous") grows as fewer agents move in each step. '
+                             'Default is False.')
+    parser.add_argument('--num_workers', nargs="?", type=positive_int, default=None,
+                        help='The number of processes that evaluate the moves of the agents when the activation order '
+                             'is "Parallelsimultaneous". Default is None, i.e. one process per CPU.')
+    parser.add_argument('--cache_size', nargs="?", type=non_negative_int, default=1024,
+                        help='The maximum number of entries of each cache of the simulation (0 disables caching). '
+                             'Default is 1024.')
+    parser.add_argument('--adaptive_cache_size', type=bool, default=False, action=argparse.BooleanOptionalAction,
+                        help='If True then caches that are rarely hit get disabled and caches that keep evicting entries '
+                             'grow during the simulation. Default is False.')
     parser.add_argument('--absolute_utility_threshold', nargs="?", type=non_negative_float, default=1e-9,
                         help='The utility threshold under which moves are disregarded. Default is 1e-9.')
     parser.add_argument('--relative_utility_threshold', nargs="?", type=non_negative_float, default=0,
@@ -589,6 +768,22 @@ def add_script_arguments(parser):
     parser.add_argument('--metrics', nargs="+", type=int, default=None, choices=range(1, len(REPORTER_IDS) + 1),
                         help='The list of ids that correspond to metrics that are tracked during the simulation. Default'
                              'is [1, 2, 3, 4, 6, 17, 18, 26, 27]')
+    parser.add_argument('--collection_policy', nargs="?", type=str.lower, default='every_step',
+                        choices=COLLECTION_POLICIES,
+                        help='The steps at which the metrics are collected: "every_step", "every_n_steps" (see '
+                             'collection_period), "on_change" (only steps where the state of the simulation changed) '
+                             'or "final" (only the final state). Default is "every_step".')
+    parser.add_argument('--collection_period', nargs="?", type=positive_int, default=1,
+                        help='The number of steps between two collections of the metrics, when the collection policy '
+                             'is "every_n_steps". Default is 1.')
+    parser.add_argument('--exact_pool_count_search', type=bool, default=False,
+                        action=argparse.BooleanOptionalAction,
+                        help='If True then agents choose the number of pools that maximises their utility '
+                             'overall, instead of stopping at the first local maximum that the binary search finds. '
+                             'Default is False.')
+    parser.add_argument('--min_aggregate_pledge_tolerance', nargs="?", type=non_negative_float, default=0,
+                        help='The maximum amount by which the reported min-aggregate pledge may exceed the true minimum, '
+                             'which makes its calculation faster. Default is 0, i.e. the exact minimum.')
     parser.add_argument('--generate_graphs', type=bool, default=True, action=argparse.BooleanOptionalAction,
                         help='If True then graphs relating to the tracked metrics are generated upon completion. Default'
                              'is True.'),
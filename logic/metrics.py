@@ -0,0 +1,652 @@
+# -*- coding: utf-8 -*-
+import csv
+import numbers
+from fractions import Fraction
+from functools import cached_property
+from math import fsum
+
+import numpy as np
+from sortedcontainers import SortedList
+
+DEFAULT_CHUNK_SIZE = 100  # number of collected rows that are written to the metrics file at once
+INITIAL_CAPACITY = 256  # number of rows that the columns can hold before they need to grow
+# the steps at which the metrics of a simulation can be collected: every step, every n steps, only steps where the state of
+# the simulation has changed or only the final step (the final state of the simulation is always included)
+COLLECTION_POLICIES = ['every_step', 'every_n_steps', 'on_change', 'final']
+EXACT_SUM_EXPONENT = 1074  # every float is an integer multiple of 2 ** -1074 (the smallest subnormal number)
+
+
+def is_integer_value(value):
+    return isinstance(value, numbers.Integral) and not isinstance(value, (bool, np.bool_))
+
+
+def is_real_value(value):
+    return isinstance(value, numbers.Real) and not isinstance(value, (bool, np.bool_))
+
+
+class ExactSum:
+    """
+    Running sum of floats that supports both adding and subtracting values without accumulating any rounding errors.
+    Every float is an integer multiple of 2 ** -1074, so the sum is kept as an (arbitrary precision) integer number of
+    such units, and it is only rounded when its value is requested. The value is therefore the correctly rounded sum of
+    the values that are currently included, i.e. the same as the result of math.fsum on them.
+    """
+
+    def __init__(self):
+        self._units = 0
+
+    @staticmethod
+    def _to_units(value):
+        numerator, denominator = float(value).as_integer_ratio()
+        # the denominator is a power of 2 that doesn't exceed 2 ** 1074
+        return numerator << (EXACT_SUM_EXPONENT + 1 - denominator.bit_length())
+
+    def add(self, value):
+        self._units += self._to_units(value)
+
+    def subtract(self, value):
+        self._units -= self._to_units(value)
+
+    @property
+    def value(self):
+        # integer division is correctly rounded in python
+        return self._units / (1 << EXACT_SUM_EXPONENT)
+
+
+def to_exact_integers(values):
+    """
+    Scale floats to integers without losing any precision, by expressing all of them in units of the smallest power of
+    2 that they are a multiple of. Sums and comparisons of the resulting integers are therefore exact, and they are
+    consistent with the original values.
+    @param values: iterable of (finite) real numbers
+    @return: list with the integer that corresponds to each value
+    """
+    ratios = [float(value).as_integer_ratio() for value in values]
+    # all denominators are powers of 2, so they divide the largest one
+    denominator = max((denominator for numerator, denominator in ratios), default=1)
+    return [numerator * (denominator // value_denominator) for numerator, value_denominator in ratios]
+
+
+def solve_knapsack(values, weights, capacity, tolerance=0):
+    """
+    Solve a 0/1 knapsack problem exactly, i.e. find the items with the maximum total value whose total weight doesn't
+    exceed the given capacity. The items are sorted in descending order of value per unit of weight and the problem is
+    solved with branch and bound, starting from the greedy (break) solution and only deciding on the items around the
+    item that didn't fit in it (adding the next items while there is spare capacity, removing the previous ones while
+    the capacity is exceeded), as in Pisinger's expanding core algorithm. The items that are far from the break item
+    rarely change, so most of them never need to be considered, and subproblems are pruned when their (Dembo-Hammer)
+    upper bound doesn't exceed the best value found so far. Identical items are interchangeable, so only one of their
+    combinations with the same number of chosen items is explored. All calculations are done with integers, so there
+    are no rounding errors involved.
+    @param values: list with the (non-negative integer) value of each item
+    @param weights: list with the (non-negative integer) weight of each item
+    @param capacity: the (non-negative integer) capacity of the knapsack
+    @param tolerance: the (non-negative integer) amount by which the value of the solution may fall short of the
+        optimal one. With no tolerance the solution is optimal, but proving it can take exponential time when there are
+        many small items that can be combined to fill the capacity almost exactly.
+    @return: tuple with the sorted indices of the chosen items and their total value
+    """
+    # items without weight can always be chosen, so only the rest need to be considered
+    free_items = [i for i, weight in enumerate(weights) if weight == 0]
+    order = sorted((i for i, weight in enumerate(weights) if weight > 0),
+                   key=lambda i: (Fraction(values[i], weights[i]), weights[i]), reverse=True)
+    item_values = [values[i] for i in order]
+    item_weights = [weights[i] for i in order]
+    num_items = len(order)
+    # the first and last (exclusive) position of the identical items that each item belongs to
+    items = list(zip(item_values, item_weights))
+    group_starts, group_ends = [0] * num_items, [num_items] * num_items
+    for position in range(1, num_items):
+        group_starts[position] = group_starts[position - 1] if items[position] == items[position - 1] else position
+    for position in range(num_items - 2, -1, -1):
+        group_ends[position] = group_ends[position + 1] if items[position] == items[position + 1] else position + 1
+
+    break_position, weight, value = 0, 0, 0
+    while break_position < num_items and weight + item_weights[break_position] <= capacity:
+        weight += item_weights[break_position]
+        value += item_values[break_position]
+        break_position += 1
+
+    best_value = -1
+    best_changes = None
+    # each subproblem consists of the position of the next item that may be removed from the break solution, the
+    # position of the next item that may be added to it, the weight and value of the current solution and the items that
+    # have been added or removed to get it (as a linked list of tuples, so that subproblems can share it)
+    stack = [(break_position - 1, break_position, weight, value, None)]
+    # the highest value of the solutions explored so far for each subproblem, as subproblems that are reached from
+    # different branches (e.g. by exchanging items of the same weight) share the same remaining choices
+    explored_values = dict()
+    while stack:
+        removal_position, addition_position, weight, value, changes = stack.pop()
+        key = (removal_position, addition_position, weight)
+        if explored_values.get(key, -1) >= value:
+            continue
+        explored_values[key] = value
+        if weight <= capacity:
+            if value > best_value:
+                best_value = value
+                best_changes = changes
+            if addition_position == num_items:
+                continue
+            # the remaining capacity can at best be filled with items as valuable (per unit of weight) as the next one
+            # (the bound is compared here without dividing by the weight of the item)
+            if (value - best_value - tolerance) * item_weights[addition_position] + \
+                    (capacity - weight) * item_values[addition_position] <= 0:
+                continue
+            # either the item is not added (and neither are the identical ones that follow it) or it is added
+            stack.append((removal_position, group_ends[addition_position], weight, value, changes))
+            stack.append((removal_position, addition_position + 1, weight + item_weights[addition_position],
+                          value + item_values[addition_position], (addition_position, changes)))
+        else:
+            if removal_position < 0:
+                continue
+            # the excess weight must be removed, at the cost of items at least as valuable as the next one
+            if (value - best_value - tolerance) * item_weights[removal_position] - \
+                    (weight - capacity) * item_values[removal_position] <= 0:
+                continue
+            # either the item is kept (and so are the identical ones that precede it) or it is removed
+            stack.append((group_starts[removal_position] - 1, addition_position, weight, value, changes))
+            stack.append((removal_position - 1, addition_position, weight - item_weights[removal_position],
+                          value - item_values[removal_position], (removal_position, changes)))
+
+    chosen_positions = set(range(break_position))
+    while best_changes is not None:
+        position, best_changes = best_changes
+        chosen_positions ^= {position}
+    chosen_items = sorted(free_items + [order[position] for position in chosen_positions])
+    return chosen_items, best_value + sum(values[i] for i in free_items)
+
+
+class IncrementalMetrics:
+    """
+    Aggregates of the pools of a simulation that are maintained incrementally, as pools are opened, closed or updated and
+    as the delegations to them change, instead of being recalculated from scratch at every step. The simulation notifies
+    the engine of every such change (see add_pool, remove_pool and update_pool) and reading any of the maintained
+    metrics then takes constant or logarithmic time.
+    Totals are kept as exact sums (so they are equal to the sums calculated with fsum) and the stake that each operator
+    controls is also kept in a sorted list, from which the Nakamoto coefficient is calculated by only going through
+    the top operators (and only when something has changed since it was last calculated).
+    """
+
+    def __init__(self):
+        self._pools = dict()  # the owner, pledge and stake of every pool, as they were when the engine last saw the pool
+        self._total_pledge = ExactSum()
+        self._total_stake = ExactSum()
+        self._pools_per_operator = dict()
+        self._sorted_pools_per_operator = SortedList()
+        self._pool_splitter_count = 0
+        self._operator_stake_sums = dict()
+        self._operator_stakes = dict()  # the (rounded) value of the stake sum of each operator
+        self._sorted_operator_stakes = SortedList()
+        self._total_operator_stake = ExactSum()
+        self._nakamoto_coefficient = None
+
+    @property
+    def pool_count(self):
+        return len(self._pools)
+
+    @property
+    def operator_count(self):
+        return len(self._pools_per_operator)
+
+    @property
+    def total_pledge(self):
+        return self._total_pledge.value
+
+    @property
+    def total_stake(self):
+        return self._total_stake.value
+
+    @property
+    def max_pools_per_operator(self):
+        return self._sorted_pools_per_operator[-1] if self.operator_count > 0 else 0
+
+    @property
+    def median_pools_per_operator(self):
+        sorted_counts = self._sorted_pools_per_operator
+        middle = len(sorted_counts) // 2
+        if len(sorted_counts) % 2 == 1:
+            return sorted_counts[middle]
+        return (sorted_counts[middle - 1] + sorted_counts[middle]) / 2
+
+    @property
+    def pool_splitter_count(self):
+        return self._pool_splitter_count
+
+    def get_operator_stake(self, operator):
+        """
+        @param operator: the id of an agent
+        @return: the stake that the agent controls through its pools
+        """
+        return self._operator_stakes.get(operator, 0)
+
+    @property
+    def nakamoto_coefficient(self):
+        """
+        The minimum number of operators that control more than half of the stake of all pools (0 if there are no pools).
+        """
+        if self._nakamoto_coefficient is None:
+            self._nakamoto_coefficient = self._calculate_nakamoto_coefficient()
+        return self._nakamoto_coefficient
+
+    def _calculate_nakamoto_coefficient(self):
+        if self.pool_count == 0:
+            return 0
+        majority_threshold = self._total_operator_stake.value / 2
+        controlled_stake = ExactSum()
+        for count, stake in enumerate(reversed(self._sorted_operator_stakes), start=1):
+            controlled_stake.add(stake)
+            if controlled_stake.value > majority_threshold:
+                return count
+        return 1
+
+    def add_pool(self, pool):
+        """
+        Include a (newly opened) pool in the metrics.
+        """
+        owner, pledge, stake = pool.owner, pool.pledge, pool.stake
+        self._pools[pool.id] = owner, pledge, stake
+        self._total_pledge.add(pledge)
+        self._total_stake.add(stake)
+        self._change_pool_count(owner, 1)
+        self._change_operator_stake(owner, stake, 1)
+
+    def remove_pool(self, pool):
+        """
+        Exclude a (closing) pool from the metrics, as it was when it was last added or updated.
+        """
+        owner, pledge, stake = self._pools.pop(pool.id)
+        self._total_pledge.subtract(pledge)
+        self._total_stake.subtract(stake)
+        self._change_pool_count(owner, -1)
+        self._change_operator_stake(owner, stake, -1)
+
+    def update_pool(self, pool):
+        """
+        Reflect the changes of a pool (e.g. in its pledge or in the stake delegated to it) in the metrics.
+        The pool may also be a new version of a pool that the metrics already include, as long as it has the same id.
+        """
+        self.remove_pool(pool)
+        self.add_pool(pool)
+
+    def _change_pool_count(self, owner, change):
+        sorted_counts = self._sorted_pools_per_operator
+        old_count = self._pools_per_operator.get(owner, 0)
+        new_count = old_count + change
+        if old_count > 0:
+            sorted_counts.remove(old_count)
+        if new_count > 0:
+            sorted_counts.add(new_count)
+            self._pools_per_operator[owner] = new_count
+        else:
+            self._pools_per_operator.pop(owner)
+        self._pool_splitter_count += (new_count > 1) - (old_count > 1)
+
+    def _change_operator_stake(self, owner, stake, sign):
+        stake_sum = self._operator_stake_sums.get(owner)
+        if stake_sum is None:
+            stake_sum = self._operator_stake_sums[owner] = ExactSum()
+        else:
+            old_stake = self._operator_stakes[owner]
+            self._sorted_operator_stakes.remove(old_stake)
+            self._total_operator_stake.subtract(old_stake)
+        if sign > 0:
+            stake_sum.add(stake)
+        else:
+            stake_sum.subtract(stake)
+        if owner in self._pools_per_operator:
+            new_stake = self._operator_stakes[owner] = stake_sum.value
+            self._sorted_operator_stakes.add(new_stake)
+            self._total_operator_stake.add(new_stake)
+        else:
+            # the operator doesn't have any pools anymore
+            self._operator_stake_sums.pop(owner)
+            self._operator_stakes.pop(owner)
+        self._nakamoto_coefficient = None
+
+
+class MetricsSnapshot:
+    """
+    Snapshot of the pools of a simulation at some point in time (typically the start of a step), shared by the model
+    reporters so that the pools are only traversed once, instead of once for every reporter.
+    The first time that they are needed, the pledges, stakes, margins and owners of the pools are extracted in a single
+    pass and kept in numpy arrays, along with the number of pools and the stake that every operator controls, so that
+    each reporter can be calculated with a few cheap reductions. If the snapshot is taken by the metrics collector of a
+    running simulation, it also gives access to the metrics that the simulation maintains incrementally, so reporters
+    that only need these don't have to go through the pools at all.
+    """
+
+    def __init__(self, model, incremental_metrics=None):
+        """
+        @param model: the instance of the simulation
+        @param incremental_metrics: the IncrementalMetrics of the simulation, if they are up-to-date with its pools
+        """
+        self.model = model
+        self.incremental_metrics = incremental_metrics
+
+    @cached_property
+    def pools(self):
+        return self.model.get_pools_list()
+
+    @cached_property
+    def num_pools(self):
+        return len(self.pools)
+
+    @cached_property
+    def _pool_data(self):
+        return np.array(
+            [(pool.id, pool.owner, pool.pledge, pool.stake, pool.margin) for pool in self.pools], dtype=float
+        ).reshape(-1, 5)
+
+    @cached_property
+    def pool_ids(self):
+        return self._pool_data[:, 0].astype(int)
+
+    @cached_property
+    def owners(self):
+        return self._pool_data[:, 1].astype(int)
+
+    @cached_property
+    def pledges(self):
+        return np.ascontiguousarray(self._pool_data[:, 2])
+
+    @cached_property
+    def stakes(self):
+        return np.ascontiguousarray(self._pool_data[:, 3])
+
+    @cached_property
+    def margins(self):
+        return np.ascontiguousarray(self._pool_data[:, 4])
+
+    @cached_property
+    def _operator_aggregates(self):
+        # operators are sorted by id; the stake of each operator is summed in the order of the pools, so it is exactly
+        # the same as when summing it in a loop
+        operator_ids, operator_positions = np.unique(self.owners, return_inverse=True)
+        pools_per_operator = np.bincount(operator_positions, minlength=operator_ids.size)
+        stake_per_operator = np.bincount(operator_positions, weights=self.stakes, minlength=operator_ids.size)
+        return operator_ids, pools_per_operator, stake_per_operator
+
+    @property
+    def operator_ids(self):
+        return self._operator_aggregates[0]
+
+    @property
+    def pools_per_operator(self):
+        return self._operator_aggregates[1]
+
+    @property
+    def stake_per_operator(self):
+        return self._operator_aggregates[2]
+
+    @cached_property
+    def total_stake(self):
+        return fsum(self.stakes)
+
+    @cached_property
+    def total_pledge(self):
+        return fsum(self.pledges)
+
+    @cached_property
+    def agent_ids(self):
+        return np.fromiter(self.model.get_agents_dict().keys(), dtype=int)
+
+    @cached_property
+    def agent_stakes(self):
+        agents = self.model.get_agents_dict()
+        return np.fromiter((agent.stake for agent in agents.values()), dtype=float, count=len(agents))
+
+    @cached_property
+    def agent_costs(self):
+        agents = self.model.get_agents_dict()
+        return np.fromiter((agent.cost for agent in agents.values()), dtype=float, count=len(agents))
+
+    @cached_property
+    def _agent_ids_match_positions(self):
+        # in a simulation the agents are indexed by their ids, which go from 0 to n - 1
+        return np.array_equal(self.agent_ids, np.arange(self.agent_ids.size))
+
+    def get_agent_positions(self, agent_ids):
+        """
+        @param agent_ids: numpy array with ids of agents
+        @return: numpy array with the positions of these agents in the agent arrays of the snapshot (e.g. agent_stakes)
+        """
+        if self._agent_ids_match_positions:
+            return agent_ids
+        position_by_id = {agent_id: i for i, agent_id in enumerate(self.agent_ids.tolist())}
+        return np.array([position_by_id[agent_id] for agent_id in agent_ids.tolist()], dtype=int)
+
+    @cached_property
+    def controlled_stake_per_agent(self):
+        """
+        The stake that each agent controls through its pools (0 for agents that don't operate any pools), in the same
+        order as agent_ids.
+        """
+        controlled_stake = np.zeros(self.agent_ids.size)
+        controlled_stake[self.get_agent_positions(self.operator_ids)] = self.stake_per_operator
+        return controlled_stake
+
+    @cached_property
+    def owner_stake_ranks(self):
+        """
+        The rank of the owner of each pool when all agents are ranked by stake (the agent with the highest stake has
+        rank 1, ties are broken in favour of lower ids), like calculate_ranks in the helper module.
+        """
+        return self._get_owner_ranks(-self.agent_stakes)
+
+    @cached_property
+    def owner_cost_ranks(self):
+        """
+        The rank of the owner of each pool when all agents are ranked by cost (the agent with the lowest cost has rank 1).
+        """
+        return self._get_owner_ranks(self.agent_costs)
+
+    @cached_property
+    def min_aggregate_pledge(self):
+        """
+        The minimum aggregate pledge of pools that collectively control at least half of the stake (see
+        model_reporters.get_min_aggregate_pledge). It is exact, unless the simulation allows it to exceed the true minimum
+        by some tolerance.
+        """
+        if self.num_pools == 0:
+            return 0
+        pledges = self.pledges.tolist()
+        stakes = to_exact_integers(self.stakes.tolist())
+        # the tolerance is scaled together with the pledge values
+        *pledge_values, tolerance = to_exact_integers(pledges + [self.model.min_aggregate_pledge_tolerance])
+        excluded_pools, _ = solve_knapsack(pledge_values, stakes, sum(stakes) // 2, tolerance=tolerance)
+        excluded_pools = set(excluded_pools)
+        return fsum([pledge for i, pledge in enumerate(pledges) if i not in excluded_pools])
+
+    def _get_owner_ranks(self, sort_keys):
+        ranks = np.empty(self.agent_ids.size, dtype=int)
+        ranks[np.lexsort((self.agent_ids, sort_keys))] = np.arange(1, self.agent_ids.size + 1)
+        return ranks[self.get_agent_positions(self.owners)]
+
+
+class MetricsCollector:
+    """
+    Collector of the model-level metrics of a simulation (used instead of mesa's DataCollector).
+    At every collection, a snapshot of the pools is built once and passed on to all reporters (see MetricsSnapshot).
+    The values of scalar metrics are stored in preallocated numpy columns (of integers or floats, depending on the values
+    that the metric reports) which grow geometrically when they fill up, while the values of other metrics (e.g. lists or
+    dictionaries) are kept in plain lists. Each row is labelled with the step it was collected at, since metrics are not
+    necessarily collected at every step (see COLLECTION_POLICIES). When a file is provided, the collected rows are appended to it in chunks
+    during the run, so that the csv file is built incrementally instead of going through a DataFrame at the end. If the
+    history of the metrics is not needed after the run (e.g. for plotting them), the rows that have been written to the
+    file are also dropped from memory, so that memory use doesn't grow with the number of steps.
+    """
+
+    def __init__(self, model_reporters, filepath=None, chunk_size=DEFAULT_CHUNK_SIZE, keep_history=True):
+        """
+        @param model_reporters: dictionary with the names of the metrics as keys and functions that calculate them
+            (given the model and a snapshot of its pools) as values
+        @param filepath: path of the csv file that the collected rows are written to (None to keep them in memory only)
+        @param chunk_size: the number of rows that are accumulated before they are written to the file
+        @param keep_history: whether to keep the rows in memory after they have been written to the file
+        """
+        self.model_reporters = dict(model_reporters)
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self.keep_history = keep_history or filepath is None
+        self.num_rows = 0  # the total number of rows collected so far
+        self.last_step = None  # the step of the last row
+        self._first_row = 0  # the index of the first row that is still held in memory
+        self._flushed_rows = 0  # the number of rows that have been written to the file
+        self._header_written = False
+        self._capacity = INITIAL_CAPACITY
+        # each column is a numpy array with room for _capacity values, a list or None if no value has been collected yet
+        self._columns = dict.fromkeys(self.model_reporters)
+        self._steps = np.empty(self._capacity, dtype=np.int64)
+        self._last_row = None
+
+    def __len__(self):
+        return self.num_rows
+
+    @property
+    def names(self):
+        return list(self.model_reporters)
+
+    @property
+    def retained_steps(self):
+        """
+        @return: list with the steps whose rows are held in memory (in increasing order)
+        """
+        return self.get_steps().tolist()
+
+    def get_steps(self):
+        """
+        @return: numpy array with the steps whose rows are held in memory (in increasing order)
+        """
+        return self._steps[:self.num_rows - self._first_row]
+
+    def collect(self, model, step=None):
+        """
+        Calculate all metrics for the current state of the given model and add them as a new row.
+        @param step: the step that the row corresponds to (by default, the number of rows collected so far)
+        """
+        snapshot = MetricsSnapshot(model, incremental_metrics=getattr(model, 'incremental_metrics', None))
+        self.add_row({name: reporter(model, snapshot) for name, reporter in self.model_reporters.items()}, step)
+
+    def add_row(self, row, step=None):
+        """
+        @param row: dictionary with the value of every metric of the collector
+        @param step: the step that the row corresponds to (by default, the number of rows collected so far); steps
+            must be given in increasing order
+        """
+        if step is None:
+            step = self.num_rows
+        position = self.num_rows - self._first_row
+        if position == self._capacity:
+            self._grow()
+        for name in self.model_reporters:
+            self._store(name, position, row[name])
+        self._steps[position] = step
+        self.num_rows += 1
+        self.last_step = step
+        self._last_row = row
+        if self.filepath is not None and self.num_rows - self._flushed_rows >= self.chunk_size:
+            self.flush()
+
+    def _grow(self):
+        self._capacity *= 2
+        grown_steps = np.empty(self._capacity, dtype=np.int64)
+        grown_steps[:self._steps.size] = self._steps
+        self._steps = grown_steps
+        for name, column in self._columns.items():
+            if isinstance(column, np.ndarray):
+                grown_column = np.empty(self._capacity, dtype=column.dtype)
+                grown_column[:column.size] = column
+                self._columns[name] = grown_column
+
+    def _store(self, name, position, value):
+        column = self._columns[name]
+        if column is None:
+            if is_integer_value(value):
+                column = np.empty(self._capacity, dtype=np.int64)
+            elif is_real_value(value):
+                column = np.empty(self._capacity, dtype=np.float64)
+            else:
+                column = []
+            self._columns[name] = column
+        if isinstance(column, np.ndarray):
+            if column.dtype.kind == 'i' and not is_integer_value(value) and is_real_value(value):
+                # the metric turned out to take non-integer values too, so (like pandas) the column switches to floats
+                column = column.astype(np.float64)
+                self._columns[name] = column
+            elif not is_real_value(value):
+                column = column[:position].tolist()
+                self._columns[name] = column
+        if isinstance(column, list):
+            column.append(value)
+        else:
+            column[position] = value
+
+    def get_column(self, name):
+        """
+        @param name: the name of a metric
+        @return: the values of the metric for the steps that are held in memory (see get_steps), as a numpy array
+            for scalar metrics or as a list otherwise
+        """
+        column = self._columns[name]
+        length = self.num_rows - self._first_row
+        if column is None:
+            return []
+        return column[:length]
+
+    def get_row(self, step):
+        """
+        @param step: the step to retrieve the metrics for
+        @return: dictionary with the value of every metric at the given step
+        """
+        if step == self.last_step:
+            return dict(self._last_row)
+        steps = self.get_steps()
+        position = int(np.searchsorted(steps, step))
+        if position == steps.size or steps[position] != step:
+            raise IndexError('the metrics of step {} were not collected or are not held in memory'.format(step))
+        return {name: self._get_value(column, position) for name, column in self._columns.items()}
+
+    def get_latest_value(self, name):
+        """
+        @param name: the name of a metric
+        @return: the last value that was collected for the metric
+        """
+        if self._last_row is None:
+            raise IndexError('no metrics have been collected yet')
+        return self._last_row[name]
+
+    @staticmethod
+    def _get_value(column, position):
+        value = column[position]
+        return value.item() if isinstance(column, np.ndarray) else value
+
+    def flush(self):
+        """
+        Append the rows that have been collected since the last flush to the file of the collector (writing the header
+        first, if this is the first time) and, if the history is not kept, drop them from memory.
+        """
+        if self.filepath is None:
+            return
+        start, end = self._flushed_rows - self._first_row, self.num_rows - self._first_row
+        with open(self.filepath, 'a' if self._header_written else 'w', newline='') as file:
+            writer = csv.writer(file, lineterminator='\n')
+            if not self._header_written:
+                writer.writerow(['Round'] + self.names)
+                self._header_written = True
+            values = [self._get_values(column, start, end) for column in self._columns.values()]
+            writer.writerows(zip(self._steps[start:end].tolist(), *values))
+        self._flushed_rows = self.num_rows
+        if not self.keep_history:
+            # the numpy columns (and the steps) are reused from the start, so they never need to grow
+            self._first_row = self.num_rows
+            for name, column in self._columns.items():
+                if isinstance(column, list):
+                    self._columns[name] = []
+
+    @staticmethod
+    def _get_values(column, start, end):
+        if column is None:
+            return []
+        values = column[start:end]
+        return values.tolist() if isinstance(values, np.ndarray) else values
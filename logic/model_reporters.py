@@ -1,385 +1,353 @@
 import statistics
-import collections
-from gekko import GEKKO
 import numpy as np
 from math import fsum
 
 import logic.helper as hlp
+import logic.caching as caching
+from logic.metrics import MetricsSnapshot
 
 
-def get_number_of_pools(model):
+def get_snapshot(model, snapshot=None):
+    """
+    @param model: the instance of the simulation
+    @param snapshot: snapshot of the pools of the simulation, if one has already been built for the current step (e.g.
+        by the metrics collector, which shares it among all reporters)
+    @return: a snapshot of the current pools of the simulation
+    """
+    return snapshot if snapshot is not None else MetricsSnapshot(model)
+
+
+def get_number_of_pools(model, snapshot=None):
     return len(model.pools)
 
 
-def get_avg_margin(model):
-    pools = model.get_pools_list()
-    margins = [pool.margin for pool in pools]
-    return statistics.mean(margins) if len(margins) > 0 else 0
+def get_avg_margin(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    return statistics.mean(snapshot.margins.tolist()) if snapshot.num_pools > 0 else 0
 
 
-def get_median_margin(model):
-    pools = model.get_pools_list()
-    margins = [pool.margin for pool in pools]
-    return statistics.median(margins) if len(margins) > 0 else 0
+def get_median_margin(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    return statistics.median(snapshot.margins.tolist()) if snapshot.num_pools > 0 else 0
 
 
-def get_avg_pledge(model):
-    current_pool_pledges = [pool.pledge for pool in model.get_pools_list()]
-    return statistics.mean(current_pool_pledges) if len(current_pool_pledges) > 0 else 0
+def get_avg_pledge(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    return statistics.mean(snapshot.pledges.tolist()) if snapshot.num_pools > 0 else 0
 
 
-def get_total_pledge(model):
-    current_pool_pledges = [pool.pledge for pool in model.get_pools_list()]
-    return fsum(current_pool_pledges)
+def get_total_pledge(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    if snapshot.incremental_metrics is not None:
+        return snapshot.incremental_metrics.total_pledge
+    return snapshot.total_pledge
 
 
-def get_median_pledge(model):
-    current_pool_pledges = [pool.pledge for pool in model.get_pools_list()]
-    return statistics.median(current_pool_pledges) if len(current_pool_pledges) > 0 else 0
+def get_median_pledge(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    return statistics.median(snapshot.pledges.tolist()) if snapshot.num_pools > 0 else 0
 
 
-def get_avg_pools_per_operator(model):
-    current_pools = model.get_pools_list()
-    current_num_pools = len(current_pools)
-    if current_num_pools == 0:
+def get_avg_pools_per_operator(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    incremental_metrics = snapshot.incremental_metrics
+    if incremental_metrics is not None:
+        if incremental_metrics.pool_count == 0:
+            return 0
+        return incremental_metrics.pool_count / incremental_metrics.operator_count
+    if snapshot.num_pools == 0:
         return 0
-    current_num_operators = len(set([pool.owner for pool in current_pools]))
-    return current_num_pools / current_num_operators
+    return snapshot.num_pools / snapshot.operator_ids.size
 
 
-def get_max_pools_per_operator(model):
-    current_pools = model.get_pools_list()
-    if len(current_pools) == 0:
+def get_max_pools_per_operator(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    if snapshot.incremental_metrics is not None:
+        return snapshot.incremental_metrics.max_pools_per_operator
+    if snapshot.num_pools == 0:
         return 0
-    current_owners = [pool.owner for pool in current_pools]
-    max_frequency_owner, max_pool_count_per_owner = collections.Counter(current_owners).most_common(1)[0]
-    return max_pool_count_per_owner
+    return int(snapshot.pools_per_operator.max())
 
 
-def get_median_pools_per_operator(model):
-    current_pools = model.get_pools_list()
-    if len(current_pools) == 0:
+def get_median_pools_per_operator(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    incremental_metrics = snapshot.incremental_metrics
+    if incremental_metrics is not None:
+        return incremental_metrics.median_pools_per_operator if incremental_metrics.pool_count > 0 else 0
+    if snapshot.num_pools == 0:
         return 0
-    current_owners = [pool.owner for pool in current_pools]
-    sorted_frequencies = sorted(collections.Counter(current_owners).values())
-    return statistics.median(sorted_frequencies)
+    return statistics.median(snapshot.pools_per_operator.tolist())
 
 
-def get_avg_sat_rate(model):
-    current_pools = model.get_pools_list()
-    if len(current_pools) == 0:
+def get_avg_sat_rate(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    if snapshot.num_pools == 0:
         return 0
-    sat_rates = [pool.stake / model.reward_scheme.get_pool_saturation_threshold(pool.pledge) for pool in current_pools]
+    saturation_thresholds = model.reward_scheme.get_pool_saturation_thresholds(snapshot.pledges)
+    sat_rates = (snapshot.stakes / saturation_thresholds).tolist()
     return statistics.mean(sat_rates)
 
 
-def get_stakes_n_margins(model):
-    agents = model.get_agents_dict()
-    pools = model.get_pools_list()
+def get_stakes_n_margins(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
     return {
-        'x': [agents[pool.owner].stake for pool in pools],
-        'y': [pool.stake for pool in pools],
-        'r': [pool.margin for pool in pools],
-        'pool_id': [pool.id for pool in pools],
-        'owner_id': [pool.owner for pool in pools]
+        'x': snapshot.agent_stakes[snapshot.get_agent_positions(snapshot.owners)].tolist(),
+        'y': snapshot.stakes.tolist(),
+        'r': snapshot.margins.tolist(),
+        'pool_id': snapshot.pool_ids.tolist(),
+        'owner_id': snapshot.owners.tolist()
     }
 
 
-def get_controlled_stake_distr_stat_dist(model):
+def get_controlled_stake_distr_stat_dist(model, snapshot=None):
     """
     :param model:
+    :param snapshot: snapshot of the pools of the simulation (optional)
     :return: the statistical distance of the distributions of the stake that agents control
                 (how they started vs how they ended up)
     """
-    active_agents = {
-        agent_id: agent
-        for agent_id, agent in model.get_agents_dict().items()
-    }
-    pools = model.get_pools_list()
-    if len(pools) == 0:
+    snapshot = get_snapshot(model, snapshot)
+    if snapshot.num_pools == 0:
         return 0
-    initial_controlled_stake = {
-        agent_id: active_agents[agent_id].stake
-        for agent_id in active_agents
-    }
-    current_controlled_stake = {
-        agent_id: 0
-        for agent_id in active_agents
-    }
-    for pool in pools:
-        current_controlled_stake[pool.owner] += pool.stake
-    abs_diff = [
-        abs(current_controlled_stake[agent_id] - initial_controlled_stake[agent_id])
-        for agent_id in active_agents
-    ]
-    return sum(abs_diff) / 2
+    abs_diff = np.abs(snapshot.controlled_stake_per_agent - snapshot.agent_stakes)
+    return sum(abs_diff.tolist()) / 2
 
 
-def get_nakamoto_coefficient(model):
+def get_nakamoto_coefficient(model, snapshot=None):
     """
     The Nakamoto coefficient is defined as the minimum number of entities that control more than 50% of the system
     (and can therefore launch a 51% attack against it). This function returns the nakamoto coefficient for a given
     simulation instance.
     :param model: the instance of the simulation
+    :param snapshot: snapshot of the pools of the simulation (optional)
     :return: the number of agents that control more than 50% of the total active stake through their pools
     """
-    agents = model.get_agents_dict()
-    active_agents = {agent_id: agents[agent_id] for agent_id in agents}
-    try:
-        pools = model.get_pools_list()
-    except AttributeError:
-        # no pools have been created at this point
-        # todo merge in one mechanism for pools or agents
-        agent_stakes = [agent.stake for agent in agents.values()]
-        sorted_final_stake = sorted(agent_stakes, reverse=True)
-        majority_control_agents = 0
-        majority_control_stake = 0
-        index = 0
-        total_stake = fsum(sorted_final_stake)
-        while majority_control_stake <= total_stake / 2:
-            majority_control_stake += sorted_final_stake[index]
-            majority_control_agents += 1
-            index += 1
-
-        return majority_control_agents
-
-    if len(pools) == 0:
+    if not hasattr(model, 'pools'):
+        # no pools have been created at this point (e.g. when describing the initial state of the simulation), so the
+        # stake of each agent counts as controlled by the agent itself
+        sorted_agent_stake = -np.sort(-model.population.stakes)
+        majority_threshold = fsum(sorted_agent_stake) / 2
+        return int(np.argmax(np.cumsum(sorted_agent_stake) > majority_threshold)) + 1
+
+    snapshot = get_snapshot(model, snapshot)
+    if snapshot.incremental_metrics is not None:
+        return snapshot.incremental_metrics.nakamoto_coefficient
+    if snapshot.num_pools == 0:
         return 0
 
-    controlled_stake = {agent_id: 0 for agent_id in active_agents}
-    for pool in pools:
-        controlled_stake[pool.owner] += pool.stake
-
-    final_stake = [controlled_stake[agent_id] for agent_id in active_agents.keys()]
+    # agents that don't operate any pools control no stake, so they don't affect the result
+    final_stake = snapshot.stake_per_operator
     total_active_stake = fsum(final_stake)
-    sorted_final_stake = sorted(final_stake, reverse=True)
-    cumulative_final_stake = np.array([fsum(sorted_final_stake[:i + 1]) for i in range(len(sorted_final_stake))])
+    sorted_final_stake = -np.sort(-final_stake)
     majority_threshold = total_active_stake / 2
-    nc = np.argmax(cumulative_final_stake > majority_threshold) + 1
-    return nc
+    return count_majority_holders(sorted_final_stake, majority_threshold)
 
 
-# note that this reporter cannot be used with multiprocessing (i.e. with the way batch-run currently works)
-def get_min_aggregate_pledge(model):
+def count_majority_holders(sorted_stake, majority_threshold):
+    """
+    Find the minimum number of entities that together hold more than some threshold of stake.
+    The cumulative sums are calculated in one go with numpy, and then the exact (correctly rounded) sums of the
+    entities around the threshold are checked with fsum, to make sure that floating point errors of the cumulative
+    sums don't affect the result.
+    :param sorted_stake: numpy array with the stake of each entity, sorted from highest to lowest
+    :param majority_threshold: the stake that the entities need to exceed
+    :return: the number of entities that are required (1 if no number of entities exceeds the threshold)
     """
-    Solve optimisation problem using solver
+    cumulative_stake = np.cumsum(sorted_stake)
+    count = int(np.argmax(cumulative_stake > majority_threshold)) + 1
+    if fsum(sorted_stake[:count]) > majority_threshold:
+        while count > 1 and fsum(sorted_stake[:count - 1]) > majority_threshold:
+            count -= 1
+        return count
+    while count < len(sorted_stake):
+        count += 1
+        if fsum(sorted_stake[:count]) > majority_threshold:
+            return count
+    return 1
+
+
+def get_min_aggregate_pledge(model, snapshot=None):
+    """
+    Find the minimum aggregate pledge of pools that collectively control at least half of the active stake.
+    This is equivalent to a 0/1 knapsack problem: the pools that are left out of such a set can control at most half of
+    the stake and they must have the maximum aggregate pledge. The stake and pledge values are scaled to integers without
+    any rounding, so the constraint is checked exactly and the result is the true minimum (unless the simulation was
+    given a min_aggregate_pledge_tolerance, in which case it may exceed the true minimum by up to that amount).
+    :param model: instance of the simulation
+    :param snapshot: snapshot of the pools of the simulation (optional)
+    :return: the minimum aggregate pledge
     """
+    snapshot = get_snapshot(model, snapshot)
+    return snapshot.min_aggregate_pledge
 
-    pools = model.get_pools_list()
-    if len(pools) == 0:
-        return 0
 
-    ids = [pool.id for pool in pools]
-    pledges = [pool.pledge for pool in pools]
-    stakes = [pool.stake for pool in pools]
-    items = len(ids)
-
-    # Create model
-    g = GEKKO()
-    # Variables
-    x = g.Array(g.Var, items, lb=0, ub=1, integer=True)
-    # Objective
-    g.Minimize(g.sum([pledges[i] * x[i] for i in range(items)]))
-    # Constraint
-    lower_bound = sum(stakes) / 2
-    g.Equation(g.sum([stakes[i] * x[i] for i in range(items)]) >= lower_bound)
-    # Optimize with APOPT
-    g.options.SOLVER = 1
-
-    try:
-        g.solve(disp=False)  # choose disp = True to print details while running
-    except Exception as e:  # todo catch specific errors
-        print("Min aggregate pledge not found")
-        return -2
-
-    min_aggr_pledge = g.options.objfcnval
-    return min_aggr_pledge
-
-
-def get_pledge_rate(model):
+def get_pledge_rate(model, snapshot=None):
     """
     Pledge rate is defined as: total_pledge / total_active_stake
     :param model: instance of the simulation
+    :param snapshot: snapshot of the pools of the simulation (optional)
     :return: the pledge rate of the model at its current state
     """
-    pools = model.get_pools_list()
-    if len(pools) == 0:
+    snapshot = get_snapshot(model, snapshot)
+    incremental_metrics = snapshot.incremental_metrics
+    if incremental_metrics is not None:
+        if incremental_metrics.pool_count == 0:
+            return 0
+        return incremental_metrics.total_pledge / incremental_metrics.total_stake
+    if snapshot.num_pools == 0:
         return 0
-    total_active_stake = fsum([pool.stake for pool in pools])
-    total_pledge = fsum([pool.pledge for pool in pools])
-    return total_pledge / total_active_stake
+    return snapshot.total_pledge / snapshot.total_stake
 
 
-def get_homogeneity_factor(model):
+def get_homogeneity_factor(model, snapshot=None):
     """
     Shows how homogeneous the pools are
     :param model:
+    :param snapshot: snapshot of the pools of the simulation (optional)
     :return:
     """
-    pools = model.get_pools_list()
-    pool_count = len(pools)
+    snapshot = get_snapshot(model, snapshot)
+    pool_count = snapshot.num_pools
     if pool_count == 0:
         return 0
-    pool_stakes = [pool.stake for pool in pools]
-    max_stake = max(pool_stakes)
+    max_stake = float(snapshot.stakes.max())
 
     ideal_area = pool_count * max_stake
-    actual_area = fsum(pool_stakes)
+    actual_area = snapshot.total_stake
 
     return actual_area / ideal_area
 
 
-def get_iterations(model):
+def get_iterations(model, snapshot=None):
     return model.schedule.steps
 
 
-def get_avg_stk_rnk(model):
-    pools = model.get_pools_list()
-    all_agents = model.get_agents_dict()
-    stakes = {agent_id: agent.stake for agent_id, agent in all_agents.items()}
-    stake_ranks = hlp.calculate_ranks(stakes)
-    pool_owner_stk_ranks = [stake_ranks[pool.owner] for pool in pools]
+def get_avg_stk_rnk(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    pool_owner_stk_ranks = snapshot.owner_stake_ranks.tolist()
     return round(statistics.mean(pool_owner_stk_ranks)) if len(pool_owner_stk_ranks) > 0 else 0
 
 
-def get_avg_cost_rnk(model):
-    pools = model.get_pools_list()
-    all_agents = model.get_agents_dict()
-    negative_cost_ranks = hlp.calculate_ranks({agent_id: -agent.cost for agent_id, agent in all_agents.items()})
-    pool_owner_cost_ranks = [negative_cost_ranks[pool.owner] for pool in pools]
+def get_avg_cost_rnk(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    pool_owner_cost_ranks = snapshot.owner_cost_ranks.tolist()
     return round(statistics.mean(pool_owner_cost_ranks)) if len(pool_owner_cost_ranks) > 0 else 0
 
 
-def get_median_stk_rnk(model):
-    pools = model.get_pools_list()
-    all_agents = model.get_agents_dict()
-    stakes = {agent_id: agent.stake for agent_id, agent in all_agents.items()}
-    stake_ranks = hlp.calculate_ranks(stakes)
-    pool_owner_stk_ranks = [stake_ranks[pool.owner] for pool in pools]
+def get_median_stk_rnk(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    pool_owner_stk_ranks = snapshot.owner_stake_ranks.tolist()
     return round(statistics.median(pool_owner_stk_ranks)) if len(pool_owner_stk_ranks) > 0 else 0
 
 
-def get_median_cost_rnk(model):
-    pools = model.get_pools_list()
-    all_agents = model.get_agents_dict()
-    negative_cost_ranks = hlp.calculate_ranks({agent_id: -agent.cost for agent_id, agent in all_agents.items()})
-    pool_owner_cost_ranks = [negative_cost_ranks[pool.owner] for pool in pools]
+def get_median_cost_rnk(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    pool_owner_cost_ranks = snapshot.owner_cost_ranks.tolist()
     return round(statistics.median(pool_owner_cost_ranks)) if len(pool_owner_cost_ranks) > 0 else 0
 
 
-def get_pool_splitter_count(model):
-    pools = model.get_pools_list()
-    if len(pools) == 0:
-        return 0
-    pool_operators = [pool.owner for pool in pools]
-    cnt = collections.Counter(pool_operators)
-    pool_splitters = [k for k, v in cnt.items() if v > 1]
-
-    return len(pool_splitters)
+def get_pool_splitter_count(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    if snapshot.incremental_metrics is not None:
+        return snapshot.incremental_metrics.pool_splitter_count
+    return int(np.count_nonzero(snapshot.pools_per_operator > 1))
 
 
-def get_cost_efficient_count(model):
-    all_agents = model.get_agents_list()
-    potential_profits = [
-        hlp.calculate_potential_profit(reward_scheme=model.reward_scheme, pledge=agent.stake, cost=agent.cost)
-        for agent in all_agents
-    ]
-    positive_potential_profits = [pp for pp in potential_profits if pp > 0]
-    return len(positive_potential_profits)
+def get_cost_efficient_count(model, snapshot=None):
+    potential_profits = hlp.calculate_potential_profits(
+        reward_scheme=model.reward_scheme, pledges=model.population.stakes, costs=model.population.costs
+    )
+    return int(np.count_nonzero(potential_profits > 0))
 
 
-def get_pool_stakes_by_agent(model):
-    num_agents = model.n
-    pool_stakes = [0 for _ in range(num_agents)]
-    current_pools = model.get_pools_list()
-    for pool in current_pools:
-        pool_stakes[pool.owner] += pool.stake
+def get_pool_stakes_by_agent(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    pool_stakes = [0 for _ in range(model.n)]
+    for owner, stake in zip(snapshot.operator_ids.tolist(), snapshot.stake_per_operator.tolist()):
+        pool_stakes[owner] = stake
     return pool_stakes
 
 
-def get_pool_stakes_by_agent_id(model):
-    num_agents = model.n
-    pool_stakes = {i: 0 for i in range(num_agents)}
-    current_pools = model.get_pools_list()
-    for pool in current_pools:
-        pool_stakes[pool.owner] += pool.stake
+def get_pool_stakes_by_agent_id(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    pool_stakes = {i: 0 for i in range(model.n)}
+    pool_stakes.update(zip(snapshot.operator_ids.tolist(), snapshot.stake_per_operator.tolist()))
     return pool_stakes
 
 
 def gini_coefficient(np_array):
     """Compute Gini coefficient of array of values
     using the fact that their Gini coefficient is half their relative mean absolute difference,
-    as noted here: https://en.wikipedia.org/wiki/Mean_absolute_difference#Relative_mean_absolute_difference """
-    diffsum = 0  # sum of absolute differences
-    for i, xi in enumerate(np_array[:-1], 1):
-        diffsum += np.sum(np.abs(xi - np_array[i:]))
-    return diffsum / (len(np_array) * sum(np_array)) if sum(np_array) != 0 else -1
-
-
-def get_gini_id_coeff_pool_count(model):
-    # gather data
-    pools = model.get_pools_list()
-    # todo check later if you can abstract this to a function that serves this one, NC and others
-    pools_owned = collections.defaultdict(lambda: 0)
-    for pool in pools:
-        pools_owned[pool.owner] += 1
-    pools_per_agent = np.fromiter(pools_owned.values(), dtype=int)
-    return gini_coefficient(pools_per_agent)
+    as noted here: https://en.wikipedia.org/wiki/Mean_absolute_difference#Relative_mean_absolute_difference
+    After sorting the values, the i-th smallest one (0-indexed) is larger than i values and smaller than n - i - 1 values,
+    so the sum of the absolute differences of all pairs is the sum of x_i * (2i - n + 1), which takes O(n log n) time
+    instead of going through all pairs """
+    sorted_array = np.sort(np.asarray(np_array, dtype=float))
+    n = len(sorted_array)
+    total = fsum(sorted_array)
+    if total == 0:
+        return -1
+    diffsum = fsum(sorted_array * (2 * np.arange(n) - n + 1))  # sum of absolute differences
+    return diffsum / (n * total)
+
+
+def get_gini_id_coeff_pool_count(model, snapshot=None):
+    return gini_coefficient(get_snapshot(model, snapshot).pools_per_operator)
 
 
-def get_gini_id_coeff_pool_count_k_agents(model):
+def get_gini_id_coeff_pool_count_k_agents(model, snapshot=None):
     # use at least k agents (if there aren't k pool operators, pad with non-pool operators)
-    pools = model.get_pools_list()
-    pools_owned = collections.defaultdict(lambda: 0)
-    for pool in pools:
-        pools_owned[pool.owner] += 1
-    pools_per_agent = np.fromiter(pools_owned.values(), dtype=int)
+    pools_per_agent = get_snapshot(model, snapshot).pools_per_operator
     if pools_per_agent.size < model.reward_scheme.k:
         missing_values = model.reward_scheme.k - pools_per_agent.size
         pools_per_agent = np.append(pools_per_agent, np.zeros(missing_values, dtype=int))
     return gini_coefficient(pools_per_agent)
 
 
-def get_gini_id_coeff_stake(model):
-    pools = model.get_pools_list()
-    stake_controlled = collections.defaultdict(lambda: 0)
-    for pool in pools:
-        stake_controlled[pool.owner] += pool.stake
-    stake_per_agent = np.fromiter(stake_controlled.values(), dtype=float)
-    return gini_coefficient(stake_per_agent)
+def get_gini_id_coeff_stake(model, snapshot=None):
+    return gini_coefficient(get_snapshot(model, snapshot).stake_per_operator)
 
 
-def get_gini_id_coeff_stake_k_agents(model):
-    pools = model.get_pools_list()
-    stake_controlled = collections.defaultdict(lambda: 0)
-    for pool in pools:
-        stake_controlled[pool.owner] += pool.stake
-    stake_per_agent = np.fromiter(stake_controlled.values(), dtype=float)
+def get_gini_id_coeff_stake_k_agents(model, snapshot=None):
+    stake_per_agent = get_snapshot(model, snapshot).stake_per_operator
     if stake_per_agent.size < model.reward_scheme.k:
         missing_values = model.reward_scheme.k - stake_per_agent.size
         stake_per_agent = np.append(stake_per_agent, np.zeros(missing_values, dtype=int))
     return gini_coefficient(stake_per_agent)
 
 
-def get_total_delegated_stake(model):
-    pools = model.get_pools_list()
-    del_stake = fsum([pool.stake for pool in pools])
-    total_stake = fsum([agent.stake for agent in model.schedule.agents])
-    return del_stake
+def get_total_delegated_stake(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    if snapshot.incremental_metrics is not None:
+        return snapshot.incremental_metrics.total_stake
+    return snapshot.total_stake
 
 
-def get_active_stake_agents(model):
-    return fsum([agent.stake for agent in model.schedule.agents])
+def get_active_stake_agents(model, snapshot=None):
+    return fsum(model.population.stakes)
 
 
 def get_stake_distr_stats(model):
-    stake_distribution = np.array([agent.stake for agent in model.schedule.agents])
+    stake_distribution = model.population.stakes
     return stake_distribution.max(), stake_distribution.min(), stake_distribution.mean(), np.median(
         stake_distribution), stake_distribution.std()
 
 
-def get_operator_count(model):
-    return len({pool.owner for pool in model.get_pools_list()})
+def get_operator_count(model, snapshot=None):
+    snapshot = get_snapshot(model, snapshot)
+    if snapshot.incremental_metrics is not None:
+        return snapshot.incremental_metrics.operator_count
+    return snapshot.operator_ids.size
+
+
+def get_cache_stats(model, snapshot=None):
+    """
+    @return: dictionary with the hits, misses, evictions and size of every cache used in the simulation, by cache name
+    """
+    cache_stats = caching.get_cache_stats()
+    cache_stats['potential_profit (reward scheme)'] = model.reward_scheme.potential_profit_cache.get_stats()
+    cache_stats['saturation_threshold (reward scheme)'] = model.reward_scheme.saturation_threshold_cache.get_stats()
+    return cache_stats
 
 
 ALL_MODEL_REPORTEERS = {
@@ -414,7 +382,8 @@ ALL_MODEL_REPORTEERS = {
     "StakePairs": get_stakes_n_margins,
     "Total delegated stake": get_total_delegated_stake,
     "Total agent stake": get_active_stake_agents,
-    "Operator count": get_operator_count
+    "Operator count": get_operator_count,
+    "Cache statistics": get_cache_stats
 }
 
 REPORTER_IDS = {
@@ -447,5 +416,6 @@ REPORTER_IDS = {
     27: "Stake per agent id",
     28: "Total delegated stake",
     29: "Total agent stake",
-    30: "Operator count"
+    30: "Operator count",
+    31: "Cache statistics"
 }
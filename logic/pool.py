@@ -1,9 +1,12 @@
 # -*- coding: utf-8 -*-
+from copy import copy
+
 import logic.helper as hlp
 
 
 class Pool:
     def __init__(self, pool_id, cost, pledge, owner, reward_scheme, margin=-1, is_private=False):
+        self._myopic_desirability = None
         self.id = pool_id
         self.cost = cost
         self.pledge = pledge
@@ -11,6 +14,8 @@ class Pool:
         self.owner = owner
         self.is_private = is_private
         self.delegators = dict()
+        # whether the delegators' map is shared with drafts of the pool (or with the pool that this one is a draft of)
+        self._shares_delegators = False
         self.set_profit(reward_scheme)
         self.margin = margin
 
@@ -23,15 +28,80 @@ class Pool:
         self._margin = m
         # whenever the margin changes, the pool's desirability gets automatically re-calculated
         self.set_desirability()
+        self._myopic_desirability = None
+
+    @property
+    def stake(self):
+        return self._stake
+
+    @stake.setter
+    def stake(self, s):
+        self._stake = s
+        # the myopic desirability depends on the current stake of the pool, so it needs to be re-calculated
+        self._myopic_desirability = None
+
+    @property
+    def pledge(self):
+        return self._pledge
 
-    def set_profit(self, reward_scheme):
-        self.potential_profit = hlp.calculate_potential_profit(reward_scheme=reward_scheme, pledge=self.pledge,
-                                                               cost=self.cost)
+    @pledge.setter
+    def pledge(self, p):
+        self._pledge = p
+        self._myopic_desirability = None
+
+    @property
+    def cost(self):
+        return self._cost
+
+    @cost.setter
+    def cost(self, c):
+        self._cost = c
+        self._myopic_desirability = None
+
+    def set_profit(self, reward_scheme, potential_profit=None):
+        """
+        @param reward_scheme: the reward scheme of the simulation
+        @param potential_profit: the potential profit of the pool, if it has already been calculated (e.g. for many
+            pools at once), otherwise it gets calculated here
+        """
+        if potential_profit is None:
+            potential_profit = hlp.calculate_potential_profit(reward_scheme=reward_scheme, pledge=self.pledge,
+                                                              cost=self.cost)
+        self.potential_profit = potential_profit
+        # the profit is (re-)calculated when the parameters of the reward scheme change, which also affects the
+        # myopic desirability of the pool
+        self._myopic_desirability = None
 
     def set_desirability(self):
         self.desirability = hlp.calculate_pool_desirability(margin=self.margin, potential_profit=self.potential_profit)
 
+    def get_myopic_desirability(self, reward_scheme):
+        """
+        Get the desirability of the pool based on its current profit (instead of its potential profit).
+        The value is cached and only re-calculated when the stake, pledge, cost or margin of the pool change
+        (or when the parameters of the reward scheme change, which leads to re-calculating the potential profit).
+        """
+        if self._myopic_desirability is None:
+            current_profit = hlp.calculate_current_profit(self.stake, self.pledge, self.cost, reward_scheme)
+            self._myopic_desirability = hlp.calculate_myopic_pool_desirability(self.margin, current_profit)
+        return self._myopic_desirability
+
+    def draft(self):
+        """
+        Create a draft of the pool, i.e. a copy that can be modified freely when evaluating a potential strategy, and
+        that can replace the pool if the strategy is executed. Instead of copying the (potentially large) map of
+        delegators, the draft shares it with the pool, and whichever of them changes its delegations first gets its
+        own copy of the map (copy-on-write).
+        @return: the draft pool
+        """
+        pool_draft = copy(self)
+        self._shares_delegators = pool_draft._shares_delegators = True
+        return pool_draft
+
     def update_delegation(self, new_delegation, delegator_id):
+        if self._shares_delegators:
+            self.delegators = dict(self.delegators)
+            self._shares_delegators = False
         if delegator_id in self.delegators:
             self.stake -= self.delegators[delegator_id]
         self.stake += new_delegation
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+
+class Population:
+    """
+    Array-backed store of the attributes of the agents of a simulation (struct-of-arrays layout).
+    The stake and cost of the agent with id i are held in position i of the corresponding numpy arrays, so that
+    operations over the whole population (e.g. normalising the stake or calculating statistics) can work on contiguous
+    arrays instead of going through all agent objects. The agents keep exposing these attributes as before, but they
+    read them from (and write them to) the population's arrays.
+    """
+
+    def __init__(self, stakes, costs):
+        self.stakes = np.array(stakes, dtype=float)
+        self.costs = np.array(costs, dtype=float)
+
+    def __len__(self):
+        return self.stakes.size
+
+    def normalize_stakes(self, total_stake):
+        """
+        Normalize the stake values so that they sum up to 1.
+        @param total_stake: the total stake of the system prior to normalization
+        @return: the sum of the normalized stake values
+        """
+        self.stakes /= total_stake
+        # the cumulative sum adds the values one by one (unlike np.sum), so the result is the same as summing them in a loop
+        norm_total_stake = np.cumsum(self.stakes)[-1] if len(self) > 0 else 0
+        if norm_total_stake != 1:
+            # add (or subtract) tiny value from the last agent's stake to account for floating point errors and make
+            # sure that the sum of all agent stakes is equal to 1
+            flt_error = 1 - norm_total_stake
+            self.stakes[-1] += flt_error
+            norm_total_stake += flt_error
+        return norm_total_stake
@@ -0,0 +1,229 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left
+from collections import defaultdict
+import heapq
+from itertools import islice
+from math import fsum
+
+from sortedcontainers import SortedList
+
+
+class PoolRankings:
+    """
+    Ranking of the pools of the system from best to worst, according to some sort key.
+    It offers the same operations as a sorted list (adding / removing pools, finding the rank of a pool, accessing pools
+    by rank), but it also keeps track of the cumulative saturation thresholds of the ranked pools. This way, the stake
+    that the pools ranked above a given pool can absorb before getting saturated can be retrieved in logarithmic time,
+    instead of summing over all better-ranked pools every time.
+    The cumulative sums are calculated lazily, using compensated summation to avoid accumulating floating point errors,
+    and whenever the rankings change only the sums that correspond to the affected ranks (and the ones below them) are
+    invalidated.
+    """
+
+    def __init__(self, iterable=(), key=None, reward_scheme=None):
+        self.key = key
+        self.reward_scheme = reward_scheme
+        self._ranked_pools = SortedList(key=key)
+        self._pools_by_owner = defaultdict(set)
+        # _cumulative_stake[i] + _compensations[i] is the total saturation threshold of the pools ranked in the first
+        # i positions; only the first len(_cumulative_stake) entries are up-to-date at any given moment
+        self._cumulative_stake = [0]
+        self._compensations = [0]
+        self.update(iterable)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_ranked_pools'] = list(self._ranked_pools)
+        return state
+
+    def __setstate__(self, state):
+        # the key function may depend on objects that are not fully restored yet at the time that the rankings are
+        # unpickled (e.g. the simulation), so the sorted list is only rebuilt when the rankings are first used
+        self.__dict__.update(state)
+        self._unpickled_pools = self.__dict__.pop('_ranked_pools')
+
+    def __getattr__(self, name):
+        # only called for attributes that are not found, i.e. for the sorted list of rankings that were just unpickled
+        if name != '_ranked_pools' or '_unpickled_pools' not in self.__dict__:
+            raise AttributeError(name)
+        self._ranked_pools = SortedList(self.__dict__.pop('_unpickled_pools'), key=self.key)
+        return self._ranked_pools
+
+    def __len__(self):
+        return len(self._ranked_pools)
+
+    def __iter__(self):
+        return iter(self._ranked_pools)
+
+    def __contains__(self, pool):
+        return pool in self._ranked_pools
+
+    def __getitem__(self, index):
+        return self._ranked_pools[index]
+
+    def index(self, pool):
+        return self._ranked_pools.index(pool)
+
+    def bisect_key_left(self, key):
+        return self._ranked_pools.bisect_key_left(key)
+
+    def bisect_key_right(self, key):
+        return self._ranked_pools.bisect_key_right(key)
+
+    def add(self, pool):
+        self._ranked_pools.add(pool)
+        if pool is not None:
+            self._pools_by_owner[pool.owner].add(pool)
+        if len(self._cumulative_stake) > 1:
+            self._invalidate_from(self._ranked_pools.bisect_key_left(self.key(pool)))
+
+    def update(self, pools):
+        pools = list(pools)
+        self._ranked_pools.update(pools)
+        for pool in pools:
+            if pool is not None:
+                self._pools_by_owner[pool.owner].add(pool)
+        self._invalidate_from(0)
+
+    def remove(self, pool):
+        rank = self._ranked_pools.index(pool)
+        del self._ranked_pools[rank]
+        if pool is not None:
+            owned_pools = self._pools_by_owner[pool.owner]
+            owned_pools.discard(pool)
+            if len(owned_pools) == 0:
+                self._pools_by_owner.pop(pool.owner)
+        self._invalidate_from(rank)
+
+    def get_pools_of_owner(self, owner):
+        """
+        @param owner: the id of an agent
+        @return: the ranked pools that belong to the given agent, sorted from best to worst
+        """
+        return sorted(self._pools_by_owner.get(owner, ()), key=self.key)
+
+    def _invalidate_from(self, rank):
+        # the sums up to (and including) position rank only depend on pools ranked above rank, so they remain valid
+        del self._cumulative_stake[rank + 1:]
+        del self._compensations[rank + 1:]
+
+    def get_saturation_threshold(self, pool):
+        # the placeholder entries of the rankings don't correspond to actual pools, so they can't absorb any stake
+        return 0 if pool is None else self.reward_scheme.get_cached_pool_saturation_threshold(pool.pledge)
+
+    def cumulative_saturation_stake(self, rank):
+        """
+        Calculate the stake that the pools in the first positions of the rankings can absorb before getting saturated.
+        @param rank: the number of top-ranked pools to consider (e.g. the rank of a pool, when we want the stake that can
+            be absorbed by the pools that are ranked better than it)
+        @return: the sum of the saturation thresholds of the pools that are ranked in the first "rank" positions
+        """
+        cumulative_stake, compensations = self._cumulative_stake, self._compensations
+        if rank >= len(cumulative_stake):
+            # extend the (Neumaier) compensated sums up to the requested rank
+            s, c = cumulative_stake[-1], compensations[-1]
+            for pool in self._ranked_pools.islice(len(cumulative_stake) - 1, rank):
+                x = self.get_saturation_threshold(pool)
+                t = s + x
+                if abs(s) >= abs(x):
+                    c += (s - t) + x
+                else:
+                    c += (x - t) + s
+                s = t
+                cumulative_stake.append(s)
+                compensations.append(c)
+        return cumulative_stake[rank] + compensations[rank]
+
+
+class RankingsOverlay:
+    """
+    Read-only view of some pool rankings, as they would be if the pools of a certain owner were removed and some
+    hypothetical pools were added. The view doesn't copy the underlying rankings, so it is cheap to create, e.g. for
+    evaluating a potential operator strategy, and it supports the operations of PoolRankings that are needed for
+    calculating the non-myopic stake of pools. Note that the underlying rankings must not change while the view is used.
+    """
+
+    def __init__(self, rankings, excluded_owner=None, extra_pools=()):
+        self.rankings = rankings
+        self.key = rankings.key
+        self.reward_scheme = rankings.reward_scheme
+        self._excluded_pools = rankings.get_pools_of_owner(excluded_owner) if excluded_owner is not None else []
+        self._excluded_keys = [self.key(pool) for pool in self._excluded_pools]
+        # positions of the excluded pools in the underlying rankings (ascending, as the pools are sorted by key)
+        self._excluded_ranks = [rankings.bisect_key_left(key) for key in self._excluded_keys]
+        self._extra_pools = sorted(extra_pools, key=self.key)
+        self._extra_keys = [self.key(pool) for pool in self._extra_pools]
+
+    def __len__(self):
+        return len(self.rankings) - len(self._excluded_pools) + len(self._extra_pools)
+
+    def __iter__(self):
+        excluded_pools = set(self._excluded_pools)
+        remaining_pools = (pool for pool in self.rankings if pool is None or pool not in excluded_pools)
+        return heapq.merge(remaining_pools, self._extra_pools, key=self.key)
+
+    def __contains__(self, pool):
+        if any(pool is extra_pool for extra_pool in self._extra_pools):
+            return True
+        return pool in self.rankings and (pool is None or pool not in self._excluded_pools)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(islice(self, *index.indices(len(self))))
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('overlay index out of range')
+        base_rank, extra_count = self._split(index)
+        # the pool at the requested position is either the next pool of the underlying rankings that is not excluded
+        # or the next hypothetical pool, whichever ranks better
+        excluded_ranks = set(self._excluded_ranks)
+        while base_rank in excluded_ranks:
+            base_rank += 1
+        if extra_count < len(self._extra_pools) and \
+                (base_rank >= len(self.rankings) or self._extra_keys[extra_count] < self.key(self.rankings[base_rank])):
+            return self._extra_pools[extra_count]
+        return self.rankings[base_rank]
+
+    def index(self, pool):
+        if pool not in self:
+            raise ValueError('{0!r} is not in rankings'.format(pool))
+        key = self.key(pool)
+        return self.rankings.bisect_key_left(key) - bisect_left(self._excluded_keys, key) + \
+            bisect_left(self._extra_keys, key)
+
+    def _split(self, rank):
+        """
+        Determine which pools make up the first positions of the view.
+        @param rank: the number of top positions of the view to consider
+        @return: a tuple with the number of top positions of the underlying rankings and the number of hypothetical
+            pools that correspond to these positions of the view
+        """
+        extra_count = 0
+        for key in self._extra_keys:
+            # position of the hypothetical pool in the view
+            position = self.rankings.bisect_key_left(key) - bisect_left(self._excluded_keys, key) + extra_count
+            if position >= rank:
+                break
+            extra_count += 1
+        base_rank = rank - extra_count
+        for excluded_rank in self._excluded_ranks:
+            # skip the excluded pools, like in an order statistic query
+            if excluded_rank < base_rank:
+                base_rank += 1
+        return base_rank, extra_count
+
+    def cumulative_saturation_stake(self, rank):
+        """
+        Calculate the stake that the pools in the first positions of the view can absorb before getting saturated.
+        @param rank: the number of top-ranked pools to consider
+        @return: the sum of the saturation thresholds of the pools that are ranked in the first "rank" positions
+        """
+        base_rank, extra_count = self._split(rank)
+        get_saturation_threshold = self.rankings.get_saturation_threshold
+        return fsum(
+            [self.rankings.cumulative_saturation_stake(base_rank)] +
+            [-get_saturation_threshold(pool)
+             for pool, excluded_rank in zip(self._excluded_pools, self._excluded_ranks) if excluded_rank < base_rank] +
+            [get_saturation_threshold(pool) for pool in self._extra_pools[:extra_count]]
+        )
@@ -1,4 +1,9 @@
+import numpy as np
+
+from logic.caching import VersionedCache
+
 TOTAL_EPOCH_REWARDS_R = 1
+BRACKET_TOLERANCE = 1e-12  # absolute tolerance for the utility comparisons that determine the bounds of the pool count
 
 
 class RSS:
@@ -7,11 +12,19 @@ class RSS:
     Determines the rewards that a pool receives.
     Note that this class cannot be used on its own, only its child-classes can be used, which must implement the
     'calculate_pool_reward' method
+    The vectorised methods (calculate_pool_rewards, get_pool_saturation_thresholds) work on numpy arrays and yield the
+    same results as their scalar counterparts. By default, they apply the scalar methods element-wise, so child-classes
+    should override them with actual vectorised implementations when possible.
+    The param_version attribute changes every time that a parameter of the reward scheme changes, which allows caching
+    values that depend on the parameters (e.g. the potential profit of a pool) and discarding them when they get stale.
     """
 
-    def __init__(self, k, a0):
+    def __init__(self, k, a0, cache_size=1024):
+        self.param_version = 0
+        self.potential_profit_cache = VersionedCache(maxsize=cache_size)
+        self.saturation_threshold_cache = VersionedCache(maxsize=cache_size)
         self.k = k
-        self.a0 = a0 
+        self.a0 = a0
 
     @property
     def k(self):
@@ -24,10 +37,39 @@ class RSS:
         self._k = int(k_value)
         # whenever k changes, the global saturation threshold also changes
         self.global_saturation_threshold = TOTAL_EPOCH_REWARDS_R / k_value
+        self.param_version += 1
+
+    def set_cache_size(self, cache_size):
+        """
+        @param cache_size: the maximum number of entries of each cache of the reward scheme
+        """
+        self.potential_profit_cache.maxsize = cache_size
+        self.saturation_threshold_cache.maxsize = cache_size
+
+    @property
+    def a0(self):
+        return self._a0
+
+    @a0.setter
+    def a0(self, a0_value):
+        self._a0 = a0_value
+        self.param_version += 1
 
     def calculate_pool_reward(self, pool_pledge, pool_stake):
         raise NotImplementedError("RSS subclass must implement 'calculate_pool_reward' method.")
 
+    def calculate_pool_rewards(self, pool_pledges, pool_stakes):
+        """
+        Vectorised version of calculate_pool_reward
+        @param pool_pledges: array with the pledges of the relevant pools
+        @param pool_stakes: array with the stakes of the relevant pools
+        @return: numpy array with the rewards of the pools
+        """
+        pool_pledges, pool_stakes = np.broadcast_arrays(np.asarray(pool_pledges, dtype=float),
+                                                        np.asarray(pool_stakes, dtype=float))
+        return np.array([self.calculate_pool_reward(pool_pledge=pledge, pool_stake=stake)
+                         for pledge, stake in zip(pool_pledges.tolist(), pool_stakes.tolist())]).reshape(pool_pledges.shape)
+
     def get_pool_saturation_threshold(self, pool_pledge):
         """
         By default, the saturation point of all pools is given by the global_saturation_threshold. However, some
@@ -38,6 +80,38 @@ class RSS:
         """
         return self.global_saturation_threshold
 
+    def get_cached_pool_saturation_threshold(self, pool_pledge):
+        """
+        Same as get_pool_saturation_threshold, but the result is retrieved from the cache of the reward scheme if
+        it has already been calculated for the current parameters.
+        @param pool_pledge: the pledge of the relevant pool
+        @return: the saturation threshold of a pool with the given pledge
+        """
+        return self.saturation_threshold_cache.get(pool_pledge, self.param_version,
+                                                   lambda: self.get_pool_saturation_threshold(pool_pledge))
+
+    def get_pool_saturation_thresholds(self, pool_pledges):
+        """
+        Vectorised version of get_pool_saturation_threshold
+        @param pool_pledges: array with the pledges of the relevant pools
+        @return: numpy array with the saturation thresholds of the pools
+        """
+        return np.full(np.shape(pool_pledges), self.global_saturation_threshold, dtype=float)
+
+    def get_num_pools_bracket(self, pledges_per_pool, costs_per_pool, min_target_desirability, calculate_utility):
+        """
+        Narrow down the range of pool counts that can maximise the utility of a (non-myopic) operator, using properties
+        of the reward scheme. Reward schemes that don't support this return None, in which case all pool counts from 1
+        to k must be considered.
+        @param pledges_per_pool: array with the pledge of each pool when operating 1, 2, ..., k pools (t in position t - 1)
+        @param costs_per_pool: array with the cost of each pool when operating 1, 2, ..., k pools
+        @param min_target_desirability: the lowest desirability that a pool of the operator needs to surpass to enter
+            the top k (i.e. the desirability of the k-th best pool of the other agents)
+        @param calculate_utility: function that calculates the utility of operating a given number of pools
+        @return: tuple (t_min, t_max) with the bounds of the pool count that maximises the utility, or None
+        """
+        return None
+
 
 class CardanoRSS(RSS):
     def __init__(self, k, a0):
@@ -51,6 +125,18 @@ class CardanoRSS(RSS):
                                             / self.global_saturation_threshold)))
         return r
 
+    def calculate_pool_rewards(self, pool_pledges, pool_stakes):
+        pledges_ = np.minimum(pool_pledges, self.global_saturation_threshold)
+        stakes_ = np.minimum(pool_stakes, self.global_saturation_threshold)
+        r = (TOTAL_EPOCH_REWARDS_R / (1 + self.a0)) * \
+            (stakes_ + (pledges_ * self.a0 * ((stakes_ - pledges_ * (1 - stakes_ / self.global_saturation_threshold))
+                                              / self.global_saturation_threshold)))
+        return r
+
+    def get_num_pools_bracket(self, pledges_per_pool, costs_per_pool, min_target_desirability, calculate_utility):
+        return calculate_num_pools_bracket(self, pledges_per_pool, costs_per_pool, min_target_desirability,
+                                           calculate_utility)
+
 
 class SimplifiedRSS(RSS):
     def __init__(self, k, a0):
@@ -63,6 +149,17 @@ class SimplifiedRSS(RSS):
             (1 + (self.a0 * pledge_ / self.global_saturation_threshold))
         return r
 
+    def calculate_pool_rewards(self, pool_pledges, pool_stakes):
+        pledges_ = np.minimum(pool_pledges, self.global_saturation_threshold)
+        stakes_ = np.minimum(pool_stakes, self.global_saturation_threshold)
+        r = (TOTAL_EPOCH_REWARDS_R / (1 + self.a0)) * stakes_ * \
+            (1 + (self.a0 * pledges_ / self.global_saturation_threshold))
+        return r
+
+    def get_num_pools_bracket(self, pledges_per_pool, costs_per_pool, min_target_desirability, calculate_utility):
+        return calculate_num_pools_bracket(self, pledges_per_pool, costs_per_pool, min_target_desirability,
+                                           calculate_utility)
+
 
 class FlatPledgeBenefitRSS(RSS):
     def __init__(self, k, a0):
@@ -74,6 +171,16 @@ class FlatPledgeBenefitRSS(RSS):
         r = (TOTAL_EPOCH_REWARDS_R / (1 + self.a0)) * (stake_ + self.a0 * pledge_)
         return r
 
+    def calculate_pool_rewards(self, pool_pledges, pool_stakes):
+        pledges_ = np.minimum(pool_pledges, self.global_saturation_threshold)
+        stakes_ = np.minimum(pool_stakes, self.global_saturation_threshold)
+        r = (TOTAL_EPOCH_REWARDS_R / (1 + self.a0)) * (stakes_ + self.a0 * pledges_)
+        return r
+
+    def get_num_pools_bracket(self, pledges_per_pool, costs_per_pool, min_target_desirability, calculate_utility):
+        return calculate_num_pools_bracket(self, pledges_per_pool, costs_per_pool, min_target_desirability,
+                                           calculate_utility)
+
 
 class CurvePledgeBenefitRSS(RSS):  # CIP-7
     def __init__(self, k, a0, crossover_factor, curve_root):
@@ -81,6 +188,24 @@ class CurvePledgeBenefitRSS(RSS):  # CIP-7
         self.crossover_factor = crossover_factor
         self.curve_root = curve_root
 
+    @property
+    def crossover_factor(self):
+        return self._crossover_factor
+
+    @crossover_factor.setter
+    def crossover_factor(self, crossover_factor_value):
+        self._crossover_factor = crossover_factor_value
+        self.param_version += 1
+
+    @property
+    def curve_root(self):
+        return self._curve_root
+
+    @curve_root.setter
+    def curve_root(self, curve_root_value):
+        self._curve_root = curve_root_value
+        self.param_version += 1
+
     def calculate_pool_reward(self, pool_pledge, pool_stake):
         crossover = self.global_saturation_threshold / self.crossover_factor
         pledge_factor = (pool_pledge ** (1 / self.curve_root)) * (
@@ -92,6 +217,20 @@ class CurvePledgeBenefitRSS(RSS):  # CIP-7
                                             / self.global_saturation_threshold)))
         return r
 
+    def calculate_pool_rewards(self, pool_pledges, pool_stakes):
+        crossover = self.global_saturation_threshold / self.crossover_factor
+        # the powers are calculated with Python's pow for every pledge value, as numpy's implementation may differ in
+        # the last digits from the scalar version
+        pledge_factors = np.array([pledge ** (1 / self.curve_root)
+                                   for pledge in np.ravel(pool_pledges).tolist()]).reshape(np.shape(pool_pledges)) * (
+                crossover ** ((self.curve_root - 1) / self.curve_root))
+        pledges_ = np.minimum(pledge_factors, self.global_saturation_threshold)
+        stakes_ = np.minimum(pool_stakes, self.global_saturation_threshold)
+        r = (TOTAL_EPOCH_REWARDS_R / (1 + self.a0)) * \
+            (stakes_ + (pledges_ * self.a0 * ((stakes_ - pledges_ * (1 - stakes_ / self.global_saturation_threshold))
+                                              / self.global_saturation_threshold)))
+        return r
+
 
 class CIP50RSS(RSS):
     """
@@ -111,10 +250,57 @@ class CIP50RSS(RSS):
         r = TOTAL_EPOCH_REWARDS_R * min(pool_stake, pool_saturation_threshold)
         return r
 
+    def calculate_pool_rewards(self, pool_pledges, pool_stakes):
+        pool_saturation_thresholds = self.get_pool_saturation_thresholds(pool_pledges)
+        r = TOTAL_EPOCH_REWARDS_R * np.minimum(pool_stakes, pool_saturation_thresholds)
+        return r
+
     def get_pool_saturation_threshold(self, pool_pledge):
         custom_saturation_threshold = self.a0 * pool_pledge
         return min(custom_saturation_threshold, self.global_saturation_threshold)
 
+    def get_pool_saturation_thresholds(self, pool_pledges):
+        custom_saturation_thresholds = self.a0 * np.asarray(pool_pledges, dtype=float)
+        return np.minimum(custom_saturation_thresholds, self.global_saturation_threshold)
+
+
+def calculate_num_pools_bracket(reward_scheme, pledges_per_pool, costs_per_pool, min_target_desirability,
+                                calculate_utility):
+    """
+    Bound the utility-maximising number of pools for reward schemes with a global saturation threshold, whose rewards
+    increase with the stake of a pool up to that threshold (CardanoRSS and its variants).
+    Lower bound: as long as the agent's stake suffices to saturate every pool with pledge alone, each pool yields the
+    maximum reward irrespective of the other pools, so the utility keeps increasing with every extra pool (given that
+    it covers its extra cost).
+    Upper bound: a pool that makes it to the top k gets at most its potential profit minus the part of the target
+    desirability that it gives away to its delegators, while any other pool only gets the rewards of its pledge, so
+    pool counts for which t times the best of these can't reach the utility of the lower bound can be ruled out.
+    @return: tuple (t_min, t_max) with the bounds of the pool count that maximises the utility
+    """
+    global_saturation_threshold = reward_scheme.global_saturation_threshold
+    max_num_pools = len(pledges_per_pool)
+    num_pools = np.arange(1, max_num_pools + 1)
+    pledge_only_profits = reward_scheme.calculate_pool_rewards(pool_pledges=pledges_per_pool,
+                                                               pool_stakes=pledges_per_pool) - costs_per_pool
+
+    saturated_pledge_utilities = num_pools * pledge_only_profits
+    t_min = 1
+    while t_min < max_num_pools and pledges_per_pool[t_min] >= global_saturation_threshold and \
+            saturated_pledge_utilities[t_min] - saturated_pledge_utilities[t_min - 1] > BRACKET_TOLERANCE:
+        t_min += 1
+
+    reference_utility = calculate_utility(t_min)
+    potential_profits = reward_scheme.calculate_pool_rewards(
+        pool_pledges=pledges_per_pool, pool_stakes=np.full(max_num_pools, global_saturation_threshold)
+    ) - costs_per_pool
+    max_top_k_utilities = potential_profits - \
+        min_target_desirability * (1 - pledges_per_pool / global_saturation_threshold)
+    max_pool_utilities = np.where(potential_profits >= min_target_desirability,
+                                  np.maximum(max_top_k_utilities, pledge_only_profits), pledge_only_profits)
+    feasible_num_pools = np.flatnonzero(num_pools * max_pool_utilities + BRACKET_TOLERANCE >= reference_utility)
+    t_max = max(t_min, feasible_num_pools[-1] + 1) if len(feasible_num_pools) > 0 else t_min
+    return t_min, int(t_max)
+
 
 RSS_MAPPING = {
     0: CardanoRSS,
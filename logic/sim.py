@@ -5,16 +5,19 @@ import math
 import random
 import pickle as pkl
 import numpy as np
-from sortedcontainers import SortedList
 from mesa import Model
-from mesa.datacollection import DataCollector
 from mesa.time import BaseScheduler, SimultaneousActivation, RandomActivation
 
-from logic.activations import SemiSimultaneousActivation
+from logic.activations import SemiSimultaneousActivation, ParallelSimultaneousActivation, \
+    RegretPrioritizedActivation
+from logic.metrics import MetricsCollector, IncrementalMetrics, COLLECTION_POLICIES
+from logic.population import Population
+from logic.rankings import PoolRankings
 import logic.helper as hlp
 import logic.model_reporters as reporters
 import logic.stakeholder_profiles as profiles
 import logic.reward_schemes as rss
+import logic.caching as caching
 
 
 class Simulation(Model):
@@ -24,7 +27,10 @@ class Simulation(Model):
             absolute_utility_threshold=0, seed=None, pareto_param=2.0, max_iterations=1000, cost_min=1e-5,
             cost_max=1e-4, extra_pool_cost_fraction=0.4, agent_activation_order="random",
             iterations_after_convergence=10, reward_scheme=0, execution_id='', seq_id=-1, parent_dir='',
-            metrics=None, generate_graphs=True, input_from_file=False
+            metrics=None, generate_graphs=True, simultaneous_moves=5, adaptive_simultaneous_moves=False,
+            num_workers=None, cache_size=caching.DEFAULT_CACHE_SIZE, adaptive_cache_size=False,
+            collection_policy='every_step', collection_period=1, exact_pool_count_search=False,
+            min_aggregate_pledge_tolerance=0, input_from_file=False
     ):
         if input_from_file:
             args = hlp.read_args_from_file("args.json")
@@ -68,6 +74,12 @@ class Simulation(Model):
         total_phases = 1
 
         self.reward_scheme = rss.RSS_MAPPING[args['reward_scheme']](-1, -1)
+        # the caches of the helper functions are shared by all simulations, so they get reset for each new one
+        caching.set_cache_size(args['cache_size'])
+        self.reward_scheme.set_cache_size(args['cache_size'])
+        self.adaptive_cache_size = args['adaptive_cache_size']
+        self.exact_pool_count_search = args['exact_pool_count_search']
+        self.min_aggregate_pledge_tolerance = args['min_aggregate_pledge_tolerance']
 
         other_fields = [
             'n', 'k', 'a0', 'relative_utility_threshold', 'absolute_utility_threshold', 'max_iterations',
@@ -95,21 +107,35 @@ class Simulation(Model):
             # to make it possible to end up with the original desired number of pools
             self.reward_scheme.k = self.reward_scheme.k / (1 - args['inactive_stake_fraction'])
 
+        if args['collection_policy'] not in COLLECTION_POLICIES:
+            raise ValueError('Unknown metric collection policy: {}'.format(args['collection_policy']))
+
         self.running = True  # for batch running and visualisation purposes
         agent_activation_orders = {
             "random": RandomActivation,
             "sequential": BaseScheduler,
             "simultaneous": SimultaneousActivation,
             # note that during simultaneous activation agents apply their moves sequentially which may not be the expected behaviour
-            "semisimultaneous": SemiSimultaneousActivation
+            "semisimultaneous": SemiSimultaneousActivation,
+            "parallelsimultaneous": ParallelSimultaneousActivation,
+            "regret": RegretPrioritizedActivation
         }
-        self.schedule = agent_activation_orders[self.agent_activation_order](self)
+        if self.agent_activation_order == "semisimultaneous":
+            self.schedule = SemiSimultaneousActivation(
+                self, simultaneous_moves=args['simultaneous_moves'],
+                adaptive_simultaneous_moves=args['adaptive_simultaneous_moves']
+            )
+        elif self.agent_activation_order == "parallelsimultaneous":
+            self.schedule = ParallelSimultaneousActivation(self, num_workers=args['num_workers'])
+        else:
+            self.schedule = agent_activation_orders[self.agent_activation_order](self)
 
         # Initialize rankings of the system's pools
-        self.pool_rankings = SortedList([None] * (self.reward_scheme.k + 1),
-                                        key=hlp.pool_comparison_key)  # all pools ranked from best to worst non-myopically
-        self.pool_rankings_myopic = SortedList([None] * (self.reward_scheme.k + 1),
-                                               key=self.pool_comparison_key_myopic)  # all pools ranked from best to worst myopically
+        self.pool_rankings = PoolRankings([None] * (self.reward_scheme.k + 1), key=hlp.pool_comparison_key,
+                                          reward_scheme=self.reward_scheme)  # all pools ranked from best to worst non-myopically
+        self.pool_rankings_myopic = PoolRankings([None] * (self.reward_scheme.k + 1),
+                                                 key=self.pool_comparison_key_myopic,
+                                                 reward_scheme=self.reward_scheme)  # all pools ranked from best to worst myopically
 
         total_stake = self.initialize_agents(
             args['agent_profile_distr'], args['cost_min'], args['cost_max'], args['pareto_param'],
@@ -132,6 +158,11 @@ class Simulation(Model):
         self.current_step_idle = True
         self.iterations_after_convergence = args['iterations_after_convergence']
         self.pools = dict()
+        # aggregates of the pools that are updated whenever the pools change, instead of being recalculated every step
+        self.incremental_metrics = IncrementalMetrics()
+        # counter that is increased whenever the pools of the system or the delegations to them change, so that agents
+        # can tell if their best response may have changed since they last calculated it
+        self.state_version = 0
         # self.revision_frequency = 10  # defines how often agents revise their belief about the active stake and expected #pools
         self.initialize_pool_id_seq()  # initialize pool id sequence for the new model run
 
@@ -139,7 +170,12 @@ class Simulation(Model):
         model_reporters = {
             reporters.REPORTER_IDS[reporter_id]: reporters.ALL_MODEL_REPORTEERS[reporters.REPORTER_IDS[reporter_id]] for
             reporter_id in args['metrics']}
-        self.datacollector = DataCollector(model_reporters=model_reporters)
+        # the metrics are written to file in chunks during the run and they are only kept in memory if they are plotted
+        self.datacollector = MetricsCollector(model_reporters=model_reporters, filepath=self.directory / 'metrics.csv',
+                                              keep_history=bool(self.generate_graphs))
+        self.collection_policy = args['collection_policy']
+        self.collection_period = args['collection_period']
+        self.collected_state_version = None  # the state version of the last collected metrics
 
         self.start_time = time.time()
         self.equilibrium_steps = []
@@ -162,8 +198,11 @@ class Simulation(Model):
         # Allocate cost to the agents, sampling from a uniform distribution
         cost_distribution = hlp.generate_cost_distr_unfrm(num_agents=self.n, low=cost_min, high=cost_max, seed=seed)
 
+        self.agents_by_id = dict()  # index of the agents by their id
         agent_profiles = self.random.choices(list(profiles.PROFILE_MAPPING.keys()), k=self.n,
                                              weights=agent_profile_distr)
+        # the stake and cost of the agents are kept in contiguous arrays
+        self.population = Population(stakes=stake_distribution, costs=cost_distribution)
         for i in range(self.n):
             agent_type = profiles.PROFILE_MAPPING[agent_profiles[i]]
             agent = agent_type(
@@ -172,7 +211,9 @@ class Simulation(Model):
                 stake=stake_distribution[i],
                 cost=cost_distribution[i]
             )
+            agent.attach_to_population(self.population)
             self.schedule.add(agent)
+            self.agents_by_id[agent.unique_id] = agent
         return total_stake
 
     def normalize_agent_stake(self, total_stake):
@@ -180,17 +221,7 @@ class Simulation(Model):
         Normalize agent stakes so that the total stake of the system is equal to 1.
         @param total_stake: the total stake of the system prior to normalization (including agent stake and inactive stake)
         """
-        norm_total_stake = 0
-        for agent in self.schedule.agents:
-            agent.stake /= total_stake
-            norm_total_stake += agent.stake
-        if norm_total_stake != 1:
-            # add (or subtract) tiny value from the last agent's stake to account for floating point errors and make
-            # sure that the sum of all agent stakes is equal to 1
-            flt_error = 1 - norm_total_stake
-            agent.stake += flt_error
-            norm_total_stake += flt_error
-        return norm_total_stake
+        return self.population.normalize_stakes(total_stake)
 
     def initialize_pool_id_seq(self):
         self.id_seq = 0
@@ -202,12 +233,22 @@ class Simulation(Model):
     def rewind_pool_id_seq(self, step=1):
         self.id_seq -= step
 
+    def skip_pool_ids(self, num_ids):
+        self.id_seq += num_ids
+
+    def register_state_change(self):
+        """
+        Mark that the state of the system has changed in a way that may affect the agents' decisions
+        (e.g. a pool was opened, closed or updated, some stake was (un)delegated or the reward scheme parameters changed)
+        """
+        self.state_version += 1
+
     def step(self):
         """
         Execute one step of the simulation
         """
         self.get_status()
-        self.datacollector.collect(self)
+        self.collect_metrics()
 
         current_step = self.schedule.steps
         if current_step >= self.max_iterations:
@@ -218,6 +259,8 @@ class Simulation(Model):
 
         # Activate all agents (in the order specified by self.schedule) to perform all their actions for one time step
         self.schedule.step()
+        if self.adaptive_cache_size:
+            caching.adapt_cache_sizes()
         if self.current_step_idle:
             self.consecutive_idle_steps += 1
             if self.has_converged():
@@ -231,6 +274,23 @@ class Simulation(Model):
             self.consecutive_idle_steps = 0
         self.current_step_idle = True
 
+    def collect_metrics(self, final=False):
+        """
+        Collect the metrics of the current step, if the collection policy of the simulation dictates so
+        @param final: whether this is the final step of the simulation, in which case the metrics are collected unless
+            the state of the simulation hasn't changed since they were last collected
+        """
+        state_changed = self.state_version != self.collected_state_version
+        if final or self.collection_policy == 'on_change':
+            collect = state_changed
+        elif self.collection_policy == 'every_n_steps':
+            collect = self.schedule.steps % self.collection_period == 0
+        else:
+            collect = self.collection_policy == 'every_step'
+        if collect:
+            self.datacollector.collect(self, step=self.schedule.steps)
+            self.collected_state_version = self.state_version
+
     def run_model(self):
         """
         Execute multiple steps of the simulation, until it converges or a maximum number of iterations is reached
@@ -238,8 +298,14 @@ class Simulation(Model):
         """
         self.start_time = time.time()
         self.initialize_pool_id_seq()  # initialize pool id sequence for the new model run
-        while self.schedule.steps <= self.max_iterations and self.running:
-            self.step()
+        try:
+            while self.schedule.steps <= self.max_iterations and self.running:
+                self.step()
+        finally:
+            # the worker processes of the scheduler (if any) don't outlive the run, even if it's interrupted (no work is
+            # pending for them at this point, so they can be terminated right away)
+            if isinstance(self.schedule, ParallelSimultaneousActivation):
+                self.schedule.shutdown(terminate=True)
 
     def has_converged(self):
         """
@@ -277,10 +343,12 @@ class Simulation(Model):
              "Pool splitting profit", "Profitable pool splitter"]]
         agents = self.get_agents_dict()
         decimals = 15
+        potential_profits = hlp.calculate_potential_profits(
+            reward_scheme=self.reward_scheme, pledges=self.population.stakes, costs=self.population.costs
+        ).tolist()
         row_list.extend([
             [agent_id, round(agents[agent_id].stake, decimals), round(agents[agent_id].cost, decimals),
-             round(hlp.calculate_potential_profit(reward_scheme=self.reward_scheme, pledge=agents[agent_id].stake,
-                                                  cost=agents[agent_id].cost), decimals),
+             round(potential_profits[agent_id], decimals),
              "Abstainer" if agents[agent_id].strategy is None else "Operator" if len(
                  agents[agent_id].strategy.owned_pools) > 0 else "Delegator",
              0 if agents[agent_id].strategy is None else len(agents[agent_id].strategy.owned_pools),
@@ -314,10 +382,8 @@ class Simulation(Model):
         hlp.export_csv_file(row_list, filepath)
 
     def export_metrics_file(self):
-        df = self.datacollector.get_model_vars_dataframe()
-        filename = 'metrics.csv'
-        filepath = self.directory / filename
-        df.to_csv(filepath, index_label='Round')
+        # most rows have already been written to the file during the run, so only the remaining ones need to be added
+        self.datacollector.flush()
 
     def export_final_state_desc_file(self, filename="final-state-descriptors.json"):
         # generate file that describes the state of the system at termination
@@ -331,6 +397,11 @@ class Simulation(Model):
         filepath = self.directory / filename
         hlp.export_json_file(descriptors, filepath)
 
+    def export_cache_stats_file(self, filename="cache-stats.json"):
+        # generate file that reports how effective the caches of the simulation were
+        filepath = self.directory / filename
+        hlp.export_json_file(reporters.get_cache_stats(self), filepath)
+
     def append_to_experiment_tracker(self, filename='experiment-tracker.csv'):
         filepath = "output/" + filename
         header = [
@@ -363,27 +434,32 @@ class Simulation(Model):
         all_reporter_colours["Total pledge"] = 'purple'
         all_reporter_colours["Nakamoto coefficient"] = 'pink'  # todo maybe remove custom colors
 
-        df = self.datacollector.get_model_vars_dataframe()
-        if len(df) > 0:
-            for col in df.columns:
-                if isinstance(df[col][0], list):
+        if len(self.datacollector) > 0:
+            steps = self.datacollector.get_steps()
+            for col in self.datacollector.names:
+                data = self.datacollector.get_column(col)
+                if isinstance(data[0], list):
                     hlp.plot_stack_area_chart(
-                        pool_sizes_by_step=df[col], execution_id=self.execution_id, path=figures_dir
+                        pool_sizes_by_step=data, execution_id=self.execution_id, path=figures_dir, steps=steps
                     )
-                elif isinstance(df[col][0], dict):
+                elif isinstance(data[0], dict):
                     pass
                 else:
                     hlp.plot_line(
-                        data=df[col], execution_id=self.execution_id, color=all_reporter_colours[col], title=col,
+                        data=data, execution_id=self.execution_id, color=all_reporter_colours[col], title=col,
                         x_label="Round", y_label=col, filename=col, equilibrium_steps=self.equilibrium_steps,
-                        pivot_steps=self.pivot_steps, path=figures_dir, show_equilibrium=True
+                        pivot_steps=self.pivot_steps, path=figures_dir, show_equilibrium=True, steps=steps
                     )
 
     def get_pools_list(self):
         return list(self.pools.values())
 
     def get_agents_dict(self):
-        return {agent.unique_id: agent for agent in self.schedule.agents}
+        """
+        @return: dictionary with all the agents of the simulation, indexed by their id (note that the dictionary is
+            maintained by the simulation, so it must not be modified by the caller)
+        """
+        return self.agents_by_id
 
     def get_agents_list(self):
         return self.schedule.agents
@@ -407,6 +483,7 @@ class Simulation(Model):
         # Revise expected number of pools, k  (note that the value of global_saturation_threshold, which is used to
         # calculate rewards, does not change in this case)
         self.reward_scheme.k = math.ceil(round(active_stake / self.reward_scheme.global_saturation_threshold, 12))  # first rounding to 12 decimal digits to avoid floating point errors
+        self.register_state_change()
         # todo if we keep method then make sure that the change of rss params is properly followed by changes in potential profits etc (see method below)
 
     def change_phase(self):
@@ -422,21 +499,32 @@ class Simulation(Model):
                     instance = self.reward_scheme
                 setattr(instance, key, values[self.current_phase])
                 change_occured = True
-        for pool in self.pools.values():
-            pool.set_profit(reward_scheme=self.reward_scheme)
+        pools = self.get_pools_list()
+        # recalculate the potential profits of all pools at once
+        potential_profits = hlp.calculate_potential_profits(
+            reward_scheme=self.reward_scheme, pledges=np.array([pool.pledge for pool in pools]),
+            costs=np.array([pool.cost for pool in pools])
+        ).tolist()
+        for pool, potential_profit in zip(pools, potential_profits):
+            pool.set_profit(reward_scheme=self.reward_scheme, potential_profit=potential_profit)
             pool.set_desirability()
-            self.pool_rankings.add(pool)
-            self.pool_rankings_myopic.add(pool)
+        self.pool_rankings.update(pools)
+        self.pool_rankings_myopic.update(pools)
         if change_occured:
             self.pivot_steps.append(self.schedule.steps)
+            self.register_state_change()
 
     def wrap_up_execution(self):
         self.running = False
+        if isinstance(self.schedule, ParallelSimultaneousActivation):
+            self.schedule.shutdown()
         print("Execution {} took  {:.2f} seconds to run.".format(self.execution_id, time.time() - self.start_time))
+        self.collect_metrics(final=True)
         self.export_pools_file()
         self.export_agents_file()
         self.export_metrics_file()
         self.export_final_state_desc_file()
+        self.export_cache_stats_file()
         self.append_to_experiment_tracker()
         self.save_model_state_pkl()
         if self.generate_graphs:
@@ -445,10 +533,6 @@ class Simulation(Model):
     def pool_comparison_key_myopic(self, pool):
         if pool is None:
             return 0, 0, 0
-        # sort pools based on their myopic desirability
+        # sort pools based on their myopic desirability (cached in the pool to avoid re-calculating it for every comparison)
         # break ties with pool id
-        current_profit = hlp.calculate_current_profit(
-            pool.stake, pool.pledge, pool.cost, self.reward_scheme
-        )
-        myopic_desirability = hlp.calculate_myopic_pool_desirability(pool.margin, current_profit)
-        return -myopic_desirability, pool.id
+        return -pool.get_myopic_desirability(self.reward_scheme), pool.id
@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
 from mesa import Agent
-from copy import deepcopy
 import heapq
 import math
+import numpy as np
 
 import logic.helper as hlp
 from logic.pool import Pool
@@ -13,14 +13,57 @@ class Stakeholder(Agent):
 
     def __init__(self, unique_id, model, stake, cost, strategy=None):
         super().__init__(unique_id, model)
+        self.population = None  # the array-backed store that holds the agent's stake and cost (if any)
         self.cost = cost  # the cost of running one pool for this agent
         self.stake = stake
         self.new_strategy = None
+        # the version of the model's state at which the agent last decided to keep their current strategy
+        self.idle_state_version = None
+        # the number of pool ids that the agent's (hypothetical) moves used when they made that decision
+        self.idle_num_pool_ids = 0
+        # the pool count terms that were last calculated for the agent, together with the values they depend on
+        self._pool_count_terms = None
         if strategy is None:
             # Initialize strategy to an "empty" strategy
             strategy = Strategy()
         self.strategy = strategy
 
+    @property
+    def stake(self):
+        if self.population is None:
+            return self._stake
+        return float(self.population.stakes[self.unique_id])
+
+    @stake.setter
+    def stake(self, s):
+        if self.population is None:
+            self._stake = s
+        else:
+            self.population.stakes[self.unique_id] = s
+
+    @property
+    def cost(self):
+        if self.population is None:
+            return self._cost
+        return float(self.population.costs[self.unique_id])
+
+    @cost.setter
+    def cost(self, c):
+        if self.population is None:
+            self._cost = c
+        else:
+            self.population.costs[self.unique_id] = c
+
+    def attach_to_population(self, population):
+        """
+        Store the agent's stake and cost in the given population from now on (in the position that corresponds to the
+        agent's id), instead of in the agent object itself.
+        @param population: a Population object
+        """
+        stake, cost = self.stake, self.cost
+        self.population = population
+        self.stake, self.cost = stake, cost
+
     def calculate_operator_utility_from_strategy(self, strategy):
         raise NotImplementedError(
             "Stakeholder subclass must implement 'calculate_operator_utility_from_strategy' method."
@@ -36,6 +79,27 @@ class Stakeholder(Agent):
             "Stakeholder subclass must implement 'calculate_margins_and_utility' method."
         )
 
+    def get_num_pools_bracket(self):
+        """
+        Determine a range of pool counts that is guaranteed to contain the one that maximises the agent's utility.
+        Stakeholder subclasses can implement this when the reward scheme allows it (see RSS.get_num_pools_bracket),
+        otherwise the best number of pools is found by searching over all pool counts from 1 to k.
+        @return: tuple (t_min, t_max) with the minimum and maximum number of pools to consider, or None if not supported
+        """
+        return None
+
+    def get_utility_calculator(self, max_num_pools):
+        """
+        Prepare the calculation of the utility that the agent would get from operating different numbers of pools, so
+        that the utility of several numbers of pools can be calculated in one go. Stakeholder subclasses can optionally
+        implement this method with a vectorised version of calculate_margins_and_utility, otherwise the utility is
+        calculated separately for every number of pools that is considered.
+        @param max_num_pools: the maximum number of pools to consider
+        @return: function that takes a sequence of pool counts (up to max_num_pools) and returns a numpy array with the
+            utility of operating each of them, or None if not supported
+        """
+        return None
+
     def step(self):
         self.update_strategy()
         if "simultaneous" not in self.model.agent_activation_order.lower():
@@ -51,6 +115,15 @@ class Stakeholder(Agent):
             self.model.current_step_idle = False
 
     def update_strategy(self):
+        state_version = self.model.state_version
+        if self.idle_state_version == state_version:
+            # nothing that the agent's best response depends on has changed since they last decided to keep their
+            # current strategy, so they would reach the same decision again (the pool ids that their hypothetical
+            # moves would use are still skipped, so that all pools get the same ids as when the decision is made anew)
+            self.new_strategy = None
+            self.model.skip_pool_ids(self.idle_num_pool_ids)
+            return
+        id_seq = self.model.id_seq
         current_utility = self.calculate_current_utility()
         current_move_expected_utility = self.calculate_expected_utility(self.strategy)
         augmented_current_move_utility = max(
@@ -76,6 +149,9 @@ class Stakeholder(Agent):
         # them earlier so that the "easiest" move is preferred ( current -> delegator -> operator)
         max_utility_option = max(possible_moves, key=lambda key: possible_moves[key][0])
         self.new_strategy = None if max_utility_option == "current" else possible_moves[max_utility_option][1]
+        if self.new_strategy is None:
+            self.idle_state_version = state_version
+            self.idle_num_pool_ids = self.model.id_seq - id_seq
 
     def discard_draft_pools(self, operator_strategy):  # unused for now
         # Discard the pool ids that were used for the hypothetical operator move
@@ -126,37 +202,87 @@ class Stakeholder(Agent):
             - If none of the neighbours have higher utility,
                 then solution found (strategy with t pools and calculated margins)
         This works because the utility of an agent as a function of the number of pools to operate has only one local max
+        The utility curve may have more than one local max though, in which case the search can stop at any of them. If
+        the model's exact_pool_count_search option is enabled, then the search is replaced by picking the best pool
+        count overall, among the ones that can maximise the agent's utility according to the reward scheme (see
+        get_num_pools_bracket) or among all pool counts from 1 to k if the reward scheme doesn't narrow them down.
         @return: a tuple with the utility of the chosen strategy and the strategy itself
         """
+        if self.model.exact_pool_count_search:
+            num_pools_bracket = self.get_num_pools_bracket()
+            if num_pools_bracket is None:
+                num_pools_bracket = 1, self.model.reward_scheme.k
+            num_pools = self.find_best_num_pools(*num_pools_bracket)
+        else:
+            num_pools = self.search_num_pools()
+        margins, _ = self.calculate_margins_and_utility(num_pools=num_pools)
+        utility = 0
+        strategy = None
+        if num_pools > 0:
+            owned_pools_copies = self.determine_pools_to_keep(num_pools)
+            strategy = self.find_operator_move(num_pools, owned_pools_copies, margins)
+            utility = self.calculate_expected_utility(
+                strategy)  # recalculating utility to account for possible delegations
+        return utility, strategy
+
+    def search_num_pools(self):
+        """
+        Search for the number of pools that maximises the agent's utility (as described in choose_pool_strategy)
+        @return: the number of pools to operate
+        """
         t_min = 1
         t_max = self.model.reward_scheme.k
         solution_found = False
 
+        utilities = {}
+        calculate_utilities = self.get_utility_calculator(max_num_pools=t_max)
+        if calculate_utilities is not None:
+            # the utilities of a number of pools and its neighbours are calculated in one go, together with the ones of
+            # the numbers of pools that the search may probe next (whichever direction it takes)
+            def calculate_utility(num_pools):
+                if num_pools not in utilities:
+                    num_pools_to_calculate = set()
+                    next_probes = math.floor((t_min + num_pools - 1) / 2), math.floor((num_pools + 1 + t_max) / 2)
+                    for t in (num_pools, *next_probes):
+                        num_pools_to_calculate.update(range(max(t - 1, t_min), min(t + 1, t_max) + 1))
+                    num_pools_to_calculate = sorted(num_pools_to_calculate.difference(utilities))
+                    utilities.update(zip(num_pools_to_calculate, calculate_utilities(num_pools_to_calculate)))
+                return utilities[num_pools]
+        else:
+            def calculate_utility(num_pools):
+                return self.calculate_margins_and_utility(num_pools=num_pools)[1]
+
         while not solution_found:
             t = math.floor((t_min + t_max) / 2)
-            margins_t, utility_t = self.calculate_margins_and_utility(num_pools=t)
+            utility_t = calculate_utility(t)
             if t > t_min:
-                margins_t_minus, utility_t_minus = self.calculate_margins_and_utility(num_pools=t - 1)
+                utility_t_minus = calculate_utility(t - 1)
                 if utility_t_minus > utility_t:
                     t_max = t - 1
                     continue
             if t < t_max:
-                margins_t_plus, utility_t_plus = self.calculate_margins_and_utility(num_pools=t + 1)
+                utility_t_plus = calculate_utility(t + 1)
                 if utility_t_plus > utility_t:
                     t_min = t + 1
                     continue  # checking only one of them suffices under the assumption that the function has one local max and is otherwise monotonincally increasing/decreasing
             # none of the neighbours has higher utility (or there are no feasible neighbours), so we are at the local max
             solution_found = True
+        return t
 
-        num_pools, margins = t, margins_t
-        utility = 0
-        strategy = None
-        if num_pools > 0:
-            owned_pools_copies = self.determine_pools_to_keep(num_pools)
-            strategy = self.find_operator_move(num_pools, owned_pools_copies, margins)
-            utility = self.calculate_expected_utility(
-                strategy)  # recalculating utility to account for possible delegations
-        return utility, strategy
+    def find_best_num_pools(self, t_min, t_max):
+        """
+        Find the number of pools that maximises the agent's utility, among a range of pool counts that is known to
+        contain it (in case of ties, the smallest number of pools is preferred)
+        @param t_min: the minimum number of pools to consider
+        @param t_max: the maximum number of pools to consider
+        @return: the number of pools to operate
+        """
+        calculate_utilities = self.get_utility_calculator(max_num_pools=t_max)
+        if calculate_utilities is not None:
+            utilities = calculate_utilities(range(t_min, t_max + 1))
+        else:
+            utilities = [self.calculate_margins_and_utility(num_pools=t)[1] for t in range(t_min, t_max + 1)]
+        return t_min + int(np.argmax(utilities))
 
     def calculate_margin(self, pool):
         """
@@ -182,9 +308,9 @@ class Stakeholder(Agent):
                                self.strategy.owned_pools.items()]
             top_pools_ids = {-p[3] for p in heapq.nlargest(num_pools_to_keep, pool_properties)}
             for pool_id in top_pools_ids:
-                owned_pools_to_keep[pool_id] = deepcopy(self.strategy.owned_pools[pool_id])
+                owned_pools_to_keep[pool_id] = self.strategy.owned_pools[pool_id].draft()
         else:
-            owned_pools_to_keep = deepcopy(self.strategy.owned_pools)
+            owned_pools_to_keep = {pool_id: pool.draft() for pool_id, pool in self.strategy.owned_pools.items()}
         return owned_pools_to_keep
 
     def calculate_cost_per_pool(self, num_pools):
@@ -200,6 +326,32 @@ class Stakeholder(Agent):
         return hlp.calculate_cost_per_pool(num_pools=num_pools, initial_cost=self.cost,
                                            extra_pool_cost_fraction=self.model.extra_pool_cost_fraction)
 
+    def get_pool_count_terms(self, max_num_pools):
+        """
+        Calculate the terms that determine the utility of the agent for operating 1, 2, ..., max_num_pools pools,
+        to be used in vectorised utility calculations.
+        @param max_num_pools: the maximum number of pools to consider
+        @return: tuple of numpy arrays with the cost per pool, the pledge per pool, the saturation threshold of each
+            pool and the reward that each pool would get at saturation, for every number of pools (t in position t - 1)
+        """
+        reward_scheme = self.model.reward_scheme
+        # the terms for t pools don't depend on max_num_pools, so they are reused (as long as the values that they
+        # depend on stay the same) for any number of pools up to the maximum that they were calculated for
+        terms_key = (self.stake, self.cost, self.model.extra_pool_cost_fraction, reward_scheme.param_version)
+        if self._pool_count_terms is None or self._pool_count_terms[0] != terms_key or \
+                len(self._pool_count_terms[1][0]) < max_num_pools:
+            costs_per_pool = np.array([self.calculate_cost_per_pool(num_pools=t) for t in range(1, max_num_pools + 1)])
+            pledges_per_pool = np.array(
+                [self.determine_pledge_per_pool(num_pools=t) for t in range(1, max_num_pools + 1)]
+            )
+            saturation_thresholds = reward_scheme.get_pool_saturation_thresholds(pledges_per_pool)
+            saturated_pool_rewards = reward_scheme.calculate_pool_rewards(
+                pool_pledges=pledges_per_pool, pool_stakes=saturation_thresholds
+            )
+            self._pool_count_terms = \
+                terms_key, (costs_per_pool, pledges_per_pool, saturation_thresholds, saturated_pool_rewards)
+        return tuple(term[:max_num_pools] for term in self._pool_count_terms[1])
+
     def determine_pledge_per_pool(self, num_pools):
         #  todo maybe better to return list of pledge values to accommodate potential method overrides that allocate
         #   a different pledge value to each pool
@@ -256,7 +408,6 @@ class Stakeholder(Agent):
         :stake_to_delegate: the amount of stake to delegate
         :return: a dictionary with delegation allocations {pool_id: stake_to_delegate_to_pool}
         """
-        all_pools_dict = self.model.pools
         eligible_pools_ranked = [
             pool
             for pool in self.rankings
@@ -266,20 +417,13 @@ class Stakeholder(Agent):
         if len(eligible_pools_ranked) == 0:
             return None
 
-        # Remove the agent's stake from the pools in case it's being delegated
-        for pool_id, allocation in self.strategy.stake_allocations.items():
-            pool = all_pools_dict[pool_id]
-            self.model.pool_rankings_myopic.remove(pool)
-            pool.update_delegation(new_delegation=0, delegator_id=self.unique_id)
-            self.model.pool_rankings_myopic.add(pool)
-
         allocations = dict()
         best_saturated_pool = None
         while len(eligible_pools_ranked) > 0:
             # first attempt to delegate to unsaturated pools
             best_pool = eligible_pools_ranked.pop(0)
             saturation_threshold = self.model.reward_scheme.get_pool_saturation_threshold(best_pool.pledge)
-            stake_to_saturation = saturation_threshold - best_pool.stake
+            stake_to_saturation = saturation_threshold - self.calculate_pool_stake_without_own(best_pool)
             if stake_to_saturation < hlp.MIN_STAKE_UNIT:
                 if best_saturated_pool is None:
                     best_saturated_pool = best_pool
@@ -293,15 +437,19 @@ class Stakeholder(Agent):
             #  if the stake to delegate does not fit in unsaturated pools, delegate to the saturated one with the
             #  highest desirability
             allocations[best_saturated_pool.id] = stake_to_delegate
-
-        # Return the agent's stake to the pools it was delegated to
-        for pool_id, allocation in self.strategy.stake_allocations.items():
-            pool = all_pools_dict[pool_id]
-            self.model.pool_rankings_myopic.remove(pool)
-            pool.update_delegation(new_delegation=allocation, delegator_id=self.unique_id)
-            self.model.pool_rankings_myopic.add(pool)
         return allocations
 
+    def calculate_pool_stake_without_own(self, pool):
+        """
+        Calculate the stake that a pool would have if the agent withdrew their delegation from it, without modifying
+        the pool (so that hypothetical moves can be evaluated without touching the shared state of the system)
+        @param pool: the pool in question
+        @return: the stake of the pool minus the stake that the agent currently delegates to it
+        """
+        if self.unique_id in pool.delegators:
+            return pool.stake - pool.delegators[self.unique_id]
+        return pool.stake
+
     def find_delegation_move(self, stake_to_delegate=None):
         if stake_to_delegate is None:
             stake_to_delegate = self.stake
@@ -326,6 +474,7 @@ class Stakeholder(Agent):
                 self.model.pool_rankings_myopic.remove(pool)
                 pool.update_delegation(new_delegation=0, delegator_id=self.unique_id)
                 self.model.pool_rankings_myopic.add(pool)
+                self.model.incremental_metrics.update_pool(pool)
         for pool_id in new_allocations.keys():
             pool = current_pools[pool_id]
             if pool is not None:
@@ -333,6 +482,7 @@ class Stakeholder(Agent):
                 self.model.pool_rankings_myopic.remove(pool)
                 pool.update_delegation(new_delegation=new_allocations[pool_id], delegator_id=self.unique_id)
                 self.model.pool_rankings_myopic.add(pool)
+                self.model.incremental_metrics.update_pool(pool)
 
         old_owned_pools = set(self.strategy.owned_pools.keys())
         new_owned_pools = set(self.new_strategy.owned_pools.keys())
@@ -348,6 +498,8 @@ class Stakeholder(Agent):
         self.new_strategy = None
         for pool_id in new_owned_pools - old_owned_pools:
             self.open_pool(pool_id)
+        # the delegations of the agent have (potentially) changed too
+        self.model.register_state_change()
 
     def update_pool(self, pool_id):
         updated_pool = self.new_strategy.owned_pools[pool_id]
@@ -361,6 +513,8 @@ class Stakeholder(Agent):
         self.model.pool_rankings.add(updated_pool)
         self.model.pool_rankings_myopic.remove(old_pool)
         self.model.pool_rankings_myopic.add(updated_pool)
+        self.model.incremental_metrics.update_pool(updated_pool)
+        self.model.register_state_change()
         return updated_pool
 
     def open_pool(self, pool_id):
@@ -369,6 +523,8 @@ class Stakeholder(Agent):
         # include in pool rankings
         self.model.pool_rankings.add(pool)
         self.model.pool_rankings_myopic.add(pool)
+        self.model.incremental_metrics.add_pool(pool)
+        self.model.register_state_change()
 
     def close_pool(self, pool_id):
         pools = self.model.pools
@@ -376,9 +532,11 @@ class Stakeholder(Agent):
         # remove from top k desirabilities
         self.model.pool_rankings.remove(pool)
         self.model.pool_rankings_myopic.remove(pool)
+        self.model.incremental_metrics.remove_pool(pool)
         # Undelegate delegators' stake
         self.remove_delegations(pool)
         pools.pop(pool_id)
+        self.model.register_state_change()
 
     def remove_delegations(self, pool):
         agents = self.model.get_agents_dict()
@@ -387,6 +545,7 @@ class Stakeholder(Agent):
             agent = agents[agent_id]
             agent.strategy.stake_allocations.pop(pool.id)
             pool.update_delegation(new_delegation=0, delegator_id=agent_id)
+        self.model.register_state_change()
 
         # Also remove pool from agents' upcoming moves in case of (semi)simultaneous activation
         if "simultaneous" in self.model.agent_activation_order.lower():
@@ -1,7 +1,8 @@
+import numpy as np
+
 from logic.stakeholder import Stakeholder
 import logic.helper as hlp
-
-from sortedcontainers import SortedList
+from logic.rankings import RankingsOverlay
 
 
 class NonMyopicStakeholder(Stakeholder):
@@ -11,10 +12,8 @@ class NonMyopicStakeholder(Stakeholder):
 
     def calculate_operator_utility_from_strategy(self, strategy):
         potential_pools = strategy.owned_pools.values()
-        temp_rankings = SortedList(
-            [pool for pool in self.rankings if pool is not None and pool.owner != self.unique_id],
-            key=hlp.pool_comparison_key)
-        temp_rankings.update(potential_pools)
+        # rank the potential pools against the pools of the other agents, without copying the rankings of the system
+        temp_rankings = RankingsOverlay(self.rankings, excluded_owner=self.unique_id, extra_pools=potential_pools)
 
         utility = 0
         for pool in potential_pools:
@@ -63,11 +62,9 @@ class NonMyopicStakeholder(Stakeholder):
         margins = []  # note that pools by the same agent may end up with different margins  because of the different pools they aim to outperform
         utility = 0
 
-        fixed_pools_ranked = [
-            pool
-            for pool in self.rankings
-            if pool is None or pool.owner != self.unique_id
-        ]
+        # the pools of the other agents, ranked from best to worst (accessing a pool by rank skips the agent's own pools
+        # in logarithmic time, instead of filtering the whole rankings for every probe of the number of pools)
+        fixed_pools_ranked = RankingsOverlay(self.rankings, excluded_owner=self.unique_id)
 
         for t in range(1, num_pools + 1):
             target_pool = fixed_pools_ranked[
@@ -95,6 +92,69 @@ class NonMyopicStakeholder(Stakeholder):
                 )
         return margins, utility
 
+    def get_num_pools_bracket(self):
+        reward_scheme = self.model.reward_scheme
+        k = reward_scheme.k
+        costs_per_pool, pledges_per_pool, _, _ = self.get_pool_count_terms(k)
+        # the k-th best pool of the other agents is the easiest one to outperform in order to enter the top k
+        target_pool = RankingsOverlay(self.rankings, excluded_owner=self.unique_id)[k - 1]
+        return reward_scheme.get_num_pools_bracket(
+            pledges_per_pool=pledges_per_pool, costs_per_pool=costs_per_pool,
+            min_target_desirability=target_pool.desirability if target_pool is not None else 0,
+            calculate_utility=lambda num_pools: self.calculate_margins_and_utility(num_pools=num_pools)[1]
+        )
+
+    def get_utility_calculator(self, max_num_pools):
+        """
+        Vectorised version of calculate_margins_and_utility, that yields the same utility values for any numbers of
+        pools up to max_num_pools. The terms that don't depend on the number of pools are calculated once, so that each
+        call of the returned function only needs one row per requested number of pools. Row j of the arrays used there
+        corresponds to operating the j-th requested number of pools, t, and column i - 1 corresponds to the i-th pool of
+        the agent (which aims to surpass the (k - i)-th pool of the others), where only the first t columns count.
+        """
+        reward_scheme = self.model.reward_scheme
+        costs_per_pool, pledges_per_pool, saturation_thresholds, saturated_pool_rewards = \
+            self.get_pool_count_terms(max_num_pools)
+        potential_profits_per_pool = saturated_pool_rewards - costs_per_pool
+        # utility of a pool that can't reach the target desirability, in which case it only gets the pledge as stake
+        pledge_only_utilities = hlp.calculate_operator_rewards_from_pools(
+            pool_margins=0, pool_costs=costs_per_pool,
+            pool_rewards=reward_scheme.calculate_pool_rewards(pool_pledges=pledges_per_pool, pool_stakes=pledges_per_pool),
+            operator_stake_fractions=np.ones_like(pledges_per_pool)
+        )
+        operator_stake_fractions = pledges_per_pool / saturation_thresholds
+
+        boost = 1e-6  # to ensure that the new desirability will be higher than the target one
+        k = reward_scheme.k
+        fixed_pools_ranked = RankingsOverlay(self.rankings, excluded_owner=self.unique_id)
+        target_pools = fixed_pools_ranked[k - max_num_pools:k][::-1]
+        target_desirabilities = np.array([pool.desirability if pool is not None else 0 for pool in target_pools]) \
+            + boost
+        target_potential_profits = np.array([pool.potential_profit if pool is not None else 0 for pool in target_pools])
+        max_target_desirabilities = np.maximum(target_desirabilities, target_potential_profits)
+
+        def calculate_utilities(num_pools):
+            rows = np.asarray(num_pools) - 1
+            num_columns = rows.max() + 1
+            potential_profits = potential_profits_per_pool[rows, np.newaxis]
+            margins = hlp.calculate_suitable_margins(
+                potential_profits=potential_profits, target_desirabilities=max_target_desirabilities[:num_columns]
+            )
+            utilities = np.where(
+                potential_profits < target_desirabilities[:num_columns],
+                pledge_only_utilities[rows, np.newaxis],
+                hlp.calculate_operator_rewards_from_pools(
+                    pool_margins=margins, pool_costs=costs_per_pool[rows, np.newaxis],
+                    pool_rewards=saturated_pool_rewards[rows, np.newaxis],
+                    operator_stake_fractions=operator_stake_fractions[rows, np.newaxis]
+                )
+            )
+            # the utility of operating t pools is the sum of the utilities of the first t pools (summed sequentially,
+            # like in calculate_margins_and_utility, so that the results are identical)
+            return np.cumsum(utilities, axis=1)[np.arange(len(rows)), rows]
+
+        return calculate_utilities
+
 
 class MyopicStakeholder(Stakeholder):
     def __init__(self, unique_id, model, stake, cost, strategy=None):
@@ -134,23 +194,15 @@ class MyopicStakeholder(Stakeholder):
         margins = []  # note that pools by the same agent may end up with different margins  because of the different pools they aim to outperform
         utility = 0
 
-        fixed_pools_ranked = [
-            pool
-            for pool in self.rankings
-            if pool is None or pool.owner != self.unique_id
-        ]
+        # the pools of the other agents, ranked from best to worst (accessing a pool by rank skips the agent's own pools
+        # in logarithmic time, instead of filtering the whole rankings for every probe of the number of pools)
+        fixed_pools_ranked = RankingsOverlay(self.rankings, excluded_owner=self.unique_id)
 
         for t in range(1, num_pools + 1):
             target_pool = fixed_pools_ranked[
                 self.model.reward_scheme.k - t]  # todo remove dependency from k to accommodate broader class of reward schemes
-            if target_pool is None:
-                target_desirability = 0
-            else:
-                target_pool_current_profit = hlp.calculate_current_profit(
-                    target_pool.stake, target_pool.pledge, target_pool.cost, self.model.reward_scheme
-                )
-                target_desirability = hlp.calculate_myopic_pool_desirability(target_pool.margin,
-                                                                             target_pool_current_profit)
+            target_desirability = target_pool.get_myopic_desirability(self.model.reward_scheme) \
+                if target_pool is not None else 0
             target_desirability += boost
 
             margins.append(
@@ -164,6 +216,46 @@ class MyopicStakeholder(Stakeholder):
             )
         return margins, utility
 
+    def get_utility_calculator(self, max_num_pools):
+        """
+        Vectorised version of calculate_margins_and_utility, that yields the same utility values for any numbers of
+        pools up to max_num_pools (see NonMyopicStakeholder.get_utility_calculator).
+        """
+        reward_scheme = self.model.reward_scheme
+        costs_per_pool, pledges_per_pool, saturation_thresholds, saturated_pool_rewards = \
+            self.get_pool_count_terms(max_num_pools)
+
+        agent_total_delegated_stake = max(sum([pool.stake for pool in self.strategy.owned_pools.values()]), self.stake)
+        expected_stakes_per_pool = agent_total_delegated_stake / np.arange(1, max_num_pools + 1)
+        profits_per_pool = reward_scheme.calculate_pool_rewards(
+            pool_pledges=pledges_per_pool, pool_stakes=expected_stakes_per_pool
+        ) - costs_per_pool
+        operator_stake_fractions = pledges_per_pool / saturation_thresholds
+
+        boost = 1e-6  # to ensure that the new desirability will be higher than the target one
+        k = reward_scheme.k
+        fixed_pools_ranked = RankingsOverlay(self.rankings, excluded_owner=self.unique_id)
+        target_pools = fixed_pools_ranked[k - max_num_pools:k][::-1]
+        target_desirabilities = np.array([
+            pool.get_myopic_desirability(reward_scheme) if pool is not None else 0 for pool in target_pools
+        ]) + boost
+
+        def calculate_utilities(num_pools):
+            rows = np.asarray(num_pools) - 1
+            num_columns = rows.max() + 1
+            margins = hlp.calculate_suitable_margins(
+                potential_profits=profits_per_pool[rows, np.newaxis],
+                target_desirabilities=target_desirabilities[:num_columns]
+            )
+            utilities = hlp.calculate_operator_rewards_from_pools(
+                pool_margins=margins, pool_costs=costs_per_pool[rows, np.newaxis],
+                pool_rewards=saturated_pool_rewards[rows, np.newaxis],
+                operator_stake_fractions=operator_stake_fractions[rows, np.newaxis]
+            )
+            return np.cumsum(utilities, axis=1)[np.arange(len(rows)), rows]
+
+        return calculate_utilities
+
 
 class Abstainer(Stakeholder):
     def __init__(self, unique_id, model, stake, cost, strategy=None):
@@ -36,6 +36,15 @@ def main():
         # parent_dir
         metrics=args.metrics,
         generate_graphs=args.generate_graphs,
+        simultaneous_moves=args.simultaneous_moves,
+        adaptive_simultaneous_moves=args.adaptive_simultaneous_moves,
+        num_workers=args.num_workers,
+        cache_size=args.cache_size,
+        adaptive_cache_size=args.adaptive_cache_size,
+        collection_policy=args.collection_policy,
+        collection_period=args.collection_period,
+        exact_pool_count_search=args.exact_pool_count_search,
+        min_aggregate_pledge_tolerance=args.min_aggregate_pledge_tolerance,
         input_from_file=args.input_from_file
     )
 
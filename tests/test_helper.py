@@ -1,6 +1,8 @@
 import random
 
+import numpy as np
 import pytest
+import logic.caching as caching
 import logic.helper as hlp
 import logic.reward_schemes as rss
 
@@ -239,15 +241,44 @@ def test_calculate_non_myopic_pool_stake():
 
 
 # todo update test
-def test_read_stake_distr_from_file():
+def test_read_stake_distr_from_file(tmp_path, monkeypatch):
+    filename = tmp_path / 'stake-distribution.csv'
+    stake_values = [0.5, 0.25, 0.125, 0.0625, 0.0625]
+    with open(filename, 'w') as file:
+        file.write('\n'.join(str(value) for value in stake_values) + '\n')
+
     # case 1: file exists and n == rows
-    assert True
+    stk_distr = hlp.read_stake_distr_from_file(filename=filename, num_agents=5)
+    assert list(stk_distr) == stake_values
+    cached_files = list((tmp_path / hlp.STAKE_DISTR_CACHE_DIR).glob('*.npy'))
+    assert len(cached_files) == 1
+    # the second time the values are loaded from the converted file
+    stk_distr = hlp.read_stake_distr_from_file(filename=filename, num_agents=5)
+    assert isinstance(stk_distr, np.memmap)
+    assert list(stk_distr) == stake_values
+    # the returned array can be changed without affecting the converted file
+    stk_distr[0] = 0.1
+    assert list(hlp.read_stake_distr_from_file(filename=filename, num_agents=5)) == stake_values
 
     # case 2: file exists and n < rows
-    assert True
+    stk_distr = hlp.read_stake_distr_from_file(filename=filename, num_agents=3)
+    assert len(stk_distr) == 3
+    assert all(value in stake_values for value in stk_distr)
 
     # case 3: file exists and n > rows
-    assert True
+    stk_distr = hlp.read_stake_distr_from_file(filename=filename, num_agents=8)
+    assert len(stk_distr) == 8
+    assert all(value in stake_values for value in stk_distr)
+
+    # the file is not hashed again while its size and modification time stay the same
+    with monkeypatch.context() as m:
+        m.setattr(hlp.hashlib, 'sha256', None)
+        assert list(hlp.read_stake_distr_from_file(filename=filename, num_agents=5)) == stake_values
+
+    # changing the file invalidates the converted one
+    with open(filename, 'w') as file:
+        file.write('0.75\n0.25\n')
+    assert list(hlp.read_stake_distr_from_file(filename=filename, num_agents=2)) == [0.75, 0.25]
 
     # case 4: file does not exist
     filename = 'fake-filename'
@@ -285,3 +316,85 @@ def test_find_target_pool():
     target_pool = hlp.find_target_pool(pools, target_stake, reward_scheme)
 
     assert pools.index(target_pool) == 13
+
+
+@pytest.mark.parametrize('reward_scheme', [
+    rss.CardanoRSS(k=10, a0=0.3),
+    rss.SimplifiedRSS(k=10, a0=0.3),
+    rss.FlatPledgeBenefitRSS(k=10, a0=0.3),
+    rss.CurvePledgeBenefitRSS(k=10, a0=0.3, crossover_factor=8, curve_root=3),
+    rss.CIP50RSS(k=10, a0=50)
+])
+def test_vectorised_reward_scheme_methods(reward_scheme):
+    rng = random.Random(24)
+    pledges = [rng.uniform(0, 0.01) for _ in range(200)]
+    stakes = [pledge + rng.uniform(0, 0.2) for pledge in pledges]
+    costs = [rng.uniform(0, 0.001) for _ in range(200)]
+
+    rewards = reward_scheme.calculate_pool_rewards(pool_pledges=pledges, pool_stakes=stakes).tolist()
+    thresholds = reward_scheme.get_pool_saturation_thresholds(pledges).tolist()
+    potential_profits = hlp.calculate_potential_profits(reward_scheme=reward_scheme, pledges=np.array(pledges),
+                                                        costs=np.array(costs)).tolist()
+    for i in range(200):
+        assert rewards[i] == reward_scheme.calculate_pool_reward(pool_pledge=pledges[i], pool_stake=stakes[i])
+        assert thresholds[i] == reward_scheme.get_pool_saturation_threshold(pledges[i])
+        assert potential_profits[i] == hlp.calculate_potential_profit(reward_scheme=reward_scheme, pledge=pledges[i],
+                                                                      cost=costs[i])
+
+
+def test_potential_profit_cache():
+    reward_scheme = rss.CardanoRSS(k=10, a0=0.3)
+    profit = hlp.calculate_potential_profit(reward_scheme=reward_scheme, pledge=0.001, cost=0.0001)
+    assert hlp.calculate_potential_profit(reward_scheme=reward_scheme, pledge=0.001, cost=0.0001) == profit
+    assert reward_scheme.potential_profit_cache.get_stats()['hits'] == 1
+    assert reward_scheme.potential_profit_cache.get_stats()['misses'] == 1
+
+    # changing a parameter of the reward scheme invalidates the cached values
+    version = reward_scheme.param_version
+    reward_scheme.a0 = 0.5
+    assert reward_scheme.param_version != version
+    assert hlp.calculate_potential_profit(reward_scheme=reward_scheme, pledge=0.001, cost=0.0001) == \
+           rss.CardanoRSS(k=10, a0=0.5).calculate_pool_reward(pool_pledge=0.001, pool_stake=0.1) - 0.0001
+    assert reward_scheme.potential_profit_cache.get_stats()['misses'] == 2
+
+    reward_scheme.potential_profit_cache.maxsize = 5
+    for i in range(10):
+        hlp.calculate_potential_profit(reward_scheme=reward_scheme, pledge=0.001 * i, cost=0.0001)
+    assert len(reward_scheme.potential_profit_cache) == 5
+
+
+def test_cache_registry():
+    assert 'calculate_cost_per_pool' in caching.CACHE_REGISTRY
+    caching.set_cache_size(2)
+    for num_pools in range(1, 6):
+        hlp.calculate_cost_per_pool(num_pools=num_pools, initial_cost=0.001, extra_pool_cost_fraction=0.4)
+    hlp.calculate_cost_per_pool(num_pools=5, initial_cost=0.001, extra_pool_cost_fraction=0.4)
+    stats = caching.get_cache_stats()['calculate_cost_per_pool']
+    assert (stats['hits'], stats['misses'], stats['evictions'], stats['size']) == (1, 5, 3, 2)
+
+    # the statistics are kept when a cache gets resized
+    caching.CACHE_REGISTRY['calculate_cost_per_pool'].resize(0)
+    assert not hasattr(hlp.calculate_cost_per_pool, 'cache_info')
+    assert hlp.calculate_cost_per_pool(num_pools=2, initial_cost=0.001, extra_pool_cost_fraction=0.4) == \
+           (0.001 + 0.4 * 0.001) / 2
+    assert caching.get_cache_stats()['calculate_cost_per_pool']['misses'] == 5
+
+    caching.set_cache_size(caching.DEFAULT_CACHE_SIZE)
+    assert caching.get_cache_stats()['calculate_cost_per_pool']['misses'] == 0
+    assert hlp.calculate_cost_per_pool.cache_info().maxsize == caching.DEFAULT_CACHE_SIZE
+
+
+def test_generate_stake_distr_pareto_truncated():
+    stk_distr = hlp.generate_stake_distr_pareto(num_agents=1000, pareto_param=1.5, seed=42, truncation_factor=100)
+    assert len(stk_distr) == 1000
+    assert max(stk_distr) <= sum(stk_distr) / 100
+    assert stk_distr == hlp.generate_stake_distr_pareto(num_agents=1000, pareto_param=1.5, seed=42,
+                                                        truncation_factor=100)
+
+    # same result as removing the largest value and drawing a new one, until the largest value is small enough
+    rng = np.random.default_rng(seed=42)
+    expected_distr = list(rng.pareto(1.5, 1000) + 1)
+    while max(expected_distr) > sum(expected_distr) / 100:
+        expected_distr.remove(max(expected_distr))
+        expected_distr.append(rng.pareto(1.5) + 1)
+    assert stk_distr == expected_distr
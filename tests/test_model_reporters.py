@@ -1,3 +1,8 @@
+import collections
+import itertools
+import random
+from fractions import Fraction
+
 import pytest
 
 import logic.sim
@@ -71,6 +76,58 @@ def test_get_min_aggregate_pledge(mocker):
     assert min_aggr_pledge == num_pools / 2 * stake_per_pool
 
 
+def generate_pools(model, rng):
+    pools_list = []
+    for i in range(rng.randrange(1, 11)):
+        # pools without delegators (whose stake is equal to their pledge) are common in the simulations
+        pledge = rng.choice([0.001, rng.uniform(0.0001, 0.01)])
+        pool = Pool(owner=i, cost=0.001, pledge=pledge, margin=0.1, pool_id=i, reward_scheme=model.reward_scheme)
+        pool.stake = rng.choice([pledge, 0.01, rng.uniform(pledge, 0.02)])
+        pools_list.append(pool)
+    return pools_list
+
+
+def test_get_min_aggregate_pledge_matches_brute_force(mocker):
+    model = logic.sim.Simulation()
+    rng = random.Random(42)
+    for _ in range(20):
+        pools_list = generate_pools(model, rng)
+        mocker.patch('logic.sim.Simulation.get_pools_list', return_value=pools_list)
+
+        half_stake = sum(Fraction(pool.stake) for pool in pools_list) / 2
+        expected_pledge = min(
+            fsum([pool.pledge for pool in subset])
+            for size in range(len(pools_list) + 1) for subset in itertools.combinations(pools_list, size)
+            if sum(Fraction(pool.stake) for pool in subset) >= half_stake
+        )
+        model.min_aggregate_pledge_tolerance = 0
+        assert get_min_aggregate_pledge(model) == expected_pledge
+        # with some tolerance, the result may exceed the true minimum by up to that amount
+        model.min_aggregate_pledge_tolerance = 1e-3
+        assert expected_pledge <= get_min_aggregate_pledge(model) <= expected_pledge + 1e-3
+
+
+def test_get_min_aggregate_pledge_matches_solver(mocker):
+    # the same optimisation problem, formulated and solved as in earlier versions of the simulation
+    gekko = pytest.importorskip('gekko')
+    model = logic.sim.Simulation()
+    rng = random.Random(156)
+    for _ in range(10):
+        pools_list = generate_pools(model, rng)
+        mocker.patch('logic.sim.Simulation.get_pools_list', return_value=pools_list)
+
+        pledges = [pool.pledge for pool in pools_list]
+        stakes = [pool.stake for pool in pools_list]
+        g = gekko.GEKKO(remote=False)
+        x = g.Array(g.Var, len(pools_list), lb=0, ub=1, integer=True)
+        g.Minimize(g.sum([pledges[i] * x[i] for i in range(len(pools_list))]))
+        g.Equation(g.sum([stakes[i] * x[i] for i in range(len(pools_list))]) >= sum(stakes) / 2)
+        g.options.SOLVER = 1
+        g.solve(disp=False)
+
+        assert get_min_aggregate_pledge(model) == pytest.approx(g.options.objfcnval)
+
+
 def test_get_pool_splitter_count(mocker):
     model = logic.sim.Simulation()
 
@@ -116,6 +173,17 @@ def test_gini_coefficient():
     assert round(g5, decimals) == 0.56000
 
 
+def test_gini_coefficient_matches_pairwise_differences():
+    rng = np.random.default_rng(seed=156)
+    for values in [rng.pareto(2, 500), rng.integers(0, 10, 200), np.array([0.3]), np.zeros(5)]:
+        # straightforward calculation that goes through all pairs of values
+        diffsum = 0
+        for i, xi in enumerate(values[:-1], 1):
+            diffsum += np.sum(np.abs(xi - values[i:]))
+        expected_gini = diffsum / (len(values) * sum(values)) if sum(values) != 0 else -1
+        assert gini_coefficient(values) == pytest.approx(expected_gini, rel=1e-12)
+
+
 def test_get_gini_id_coeff_pool_count():
     model = logic.sim.Simulation()
 
@@ -209,6 +277,47 @@ def test_get_nakamoto_coefficient_total_stake_1():
     assert nc == 151
 
 
+def test_get_nakamoto_coefficient_matches_cumulative_sums():
+    model = logic.sim.Simulation(n=200)
+    rng = random.Random(24)
+    pools = {}
+    for i in range(300):
+        pools[i] = Pool(owner=rng.randrange(200), cost=0.001, pledge=0.001, margin=0.1, pool_id=i,
+                        reward_scheme=model.reward_scheme)
+        pools[i].stake = rng.choice([0.001, 0.002, 0.005]) * rng.random()
+    model.pools = pools
+
+    # straightforward calculation that sums the stake of the top agents separately for every number of agents
+    controlled_stake = collections.defaultdict(lambda: 0)
+    for pool in pools.values():
+        controlled_stake[pool.owner] += pool.stake
+    final_stake = [controlled_stake[agent_id] for agent_id in range(200)]
+    sorted_final_stake = sorted(final_stake, reverse=True)
+    cumulative_final_stake = np.array([fsum(sorted_final_stake[:i + 1]) for i in range(len(sorted_final_stake))])
+    expected_nc = np.argmax(cumulative_final_stake > fsum(final_stake) / 2) + 1
+
+    assert get_nakamoto_coefficient(model) == expected_nc
+    # values that sum up to the threshold don't exceed it, regardless of floating point errors
+    assert count_majority_holders(np.array([0.1] * 10), 0.5) == 6
+    assert count_majority_holders(np.zeros(3), 0) == 1
+
+
+def test_get_nakamoto_coefficient_without_pools():
+    model = logic.sim.Simulation(n=200, seed=24)
+    # the pools of the simulation have not been created yet when the initial state is described
+    del model.pools
+
+    # each agent controls their own stake, and the stake of the top agents is added until it exceeds half of the total
+    sorted_stake = sorted([agent.stake for agent in model.get_agents_dict().values()], reverse=True)
+    majority_control_agents = 0
+    majority_control_stake = 0
+    while majority_control_stake <= fsum(sorted_stake) / 2:
+        majority_control_stake += sorted_stake[majority_control_agents]
+        majority_control_agents += 1
+
+    assert get_nakamoto_coefficient(model) == majority_control_agents
+
+
 def test_get_median_stk_rnk(mocker):
     model = logic.sim.Simulation()
     agents = {x: NonMyopicStakeholder(unique_id=x, model=model, stake=x, cost=0.001) for x in range(1, 101)}
@@ -223,3 +332,32 @@ def test_get_median_stk_rnk(mocker):
     median_stk_rank = get_median_stk_rnk(model)
 
     assert median_stk_rank == 1
+
+
+def test_metrics_snapshot():
+    model = logic.sim.Simulation(n=50)
+    rng = random.Random(8)
+    pools = {}
+    for i in range(40):
+        pools[i] = Pool(owner=rng.randrange(50), cost=0.001, pledge=rng.uniform(0.0001, 0.005), margin=rng.random(),
+                        pool_id=i, reward_scheme=model.reward_scheme)
+        pools[i].stake = rng.uniform(0.001, 0.02)
+    model.pools = pools
+    snapshot = MetricsSnapshot(model)
+
+    # the aggregates of the snapshot are the same as the ones calculated by going through the pools
+    controlled_stake = collections.defaultdict(lambda: 0)
+    for pool in pools.values():
+        controlled_stake[pool.owner] += pool.stake
+    assert dict(zip(snapshot.operator_ids.tolist(), snapshot.stake_per_operator.tolist())) == controlled_stake
+    assert dict(zip(snapshot.operator_ids.tolist(), snapshot.pools_per_operator.tolist())) == \
+           collections.Counter(pool.owner for pool in pools.values())
+    agents = model.get_agents_dict()
+    stake_ranks = hlp.calculate_ranks({agent_id: agent.stake for agent_id, agent in agents.items()})
+    cost_ranks = hlp.calculate_ranks({agent_id: -agent.cost for agent_id, agent in agents.items()})
+    assert snapshot.owner_stake_ranks.tolist() == [stake_ranks[pool.owner] for pool in pools.values()]
+    assert snapshot.owner_cost_ranks.tolist() == [cost_ranks[pool.owner] for pool in pools.values()]
+
+    assert get_controlled_stake_distr_stat_dist(model, snapshot) == \
+           sum([abs(controlled_stake[agent_id] - agent.stake) for agent_id, agent in agents.items()]) / 2
+    assert get_stakes_n_margins(model, snapshot)['x'] == [agents[pool.owner].stake for pool in pools.values()]
@@ -0,0 +1,48 @@
+import logic.helper as hlp
+import logic.reward_schemes as rss
+from logic.pool import Pool
+
+
+def test_get_myopic_desirability():
+    reward_scheme = rss.CardanoRSS(k=10, a0=0.3)
+    pool = Pool(pool_id=1, cost=0.001, pledge=0.01, owner=1, reward_scheme=reward_scheme, margin=0.1)
+
+    def expected_myopic_desirability():
+        current_profit = hlp.calculate_current_profit(pool.stake, pool.pledge, pool.cost, reward_scheme)
+        return hlp.calculate_myopic_pool_desirability(pool.margin, current_profit)
+
+    assert pool.get_myopic_desirability(reward_scheme) == expected_myopic_desirability()
+
+    # the cached value gets re-calculated whenever a relevant attribute of the pool changes
+    pool.update_delegation(new_delegation=0.05, delegator_id=2)
+    assert pool.get_myopic_desirability(reward_scheme) == expected_myopic_desirability()
+    pool.margin = 0.2
+    assert pool.get_myopic_desirability(reward_scheme) == expected_myopic_desirability()
+    pool.pledge = 0.02
+    pool.cost = 0.002
+    assert pool.get_myopic_desirability(reward_scheme) == expected_myopic_desirability()
+
+    reward_scheme.k = 5
+    pool.set_profit(reward_scheme)
+    assert pool.get_myopic_desirability(reward_scheme) == expected_myopic_desirability()
+
+
+def test_draft():
+    reward_scheme = rss.CardanoRSS(k=10, a0=0.3)
+    pool = Pool(pool_id=1, cost=0.001, pledge=0.001, owner=1, reward_scheme=reward_scheme, margin=0.1)
+    pool.update_delegation(new_delegation=0.01, delegator_id=2)
+
+    pool_draft = pool.draft()
+    pool_draft.pledge = 0.002
+    pool_draft.margin = 0.2
+    assert pool.pledge == 0.001 and pool.margin == 0.1
+    # the delegators are shared until one of the two pools changes them
+    assert pool_draft.delegators is pool.delegators
+
+    pool.update_delegation(new_delegation=0.02, delegator_id=3)
+    assert pool.delegators == {2: 0.01, 3: 0.02}
+    assert pool_draft.delegators == {2: 0.01}
+
+    pool_draft.update_delegation(new_delegation=0, delegator_id=2)
+    assert pool_draft.delegators == {}
+    assert pool.delegators == {2: 0.01, 3: 0.02}
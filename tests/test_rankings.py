@@ -0,0 +1,113 @@
+import pickle
+import random
+from math import fsum
+
+import logic.helper as hlp
+import logic.reward_schemes as rss
+from logic.pool import Pool
+from logic.rankings import PoolRankings, RankingsOverlay
+
+
+def test_cumulative_saturation_stake():
+    reward_scheme = rss.CIP50RSS(k=10, a0=50)
+    rng = random.Random(156)
+    pools = [
+        Pool(pool_id=i, cost=0.0001, pledge=rng.uniform(0.0001, 0.003), owner=i, reward_scheme=reward_scheme,
+             margin=rng.random())
+        for i in range(1, 51)
+    ]
+    rankings = PoolRankings([None] * 11, key=hlp.pool_comparison_key, reward_scheme=reward_scheme)
+    rankings.update(pools[:30])
+
+    for step in range(100):
+        # alternate between queries and modifications of the rankings to make sure that the sums stay up-to-date
+        rank = rng.randrange(len(rankings) + 1)
+        expected_stake = fsum([reward_scheme.get_pool_saturation_threshold(pool.pledge)
+                               for pool in rankings[:rank] if pool is not None])
+        assert abs(rankings.cumulative_saturation_stake(rank) - expected_stake) < 1e-15
+        pool = rng.choice(pools)
+        if pool in rankings:
+            rankings.remove(pool)
+        else:
+            rankings.add(pool)
+
+
+def test_calculate_non_myopic_pool_stake_with_pool_rankings():
+    reward_scheme = rss.CardanoRSS(k=10, a0=0.3)
+    pools = [
+        Pool(pool_id=i, cost=0.0001, pledge=0.001 * i, owner=i, reward_scheme=reward_scheme, margin=0.01 * i)
+        for i in range(1, 16)
+    ]
+    ranked_list = sorted(pools, key=hlp.pool_comparison_key)
+    rankings = PoolRankings(pools, key=hlp.pool_comparison_key, reward_scheme=reward_scheme)
+
+    for pool in pools:
+        assert hlp.calculate_non_myopic_pool_stake(pool, rankings, reward_scheme, total_stake=1) == \
+               hlp.calculate_non_myopic_pool_stake(pool, ranked_list, reward_scheme, total_stake=1)
+
+
+def test_rankings_overlay():
+    reward_scheme = rss.CardanoRSS(k=10, a0=0.3)
+    rng = random.Random(42)
+    pools = [
+        Pool(pool_id=i, cost=0.0001, pledge=rng.uniform(0.0001, 0.003), owner=i % 7, reward_scheme=reward_scheme,
+             margin=rng.random())
+        for i in range(1, 41)
+    ]
+    rankings = PoolRankings([None] * 11, key=hlp.pool_comparison_key, reward_scheme=reward_scheme)
+    rankings.update(pools)
+    hypothetical_pools = [
+        Pool(pool_id=100 + i, cost=0.0001, pledge=0.001, owner=3, reward_scheme=reward_scheme, margin=0.05 * i)
+        for i in range(4)
+    ]
+
+    overlay = RankingsOverlay(rankings, excluded_owner=3, extra_pools=hypothetical_pools)
+    expected_rankings = PoolRankings([pool for pool in rankings if pool is None or pool.owner != 3],
+                                     key=hlp.pool_comparison_key, reward_scheme=reward_scheme)
+    expected_rankings.update(hypothetical_pools)
+
+    assert len(overlay) == len(expected_rankings)
+    assert list(overlay) == list(expected_rankings)
+    assert overlay[5:20] == expected_rankings[5:20]
+    for rank in range(len(expected_rankings)):
+        assert overlay[rank] is expected_rankings[rank]
+        assert abs(overlay.cumulative_saturation_stake(rank) - expected_rankings.cumulative_saturation_stake(rank)) \
+               < 1e-15
+    for pool in hypothetical_pools:
+        assert overlay.index(pool) == expected_rankings.index(pool)
+    # the underlying rankings remain intact
+    assert len(rankings) == 51
+
+
+def test_rankings_overlay_order_statistic():
+    reward_scheme = rss.CardanoRSS(k=20, a0=0.3)
+    rng = random.Random(7)
+    pools = [
+        Pool(pool_id=i, cost=0.0001, pledge=rng.uniform(0.0001, 0.003), owner=rng.randrange(5),
+             reward_scheme=reward_scheme, margin=rng.random())
+        for i in range(1, 31)
+    ]
+    rankings = PoolRankings([None] * 21, key=hlp.pool_comparison_key, reward_scheme=reward_scheme)
+    rankings.update(pools)
+
+    for owner in range(5):
+        fixed_pools_ranked = [pool for pool in rankings if pool is None or pool.owner != owner]
+        overlay = RankingsOverlay(rankings, excluded_owner=owner)
+        for t in range(1, 21):
+            assert overlay[20 - t] is fixed_pools_ranked[20 - t]
+
+
+def test_pickle_pool_rankings():
+    reward_scheme = rss.CardanoRSS(k=10, a0=0.3)
+    pools = [
+        Pool(pool_id=i, cost=0.0001, pledge=0.001 * i, owner=i, reward_scheme=reward_scheme, margin=0.01 * i)
+        for i in range(1, 16)
+    ]
+    rankings = PoolRankings([None] * 11 + pools, key=hlp.pool_comparison_key, reward_scheme=reward_scheme)
+
+    restored_rankings = pickle.loads(pickle.dumps(rankings))
+    assert [(pool.id if pool is not None else None) for pool in restored_rankings] == \
+           [(pool.id if pool is not None else None) for pool in rankings]
+    assert restored_rankings.key is hlp.pool_comparison_key
+    restored_rankings.add(Pool(pool_id=16, cost=0.0001, pledge=0.05, owner=16, reward_scheme=reward_scheme, margin=0))
+    assert restored_rankings[0].id == 16
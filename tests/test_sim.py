@@ -1,7 +1,208 @@
+import csv
+import itertools
+import random
+from fractions import Fraction
+from math import fsum
+import pytest
+
+import logic.model_reporters as reporters
 from logic.pool import Pool
 from logic.stakeholder import Stakeholder
 from logic.sim import Simulation
+from logic.metrics import COLLECTION_POLICIES, MetricsCollector, MetricsSnapshot, ExactSum, solve_knapsack, \
+    to_exact_integers
 
 
 def test_revise_beliefs():
     assert False
+
+
+def test_get_agents_dict():
+    model = Simulation(n=20, k=5, seed=156, generate_graphs=False)
+    agents = model.get_agents_dict()
+    assert agents == {agent.unique_id: agent for agent in model.schedule.agents}
+    # the same index is maintained throughout the simulation instead of being rebuilt
+    model.step()
+    assert model.get_agents_dict() is agents
+
+
+def test_normalize_agent_stake():
+    model = Simulation(n=100, k=10, seed=156, generate_graphs=False)
+    agents = model.get_agents_list()
+    # the agents read their stake from the population's arrays
+    assert [agent.stake for agent in agents] == list(model.population.stakes)
+    assert sum(agent.stake for agent in agents) == 1
+
+    stakes = [agent.stake * 3 for agent in agents]
+    for agent, stake in zip(agents, stakes):
+        agent.stake = stake
+    expected_stakes = [stake / 3 for stake in stakes]
+    expected_total = sum(expected_stakes)
+    expected_stakes[-1] += 1 - expected_total
+    assert model.normalize_agent_stake(3) == 1
+    assert [agent.stake for agent in agents] == expected_stakes
+
+
+def test_parallel_simultaneous_activation():
+    final_states = []
+    for agent_activation_order in ['simultaneous', 'parallelsimultaneous']:
+        model = Simulation(n=50, k=5, seed=156, max_iterations=10, agent_activation_order=agent_activation_order,
+                           num_workers=2, generate_graphs=False)
+        model.run_model()
+        final_states.append([(pool.id, pool.owner, pool.stake, pool.pledge, pool.margin, pool.delegators)
+                             for pool in model.get_pools_list()])
+    # evaluating the agents' moves in parallel yields exactly the same results
+    assert final_states[0] == final_states[1]
+
+
+def test_semi_simultaneous_activation(mocker):
+    model = Simulation(n=50, k=5, seed=156, max_iterations=30, agent_activation_order='semisimultaneous',
+                       simultaneous_moves=4, adaptive_simultaneous_moves=True, generate_graphs=False)
+    step_spies = [mocker.spy(agent, 'step') for agent in model.schedule.agents]
+    model.step()
+    # every agent is activated exactly once per step
+    assert all(spy.call_count == 1 for spy in step_spies)
+    mocker.stopall()
+
+    model.run_model()
+    assert model.has_converged()
+    # no agent moved in the last steps, so all of them were activated in one block
+    assert model.schedule.current_simultaneous_moves == 50
+
+
+def test_regret_prioritized_activation():
+    model = Simulation(n=50, k=5, seed=156, max_iterations=100, agent_activation_order='regret',
+                       generate_graphs=False)
+    model.run_model()
+    assert model.has_converged()
+
+    # the simulation only converges after a sweep of all agents where no one wants to move
+    for agent in model.get_agents_list():
+        agent.update_strategy()
+        assert agent.new_strategy is None
+
+
+def test_exact_pool_count_search():
+    # by default, the number of pools is chosen with the binary search, which yields the same results as before
+    model = Simulation(n=150, k=10, seed=42, reward_scheme=2, generate_graphs=False)
+    model.run_model()
+    assert model.schedule.steps == 13
+    assert len(model.pools) == 333
+
+    # the utility curve is not always unimodal, so picking the best number of pools overall may lead elsewhere
+    model = Simulation(n=150, k=10, seed=42, reward_scheme=2, exact_pool_count_search=True, generate_graphs=False)
+    model.run_model()
+    assert model.has_converged()
+    assert len(model.pools) == 540
+
+
+def test_metrics_collector(tmp_path):
+    rows = [{'Pool count': step, 'Mean margin': step / 10 if step > 2 else 0, 'Stake per agent': [step, 0]}
+            for step in range(250)]
+    files = []
+    for keep_history in [True, False]:
+        filepath = tmp_path / 'metrics-{}.csv'.format(keep_history)
+        collector = MetricsCollector(model_reporters=dict.fromkeys(rows[0]), filepath=filepath, chunk_size=40,
+                                     keep_history=keep_history)
+        for row in rows:
+            collector.add_row(row)
+        collector.flush()
+        with open(filepath) as file:
+            files.append(list(csv.reader(file)))
+        assert collector.get_row(collector.last_step) == rows[-1]
+        assert collector.get_latest_value('Stake per agent') == [249, 0]
+    assert files[0] == files[1]
+    assert files[0][0] == ['Round', 'Pool count', 'Mean margin', 'Stake per agent']
+    assert files[0][1:] == [[str(step), str(row['Pool count']), str(float(row['Mean margin'])),
+                             str(row['Stake per agent'])] for step, row in enumerate(rows)]
+
+    # the whole history is kept in memory only if needed, otherwise the rows are dropped once they're written to file
+    collector = MetricsCollector(model_reporters=dict.fromkeys(rows[0]), filepath=tmp_path / 'metrics.csv',
+                                 chunk_size=40, keep_history=False)
+    for row in rows:
+        collector.add_row(row)
+    assert list(collector.retained_steps) == list(range(240, 250))
+    assert collector.get_column('Pool count').tolist() == list(range(240, 250))
+    assert collector.get_row(245) == rows[245]
+
+
+def test_collection_policies():
+    rows = {}
+    for policy in COLLECTION_POLICIES:
+        model = Simulation(n=100, k=10, seed=156, max_iterations=25, agent_profile_distr=[0.5, 0.5, 0],
+                           generate_graphs=False, collection_policy=policy, collection_period=4)
+        while model.running:
+            model.step()
+        with open(model.directory / 'metrics.csv') as file:
+            rows[policy] = {int(row['Round']): row for row in csv.DictReader(file)}
+    all_steps = list(rows['every_step'])
+    assert all_steps == list(range(len(all_steps)))
+    assert [step for step in rows['every_n_steps'] if step % 4 == 0] == [step for step in all_steps if step % 4 == 0]
+    assert len(rows['final']) == 1
+    assert len(rows['on_change']) < len(all_steps)
+    for policy in COLLECTION_POLICIES:
+        # the collected steps are the same as with the default policy
+        for step, row in rows[policy].items():
+            if step in rows['every_step']:
+                assert row == rows['every_step'][step]
+        # and the final state of the simulation is always collected (unless it was already collected at an earlier step)
+        final_metrics = dict(list(rows[policy].values())[-1], Round=None)
+        assert final_metrics == dict(rows['every_step'][all_steps[-1]], Round=None)
+
+    with pytest.raises(ValueError):
+        Simulation(n=100, k=10, collection_policy='sometimes', generate_graphs=False)
+
+
+def test_incremental_metrics():
+    model = Simulation(n=100, k=10, seed=156, max_iterations=25, agent_profile_distr=[0.5, 0.5, 0],
+                       generate_graphs=False)
+    incremental_reporters = [
+        reporters.get_total_pledge, reporters.get_avg_pools_per_operator, reporters.get_max_pools_per_operator,
+        reporters.get_median_pools_per_operator, reporters.get_nakamoto_coefficient, reporters.get_pledge_rate,
+        reporters.get_pool_splitter_count, reporters.get_total_delegated_stake, reporters.get_operator_count
+    ]
+    while model.running:
+        model.step()
+        # the metrics that are maintained as the pools change match the ones calculated from scratch
+        snapshot = MetricsSnapshot(model, incremental_metrics=model.incremental_metrics)
+        assert model.incremental_metrics.pool_count == len(model.pools)
+        for reporter in incremental_reporters:
+            assert reporter(model, snapshot) == reporter(model)
+
+    values = [0.1] * 10 + [1e20, 1e-20]
+    exact_sum = ExactSum()
+    for value in values:
+        exact_sum.add(value)
+    exact_sum.subtract(1e20)
+    assert exact_sum.value == fsum(values[:-2] + values[-1:])
+
+
+def test_solve_knapsack():
+    rng = random.Random(156)
+    for _ in range(500):
+        num_items = rng.randrange(12)
+        # small ranges of values and weights, so that there are many identical items and ties
+        values = [rng.randrange(8) for _ in range(num_items)]
+        weights = [rng.randrange(6) for _ in range(num_items)]
+        capacity = rng.randrange(30)
+        expected_value = max(
+            sum(values[i] for i in subset)
+            for size in range(num_items + 1) for subset in itertools.combinations(range(num_items), size)
+            if sum(weights[i] for i in subset) <= capacity
+        )
+        chosen_items, value = solve_knapsack(values, weights, capacity)
+        assert value == expected_value == sum(values[i] for i in chosen_items)
+        assert sum(weights[i] for i in chosen_items) <= capacity
+
+        # with some tolerance, the solution may be worse than the optimal one by up to that amount
+        chosen_items, value = solve_knapsack(values, weights, capacity, tolerance=2)
+        assert value == sum(values[i] for i in chosen_items)
+        assert sum(weights[i] for i in chosen_items) <= capacity
+        assert expected_value - 2 <= value <= expected_value
+
+    # the values are scaled exactly, i.e. all of them by the same factor
+    values = [0.1, 0.2, 0.3, 1e-20, 3]
+    scaled_values = to_exact_integers(values)
+    assert all(isinstance(value, int) for value in scaled_values)
+    assert all(Fraction(scaled_value) / Fraction(value) == Fraction(scaled_values[-1], 3)
+               for value, scaled_value in zip(values, scaled_values))
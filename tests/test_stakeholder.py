@@ -253,4 +253,145 @@ def test_execute_strategy(mocker):
     assert pytest.approx(model.pools[3].stake) == 0.002
 
 
-
+@pytest.mark.parametrize('agent_profile_distr', [[1, 0, 0], [0, 1, 0]])
+def test_get_utility_calculator(agent_profile_distr):
+    model = Simulation(n=100, k=10, seed=42, agent_profile_distr=agent_profile_distr, generate_graphs=False)
+    for _ in range(5):
+        model.step()
+
+    k = model.reward_scheme.k
+    for agent in model.schedule.agents:
+        calculate_utilities = agent.get_utility_calculator(max_num_pools=k)
+        expected_utilities = [agent.calculate_margins_and_utility(num_pools=t)[1] for t in range(1, k + 1)]
+        # the vectorised calculation must yield exactly the same utilities as the one for a single number of pools
+        assert list(calculate_utilities(range(1, k + 1))) == expected_utilities
+        # also when only some of the numbers of pools are requested, in any order
+        assert list(calculate_utilities([k, 1, 5, 4])) == [expected_utilities[t - 1] for t in [k, 1, 5, 4]]
+
+
+def test_update_strategy_reuses_idle_decision(mocker):
+    model = Simulation(n=50, k=5, seed=156, generate_graphs=False)
+    while model.running:
+        model.step()
+    # the simulation has converged, so no agent wants to change their strategy
+    agent = model.schedule.agents[0]
+    id_seq = model.id_seq
+    agent.update_strategy()
+    assert agent.new_strategy is None
+    assert agent.idle_state_version == model.state_version
+    num_pool_ids = model.id_seq - id_seq
+    assert num_pool_ids > 0
+
+    choose_pool_strategy = mocker.spy(agent, 'choose_pool_strategy')
+    id_seq = model.id_seq
+    agent.update_strategy()
+    # nothing has changed in the system, so the agent doesn't need to reconsider their strategy
+    choose_pool_strategy.assert_not_called()
+    assert agent.new_strategy is None
+    # the pool ids that the agent's hypothetical moves used are still skipped, so later pools get the same ids
+    assert model.id_seq - id_seq == num_pool_ids
+
+    model.register_state_change()
+    agent.update_strategy()
+    choose_pool_strategy.assert_called_once()
+
+
+def test_reused_idle_decisions_keep_pool_ids(monkeypatch):
+    final_states = []
+    for reuse_idle_decisions in [True, False]:
+        if not reuse_idle_decisions:
+            update_strategy = NonMyopicStakeholder.update_strategy
+
+            def update_strategy_from_scratch(agent):
+                agent.idle_state_version = None
+                update_strategy(agent)
+            monkeypatch.setattr(NonMyopicStakeholder, 'update_strategy', update_strategy_from_scratch)
+        model = Simulation(n=50, k=5, seed=156, max_iterations=30, generate_graphs=False)
+        model.run_model()
+        final_states.append((model.id_seq, [(pool.id, pool.owner, pool.stake) for pool in model.get_pools_list()]))
+    # the pools get the same ids whether the agents reuse their idle decisions or not
+    assert final_states[0] == final_states[1]
+
+
+def determine_stake_allocations_by_withdrawing(agent, stake_to_delegate):
+    """
+    Allocate the stake the way that determine_stake_allocations used to: by withdrawing the agent's delegations from the
+    pools, comparing the stake to the saturation threshold of each pool and then returning the delegations (so the
+    pools end up with the same delegations but possibly with slightly different stake, due to rounding).
+    """
+    model = agent.model
+    eligible_pools_ranked = [
+        pool
+        for pool in agent.rankings
+        if pool is not None and pool.owner != agent.unique_id and not pool.is_private
+    ]
+    for pool_id in agent.strategy.stake_allocations:
+        pool = model.pools[pool_id]
+        model.pool_rankings_myopic.remove(pool)
+        pool.update_delegation(new_delegation=0, delegator_id=agent.unique_id)
+        model.pool_rankings_myopic.add(pool)
+    allocations = dict()
+    best_saturated_pool = None
+    for pool in eligible_pools_ranked:
+        stake_to_saturation = model.reward_scheme.get_pool_saturation_threshold(pool.pledge) - pool.stake
+        if stake_to_saturation < hlp.MIN_STAKE_UNIT:
+            if best_saturated_pool is None:
+                best_saturated_pool = pool
+            continue
+        allocations[pool.id] = min(stake_to_delegate, stake_to_saturation)
+        stake_to_delegate -= allocations[pool.id]
+        if stake_to_delegate < hlp.MIN_STAKE_UNIT:
+            break
+    if stake_to_delegate >= hlp.MIN_STAKE_UNIT and best_saturated_pool is not None:
+        allocations[best_saturated_pool.id] = stake_to_delegate
+    for pool_id, allocation in agent.strategy.stake_allocations.items():
+        pool = model.pools[pool_id]
+        model.pool_rankings_myopic.remove(pool)
+        pool.update_delegation(new_delegation=allocation, delegator_id=agent.unique_id)
+        model.pool_rankings_myopic.add(pool)
+    return allocations
+
+
+@pytest.mark.parametrize('agent_profile_distr', [[1, 0, 0], [0.5, 0.5, 0]])
+def test_determine_stake_allocations_leaves_pools_intact(agent_profile_distr):
+    model = Simulation(n=50, k=5, seed=156, agent_profile_distr=agent_profile_distr, generate_graphs=False)
+    for _ in range(3):
+        model.step()
+    delegators = [agent for agent in model.schedule.agents if len(agent.strategy.stake_allocations) > 0]
+    assert len(delegators) > 0
+
+    pool_states = {pool_id: (pool.stake, dict(pool.delegators)) for pool_id, pool in model.pools.items()}
+    myopic_rankings = list(model.pool_rankings_myopic)
+    allocations = dict()
+    for agent in delegators:
+        allocations[agent.unique_id] = agent.determine_stake_allocations(agent.stake)
+        assert abs(sum(allocations[agent.unique_id].values()) - agent.stake) < 1e-12
+    assert {pool_id: (pool.stake, pool.delegators) for pool_id, pool in model.pools.items()} == pool_states
+    assert list(model.pool_rankings_myopic) == myopic_rankings
+
+    # the allocations are the same as the ones found by withdrawing the agent's delegations from the pools
+    for agent in delegators:
+        assert determine_stake_allocations_by_withdrawing(agent, agent.stake) == allocations[agent.unique_id]
+        # undo any rounding differences, so that the next agent starts from the same state
+        for pool_id in agent.strategy.stake_allocations:
+            pool = model.pools[pool_id]
+            model.pool_rankings_myopic.remove(pool)
+            pool.stake, pool.delegators = pool_states[pool_id][0], dict(pool_states[pool_id][1])
+            model.pool_rankings_myopic.add(pool)
+
+
+@pytest.mark.parametrize('reward_scheme', [0, 1, 2])
+def test_get_num_pools_bracket(reward_scheme):
+    model = Simulation(n=100, k=10, seed=42, reward_scheme=reward_scheme, generate_graphs=False)
+    for _ in range(5):
+        model.step()
+    # an agent that can saturate several pools with their pledge alone
+    model.schedule.agents[0].stake = 0.35
+
+    k = model.reward_scheme.k
+    for agent in model.schedule.agents:
+        t_min, t_max = agent.get_num_pools_bracket()
+        utility_curve = agent.get_utility_calculator(max_num_pools=k)(range(1, k + 1))
+        # the pool count that maximises the agent's utility must be within the bracket
+        assert t_min <= utility_curve.argmax() + 1 <= t_max
+    assert model.schedule.agents[0].get_num_pools_bracket()[0] == 3